@@ -0,0 +1,173 @@
+import asyncio
+import math
+import os
+from collections import OrderedDict, deque
+from urllib.parse import parse_qsl
+
+from app.metrics import ADMISSION_QUEUED, ADMISSION_QUEUE_DEPTH
+from app.utils import LIST_MEDIA_TYPES, XML_MEDIA_TYPE, negotiate
+
+# Listings that are expensive to answer when they search by regex or return
+# the whole collection as XML
+EXPENSIVE_LISTINGS = frozenset(("/medications/", "/inventory/"))
+
+# Never limited, so the service can still be observed and tuned under load
+EXEMPT_PREFIXES = ("/metrics", "/admin/")
+
+# Clients whose token buckets are remembered; the least recently seen are
+# forgotten first and start over with a full bucket
+MAX_TRACKED_CLIENTS = 10000
+
+
+class AdmissionSettings:
+    """Limits applied by AdmissionMiddleware, changed at runtime via PUT /admin/admission.
+
+    A rate of 0 switches that token bucket off. They are per process: with
+    several workers each one admits up to these limits.
+    """
+
+    def __init__(self):
+        # Requests per second per client (by address), and how many it may make at once
+        self.client_rate = float(os.environ.get("CLIENT_RATE_LIMIT", "0"))
+        self.client_burst = float(os.environ.get("CLIENT_BURST", "20"))
+        # Requests per second per route, from all clients together
+        self.route_rate = float(os.environ.get("ROUTE_RATE_LIMIT", "0"))
+        self.route_burst = float(os.environ.get("ROUTE_BURST", "100"))
+        # Tokens an expensive request takes from both buckets
+        self.expensive_cost = float(os.environ.get("EXPENSIVE_COST", "5"))
+        # Expensive requests served at once per listing, how many more may
+        # wait for a slot and for how many seconds
+        self.expensive_concurrency = int(os.environ.get("EXPENSIVE_CONCURRENCY", "4"))
+        self.expensive_queue = int(os.environ.get("EXPENSIVE_QUEUE", "16"))
+        self.queue_timeout = float(os.environ.get("ADMISSION_QUEUE_TIMEOUT", "2.0"))
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+
+settings = AdmissionSettings()
+
+
+def exempt(path: str) -> bool:
+    return path.startswith(EXEMPT_PREFIXES)
+
+
+def is_expensive(scope) -> bool:
+    # A regex search, or a whole listing (no limit) rendered as XML
+    if scope["method"] != "GET" or scope["path"] not in EXPENSIVE_LISTINGS:
+        return False
+    params = dict(parse_qsl(scope["query_string"].decode("latin-1")))
+    if params.get("regex"):
+        return True
+    if "limit" in params or params.get("stream") in ("1", "true"):
+        return False
+    accept = next((value.decode("latin-1") for name, value in scope["headers"] if name == b"accept"), "")
+    return negotiate(accept, LIST_MEDIA_TYPES)[0] == XML_MEDIA_TYPE
+
+
+def retry_after(seconds: float) -> str:
+    # Retry-After takes whole seconds
+    return str(max(1, math.ceil(seconds)))
+
+
+class TokenBucket:
+    __slots__ = ("tokens", "updated")
+
+    def __init__(self, burst: float, now: float):
+        self.tokens = burst
+        self.updated = now
+
+    def wait(self, cost: float, rate: float, burst: float, now: float) -> float:
+        # Seconds until cost tokens are available; 0 when they are now
+        self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+        cost = min(cost, burst)
+        return 0.0 if self.tokens >= cost else (cost - self.tokens) / rate
+
+    def take(self, cost: float, burst: float):
+        self.tokens -= min(cost, burst)
+
+
+class TokenBuckets:
+    """One TokenBucket per key, forgetting the least recently used beyond max_size."""
+
+    def __init__(self, max_size: int = MAX_TRACKED_CLIENTS):
+        self.max_size = max_size
+        self._buckets = OrderedDict()
+
+    def get(self, key, burst: float, now: float) -> TokenBucket:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = TokenBucket(burst, now)
+            if len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(key)
+        return bucket
+
+    def clear(self):
+        self._buckets.clear()
+
+
+class ConcurrencyLimit:
+    """Serves up to settings.expensive_concurrency requests at once.
+
+    Requests beyond that wait in a FIFO queue of at most
+    settings.expensive_queue, each for at most settings.queue_timeout. It
+    lives on the event loop and needs no locks.
+    """
+
+    def __init__(self, endpoint: str):
+        self.endpoint = endpoint
+        self.active = 0
+        self._waiters = deque()
+        self._queued = ADMISSION_QUEUED.labels(endpoint=endpoint)
+        self._depth = ADMISSION_QUEUE_DEPTH.labels(endpoint=endpoint)
+
+    def __len__(self) -> int:
+        return len(self._waiters)
+
+    async def acquire(self):
+        # None once admitted (call release() when done), else why the
+        # request is shed: "queue_full" or "queue_timeout"
+        if self.active < settings.expensive_concurrency and not self._waiters:
+            self.active += 1
+            return None
+        if len(self._waiters) >= settings.expensive_queue:
+            return "queue_full"
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._queued.inc()
+        self._depth.inc()
+        try:
+            await asyncio.wait_for(waiter, settings.queue_timeout)
+        except asyncio.TimeoutError:
+            return "queue_timeout"
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                self.release()
+            raise
+        finally:
+            self._depth.dec()
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+        return None
+
+    def release(self):
+        self.active -= 1
+        self.admit_waiting()
+
+    def admit_waiting(self):
+        # Free slots go to the longest waiting requests that are still waiting
+        while self._waiters and self.active < settings.expensive_concurrency:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)
+                self.active += 1
+
+
+# Buckets per client address and per (method, route template), and the
+# limits of the expensive listings; only used on the event loop
+client_buckets = TokenBuckets()
+route_buckets = TokenBuckets()
+expensive_limits = {path: ConcurrencyLimit(path) for path in EXPENSIVE_LISTINGS}
@@ -0,0 +1,190 @@
+import os
+import socket
+import sqlite3
+import struct
+import threading
+import time
+import uuid
+
+from app.metrics import INVALIDATIONS_PUBLISHED, INVALIDATIONS_RECEIVED
+
+# "unix:///run/medications-bus" sends datagrams between the nodes of one host
+# through sockets in that directory; "sqlite:///bus.db" passes messages
+# through a table, for hosts or sandboxes without Unix sockets. Either way the
+# nodes also need a shared STORAGE_URL.
+INVALIDATION_BUS = os.environ.get("INVALIDATION_BUS", "")
+# How often the SQLite bus looks for new messages
+BUS_POLL_INTERVAL = float(os.environ.get("BUS_POLL_INTERVAL", "0.02"))
+
+# Sequence number of the shared store after a write
+MESSAGE = struct.Struct("<Q")
+SOCKET_SUFFIX = ".sock"
+
+
+class InvalidationBus:
+    """Tells the other nodes sharing a store that it moved on to a new seq.
+
+    A node publish()es the store's sequence number after each of its writes;
+    `latest` is the highest one announced by any other node. Messages carry
+    nothing but that number, and nodes pull the changes themselves from the
+    store (Repository.changes_since), so a lost message is made up for by
+    the next one.
+    """
+
+    def __init__(self):
+        self.node_id = f"{os.getpid()}-{uuid.uuid4().hex[:8]}"
+        self.latest = 0
+        self._lock = threading.Lock()
+
+    def publish(self, seq: int):
+        raise NotImplementedError
+
+    def _received(self, seq: int):
+        INVALIDATIONS_RECEIVED.inc()
+        with self._lock:
+            if seq > self.latest:
+                self.latest = seq
+
+    def close(self):
+        pass
+
+
+class UnixSocketBus(InvalidationBus):
+    """Datagram sockets in a directory shared by the nodes of one host.
+
+    Every node binds <directory>/<node id>.sock and publish() sends to every
+    other socket there. A socket left behind by a node that went away
+    refuses the datagram and is removed.
+    """
+
+    def __init__(self, directory: str):
+        super().__init__()
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.path = os.path.join(directory, self.node_id + SOCKET_SUFFIX)
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._socket.bind(self.path)
+        self._closed = False
+        self._sender = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self._sender.setblocking(False)
+        self._receiver = threading.Thread(target=self._receive, name="bus-receiver", daemon=True)
+        self._receiver.start()
+
+    def publish(self, seq: int):
+        INVALIDATIONS_PUBLISHED.inc()
+        message = MESSAGE.pack(seq)
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if not name.endswith(SOCKET_SUFFIX) or path == self.path:
+                continue
+            try:
+                self._sender.sendto(message, path)
+            except (ConnectionRefusedError, FileNotFoundError):
+                self._remove_stale(path)
+            except BlockingIOError:
+                pass  # the node is not keeping up; its next sync catches up
+
+    @staticmethod
+    def _remove_stale(path: str):
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+
+    def _receive(self):
+        while True:
+            message = self._socket.recv(MESSAGE.size)
+            if self._closed:
+                return
+            if len(message) == MESSAGE.size:
+                self._received(MESSAGE.unpack(message)[0])
+
+    def close(self):
+        # An empty datagram to our own socket wakes the receiver
+        self._closed = True
+        self._sender.sendto(b"", self.path)
+        self._receiver.join()
+        self._remove_stale(self.path)
+        self._socket.close()
+        self._sender.close()
+
+
+BUS_SCHEMA = """
+CREATE TABLE IF NOT EXISTS invalidations (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    node TEXT NOT NULL,
+    seq INTEGER NOT NULL
+);
+"""
+
+
+class SQLiteBus(InvalidationBus):
+    """Messages in a table that every node polls every BUS_POLL_INTERVAL.
+
+    PRAGMA data_version tells whether another connection wrote since the last
+    poll, so an idle bus costs one pragma per poll. Messages older than
+    `retention` are deleted by the nodes that publish.
+    """
+
+    def __init__(self, path: str, poll_interval: float = BUS_POLL_INTERVAL, retention: float = 60.0):
+        super().__init__()
+        self.path = path
+        self.retention = retention
+        self._publisher = self._connect()
+        self._publisher.executescript(BUS_SCHEMA)
+        self._publish_lock = threading.Lock()
+        self._pruned_at = time.monotonic()
+        self._last_id = self._retained_id = self._publisher.execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+        self._stop = threading.Event()
+        self._poller = threading.Thread(target=self._poll, args=(poll_interval,), name="bus-poller", daemon=True)
+        self._poller.start()
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    def publish(self, seq: int):
+        INVALIDATIONS_PUBLISHED.inc()
+        with self._publish_lock:
+            self._publisher.execute("INSERT INTO invalidations (node, seq) VALUES (?, ?)", (self.node_id, seq))
+            if time.monotonic() - self._pruned_at > self.retention:
+                self._pruned_at = time.monotonic()
+                # Row ids grow with time, so this keeps roughly `retention`
+                # seconds of messages without storing timestamps
+                self._publisher.execute("DELETE FROM invalidations WHERE id <= ?", (self._retained_id,))
+                self._retained_id = self._publisher.execute("SELECT COALESCE(MAX(id), 0) FROM invalidations").fetchone()[0]
+
+    def _poll(self, interval: float):
+        conn = self._connect()
+        data_version = None
+        try:
+            while not self._stop.wait(interval):
+                version = conn.execute("PRAGMA data_version").fetchone()[0]
+                if version == data_version:
+                    continue
+                data_version = version
+                for message_id, node, seq in conn.execute("SELECT id, node, seq FROM invalidations WHERE id > ? ORDER BY id", (self._last_id,)).fetchall():
+                    self._last_id = message_id
+                    if node != self.node_id:
+                        self._received(seq)
+        finally:
+            conn.close()
+
+    def close(self):
+        self._stop.set()
+        self._poller.join()
+        self._publisher.close()
+
+
+def open_bus(url: str):
+    # "unix:///relative/dir", "unix:////absolute/dir", "sqlite:///relative.db"
+    # or "sqlite:////absolute.db"; None without a bus
+    if not url:
+        return None
+    if url.startswith("unix:///"):
+        return UnixSocketBus(url[len("unix:///"):])
+    if url.startswith("sqlite:///"):
+        return SQLiteBus(url[len("sqlite:///"):])
+    raise ValueError(f"Unsupported INVALIDATION_BUS: {url}")
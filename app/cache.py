@@ -0,0 +1,115 @@
+import os
+import threading
+from collections import OrderedDict
+from fastapi.responses import Response as FastAPIResponse
+
+from app.metrics import RESPONSE_CACHE_HITS, RESPONSE_CACHE_MISSES, RESPONSE_CACHE_BYTES
+from app.tracing import run_offloaded
+
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get("RESPONSE_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+
+
+class ResponseCache:
+    """LRU cache of encoded response bodies, bounded by total body size.
+
+    Every entry is registered under one or more tags (e.g. "medications" for
+    any medication list, ("medication", 1) for a single item) and the data
+    layer invalidates by tag whenever it saves or removes a record.
+    """
+
+    def __init__(self, max_bytes: int = RESPONSE_CACHE_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.generation = 0
+        self._entries = OrderedDict()
+        self._tags = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+        (RESPONSE_CACHE_HITS if entry is not None else RESPONSE_CACHE_MISSES).labels(resource=key[0]).inc()
+        return entry
+
+    def put(self, key, body: bytes, media_type: str, tags, generation: int = None, headers: dict = None):
+        if len(body) > self.max_bytes:
+            return
+        with self._lock:
+            # Drop the entry if anything was invalidated while it was being built
+            if generation is not None and generation != self.generation:
+                return
+            self._discard(key)
+            self._entries[key] = (body, media_type, tuple(tags), headers)
+            self.size += len(body)
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while self.size > self.max_bytes:
+                self._discard(next(iter(self._entries)))
+            RESPONSE_CACHE_BYTES.set(self.size)
+
+    def invalidate(self, *tags):
+        with self._lock:
+            self.generation += 1
+            for tag in tags:
+                for key in self._tags.pop(tag, ()):
+                    self._discard(key)
+            RESPONSE_CACHE_BYTES.set(self.size)
+
+    def clear(self):
+        with self._lock:
+            self.generation += 1
+            self._entries.clear()
+            self._tags.clear()
+            self.size = 0
+            RESPONSE_CACHE_BYTES.set(0)
+
+    def _discard(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        self.size -= len(entry[0])
+        for tag in entry[2]:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+
+response_cache = ResponseCache()
+
+
+def _cached(key):
+    entry = response_cache.get(key)
+    if entry is not None:
+        return FastAPIResponse(content=entry[0], media_type=entry[1], headers=entry[3])
+    return None
+
+
+def _store(key, tags, generation: int, response):
+    headers = {name: value for name, value in response.headers.items() if name not in ("content-length", "content-type")}
+    response_cache.put(key, response.body, response.media_type, tags, generation, headers)
+    return response
+
+
+def cached_response(key, tags, build):
+    response = _cached(key)
+    if response is None:
+        generation = response_cache.generation
+        response = _store(key, tags, generation, build())
+    return response
+
+
+async def cached_response_async(key, tags, build, offload: bool = False):
+    # cached_response for async endpoints: a hit never leaves the event loop,
+    # with `offload` a miss is built on a worker thread
+    response = _cached(key)
+    if response is None:
+        generation = response_cache.generation
+        response = _store(key, tags, generation, await run_offloaded(offload, build))
+    return response
@@ -0,0 +1,83 @@
+import asyncio
+import os
+import threading
+from typing import Optional
+
+CHANGE_LOG_RETENTION = int(os.environ.get("CHANGE_LOG_RETENTION", "10000"))
+
+UPSERT = "upsert"
+DELETE = "delete"
+
+
+class ChangeLog:
+    """Append-only log of record changes with a monotonically increasing seq.
+
+    Entries live in a ring buffer holding the last `retention` changes, so a
+    reader asking for changes it is too far behind to get back receives None
+    and has to reload the collections instead. Appends come from worker
+    threads; wait() lets coroutines sleep until something is appended.
+    """
+
+    def __init__(self, retention: int = CHANGE_LOG_RETENTION):
+        self.retention = retention
+        self._entries = [None] * retention
+        self._lock = threading.Lock()
+        self._waiters = set()
+        self.last_seq = 0
+        # Oldest seq a reader can still resume after; moved forward by reset()
+        self._floor = 0
+
+    def append(self, kind: str, record_id: int, record=None, encoded: bytes = None) -> int:
+        # record/encoded are the new record and its JSON, None for a deletion
+        with self._lock:
+            seq = self.last_seq + 1
+            entry = {"seq": seq, "kind": kind, "id": record_id, "op": DELETE if record is None else UPSERT, "record": record}
+            body = b'{"seq":%d,"kind":"%s","id":%d,"op":"%s","record":%s}' % (
+                seq, kind.encode(), record_id, entry["op"].encode(), b"null" if encoded is None else encoded
+            )
+            self._entries[seq % self.retention] = (seq, entry, body)
+            self.last_seq = seq
+            waiters = list(self._waiters)
+        for loop, event in waiters:
+            loop.call_soon_threadsafe(event.set)
+        return seq
+
+    def reset(self):
+        # Everything before now is unavailable, e.g. after a full reload that
+        # did not go through append()
+        with self._lock:
+            self._floor = self.last_seq
+
+    def oldest_seq(self) -> int:
+        # Readers can resume after any seq from this one on
+        return max(self._floor, self.last_seq - self.retention)
+
+    def since(self, seq: int, limit: int) -> Optional[list]:
+        # (seq, entry, JSON) for the changes after `seq`, oldest first, or None
+        # if some of them are no longer retained
+        with self._lock:
+            if seq < self.oldest_seq() or seq > self.last_seq:
+                return None
+            last = min(self.last_seq, seq + limit)
+            return [self._entries[s % self.retention] for s in range(seq + 1, last + 1)]
+
+    async def wait(self, seq: int, timeout: float) -> bool:
+        # Returns once there are changes after `seq`, False if it timed out
+        loop = asyncio.get_running_loop()
+        waiter = (loop, asyncio.Event())
+        with self._lock:
+            if self.last_seq > seq:
+                return True
+            self._waiters.add(waiter)
+        try:
+            await asyncio.wait_for(waiter[1].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            with self._lock:
+                self._waiters.discard(waiter)
+
+
+# Changes applied to this process's working set, fed by app/data.py
+change_log = ChangeLog()
@@ -0,0 +1,231 @@
+import threading
+from array import array
+from collections.abc import MutableMapping
+from itertools import repeat
+from typing import Optional
+
+from app.models import Inventory
+
+_NOT_IMPORTED = object()
+# Imported by the first aggregate rather than at startup; None when it is not
+# installed, and aggregates fall back to a single pass in Python
+numpy = _NOT_IMPORTED
+
+GROUP_COLUMNS = ("shelf_id", "shelf_location")
+
+
+def _numpy():
+    global numpy
+    if numpy is _NOT_IMPORTED:
+        try:
+            import numpy as module
+        except ImportError:
+            module = None
+        numpy = module
+    return numpy
+
+
+def vectorized() -> bool:
+    # Whether aggregates run in numpy, which is then already imported
+    return numpy is not None and numpy is not _NOT_IMPORTED
+
+
+def _column_snapshot(column: array):
+    return numpy.frombuffer(column.tobytes(), dtype=f"i{column.itemsize}").astype(numpy.intp)
+
+
+class Interner:
+    """Maps each distinct string to a small integer code and back.
+
+    Codes are never reused, so the table only grows; shelf ids and locations
+    have few distinct values compared to the rows that reference them.
+    """
+
+    def __init__(self):
+        self.values = []
+        self._codes = {}
+
+    def code(self, value: str) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+    def clear(self):
+        self.values.clear()
+        self._codes.clear()
+
+
+class InventoryColumns(MutableMapping):
+    """Inventory stored as parallel typed arrays, one row per medication id.
+
+    Behaves like the dict of Inventory objects it replaces: reads build a
+    fresh Inventory from the row, so changes to it only take effect when it is
+    stored again. A row costs 24 bytes of column data instead of a pydantic
+    object, and aggregates run over whole columns at once. Deleting a row
+    moves the last row into its place, so rows are only read and changed
+    under a lock; it is held for a few array operations at most.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._rows = {}
+        self._keys = array("q")
+        self.medication_id = array("q")
+        self.quantity = array("q")
+        self.shelf_id = array("i")
+        self.shelf_location = array("i")
+        self.shelf_ids = Interner()
+        self.shelf_locations = Interner()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __iter__(self):
+        return iter(list(self._rows))
+
+    def __contains__(self, med_id) -> bool:
+        return med_id in self._rows
+
+    def __getitem__(self, med_id: int) -> Inventory:
+        with self._lock:
+            return self._read(self._rows[med_id])
+
+    def get(self, med_id: int, default=None):
+        with self._lock:
+            row = self._rows.get(med_id)
+            return default if row is None else self._read(row)
+
+    def _read(self, row: int) -> Inventory:
+        return Inventory.construct(
+            medication_id=self.medication_id[row],
+            quantity=self.quantity[row],
+            shelf_id=self.shelf_ids.values[self.shelf_id[row]],
+            shelf_location=self.shelf_locations.values[self.shelf_location[row]]
+        )
+
+    def __setitem__(self, med_id: int, inv: Inventory):
+        # Converted before any column changes, so a value that does not fit
+        # in 64 bits raises OverflowError and leaves the rows as they were
+        key, medication_id, quantity = array("q", (med_id, inv.medication_id, inv.quantity))
+        with self._lock:
+            shelf_id = self.shelf_ids.code(inv.shelf_id)
+            shelf_location = self.shelf_locations.code(inv.shelf_location)
+            row = self._rows.get(med_id)
+            if row is None:
+                self._keys.append(key)
+                self.medication_id.append(medication_id)
+                self.quantity.append(quantity)
+                self.shelf_id.append(shelf_id)
+                self.shelf_location.append(shelf_location)
+                self._rows[med_id] = len(self._keys) - 1
+            else:
+                self.medication_id[row] = medication_id
+                self.quantity[row] = quantity
+                self.shelf_id[row] = shelf_id
+                self.shelf_location[row] = shelf_location
+
+    def __delitem__(self, med_id: int):
+        with self._lock:
+            row = self._rows.pop(med_id)
+            last = len(self._keys) - 1
+            columns = (self._keys, self.medication_id, self.quantity, self.shelf_id, self.shelf_location)
+            if row != last:
+                moved = self._keys[last]
+                for column in columns:
+                    column[row] = column[last]
+                self._rows[moved] = row
+            for column in columns:
+                del column[last]
+
+    def clear(self):
+        with self._lock:
+            self._clear()
+
+    def _clear(self):
+        self._rows.clear()
+        for column in (self._keys, self.medication_id, self.quantity, self.shelf_id, self.shelf_location):
+            del column[:]
+        self.shelf_ids.clear()
+        self.shelf_locations.clear()
+
+    def load(self, keys, medication_id, quantity, shelf_id, shelf_location, shelf_ids: list, shelf_locations: list):
+        # Replaces every row with whole columns at once, such as a snapshot's;
+        # the shelf columns hold codes into shelf_ids and shelf_locations
+        with self._lock:
+            self._clear()
+            for column, values in ((self._keys, keys), (self.medication_id, medication_id), (self.quantity, quantity),
+                                   (self.shelf_id, shelf_id), (self.shelf_location, shelf_location)):
+                column.frombytes(memoryview(values).cast("B"))
+            self._rows.update(zip(self._keys.tolist(), range(len(self._keys))))
+            for value in shelf_ids:
+                self.shelf_ids.code(value)
+            for value in shelf_locations:
+                self.shelf_locations.code(value)
+
+    def stats(self, low_stock_threshold: int, group_by: Optional[str] = None) -> dict:
+        # Item and unit totals plus empty / low-stock counts (with the same
+        # bounds as app.stock), overall and per shelf_id or shelf_location.
+        if group_by is not None and group_by not in GROUP_COLUMNS:
+            raise ValueError(f"Cannot group by {group_by!r}")
+        if _numpy() is not None:
+            totals, groups = self._stats_numpy(low_stock_threshold, group_by)
+        else:
+            totals, groups = self._stats_python(low_stock_threshold, group_by)
+        result = dict(zip(("items", "quantity", "empty", "low_stock"), totals))
+        if group_by is not None:
+            names = (self.shelf_ids if group_by == "shelf_id" else self.shelf_locations).values
+            result["groups"] = sorted(
+                ({group_by: names[code], "items": items, "quantity": quantity, "empty": empty, "low_stock": low}
+                 for code, (items, quantity, empty, low) in groups.items() if items),
+                key=lambda group: group[group_by]
+            )
+        return result
+
+    def _stats_numpy(self, low_stock_threshold: int, group_by: Optional[str]):
+        # Snapshots taken with tobytes(), which copies without exporting the
+        # array's buffer; a writer appending while numpy read the buffer
+        # itself would fail with BufferError
+        with self._lock:
+            quantity = numpy.frombuffer(self.quantity.tobytes(), dtype=numpy.int64)
+            codes = _column_snapshot(getattr(self, group_by)) if group_by is not None else None
+        if len(quantity) and len(quantity) * max(-int(quantity.min()), int(quantity.max())) >= 2**63:
+            # Sums in int64 could wrap around; Python's ints cannot
+            return self._stats_python(low_stock_threshold, group_by)
+        empty = quantity <= 0
+        low = ~empty & (quantity <= low_stock_threshold)
+        totals = (len(quantity), int(quantity.sum()), int(empty.sum()), int(low.sum()))
+        groups = {}
+        if codes is not None:
+            size = len((self.shelf_ids if group_by == "shelf_id" else self.shelf_locations).values)
+            # Summed in int64 rather than with bincount's float64 weights,
+            # which are inexact above 2**53
+            sums = numpy.zeros(size, dtype=numpy.int64)
+            numpy.add.at(sums, codes, quantity)
+            columns = (
+                numpy.bincount(codes, minlength=size),
+                sums,
+                numpy.bincount(codes[empty], minlength=size),
+                numpy.bincount(codes[low], minlength=size),
+            )
+            groups = {code: tuple(int(column[code]) for column in columns) for code in numpy.flatnonzero(columns[0]).tolist()}
+        return totals, groups
+
+    def _stats_python(self, low_stock_threshold: int, group_by: Optional[str]):
+        with self._lock:
+            quantities = self.quantity[:]
+            codes = getattr(self, group_by)[:] if group_by is not None else repeat(0)
+        groups = {}
+        for code, quantity in zip(codes, quantities):
+            group = groups.get(code)
+            if group is None:
+                group = groups[code] = [0, 0, 0, 0]
+            group[0] += 1
+            group[1] += quantity
+            if quantity <= 0:
+                group[2] += 1
+            elif quantity <= low_stock_threshold:
+                group[3] += 1
+        totals = tuple(sum(group[i] for group in groups.values()) for i in range(4))
+        return totals, groups if group_by is not None else {}
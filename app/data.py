@@ -1,10 +1,477 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+
 from app.models import Medication, Inventory
+from app.search import NameIndex
+from app.stock import StockIndex
+from app.columns import InventoryColumns
+from app.shelves import ShelfIndex
+from app.pagination import SortedIds
+from app.repository import ANY, MEDICATION, INVENTORY, ConcurrentUpdate, open_repository
+from app.snapshots import RecordTable
+from app.bus import INVALIDATION_BUS, open_bus
+from app.utils import json_etag, etag_digest
+from app.encoders import encode_json, decode_json
+from app.cache import response_cache
+from app.changes import change_log
+from app.tracing import run_in_threadpool
+from app.metrics import RECORD_LOCK_CONTENTION, RECORD_LOCK_WAIT_SECONDS, WRITE_RETRIES, WRITE_CONFLICTS
+
+# "memory://" keeps everything in this process; "sqlite:///medications.db"
+# persists to SQLite and lets several workers share the same data;
+# "wal:///data" keeps everything in memory, logged and snapshotted to a
+# directory, and restarts from a memory-mapped snapshot.
+STORAGE_URL = os.environ.get("STORAGE_URL", "memory://")
+
+# Records indexed per lock acquisition when building indexes after a snapshot load
+INDEX_BUILD_CHUNK = 1000
+
+# Async endpoints build a response on a worker thread rather than on the event
+# loop when it encodes more records than this; regex searches always are
+INLINE_BUILD_LIMIT = int(os.environ.get("INLINE_BUILD_LIMIT", "1000"))
+
+# In-memory storage for medications; after a snapshot load they are read out
+# of the snapshot on first access (see app/snapshots.py), and so are the
+# record tables below
+medications = RecordTable(cache=True)
+
+# In-memory storage for inventory, as typed columns rather than one object per
+# item (see app/columns.py); reads and writes look like a dict of Inventory
+inventory = InventoryColumns()
+
+# Store of record; the dicts above and the indexes below are this process's
+# working set and are only ever changed through the helpers in this module.
+repository = open_repository(STORAGE_URL, medications, inventory)
+
+# Ids of each collection in ascending order, for cursor paging and streaming
+medication_ids = SortedIds()
+inventory_ids = SortedIds()
+
+# Trigram index over medication names, kept in sync by the helpers below
+medication_names = NameIndex()
+
+# Empty / low / in-stock buckets over inventory quantities
+stock_levels = StockIndex()
+
+# Medication ids per shelf
+shelf_items = ShelfIndex()
+
+# After a snapshot load the indexes above are built in a background thread;
+# readers of an index wait for its event, and writes made meanwhile are
+# recorded in _index_touched so the build does not overwrite them
+_index_lock = threading.Lock()
+_index_ready = {"names": threading.Event(), "inventory": threading.Event()}
+_index_touched = None
+
+# ETags per record, recomputed only when the record is saved
+medication_etags = RecordTable()
+inventory_etags = RecordTable()
+
+# Each record encoded as JSON, so responses join fragments instead of
+# re-encoding records on every request
+medication_json = RecordTable()
+inventory_json = RecordTable()
+
+# XOR of the record ETags in each collection, used for list ETags
+collection_digests = {"medications": 0, "inventory": 0}
+
+# Icon file of each medication and the medication ids referencing each icon
+# file, so a file shared by identical uploads is only deleted with its last user
+medication_icons = {}
+icon_refs = {}
+
+# Writes to a medication and its inventory item hold the lock of the id's
+# stripe while they check their preconditions and save
+LOCK_STRIPES = int(os.environ.get("LOCK_STRIPES", "256"))
+MAX_WRITE_RETRIES = 3
+_record_locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+
+# Last repository change this process has applied, and when it last looked
+_synced_seq = 0
+_synced_at = 0.0
+_sync_lock = threading.Lock()
+
+# Nodes sharing a store announce their writes on the bus (see app/bus.py), so
+# the others only sync when something was written, when a client asks for a
+# seq it saw (X-Store-Seq) and every STORE_POLL_SECONDS in case a message got
+# lost. Without a bus every request syncs.
+bus = open_bus(INVALIDATION_BUS)
+if bus is not None and not repository.shared:
+    raise ValueError("INVALIDATION_BUS needs a shared STORAGE_URL")
+STORE_POLL_SECONDS = float(os.environ.get("STORE_POLL_SECONDS", "1.0"))
+
+# Set to a list for each request by StoreSeqMiddleware; writes to a shared
+# store add the store's seq after them
+written_seqs = ContextVar("written_seqs", default=None)
+
+
+def _replace_etag(etags: dict, collection: str, key: int, etag):
+    previous = etags.pop(key, None)
+    if previous is not None:
+        collection_digests[collection] ^= etag_digest(previous)
+    if etag is not None:
+        etags[key] = etag
+        collection_digests[collection] ^= etag_digest(etag)
+
+
+def _replace_icon_ref(med_id: int, icon_file):
+    previous = medication_icons.pop(med_id, None)
+    if previous is not None:
+        refs = icon_refs[previous]
+        refs.discard(med_id)
+        if not refs:
+            del icon_refs[previous]
+    if icon_file is not None:
+        medication_icons[med_id] = icon_file
+        icon_refs.setdefault(icon_file, set()).add(med_id)
+
+
+def _touch(kind: str, med_id: int):
+    # Called with _index_lock held
+    if _index_touched is not None:
+        _index_touched[kind].add(med_id)
+
+
+# The _apply_* helpers encode before they change anything, so a record the
+# encoder rejects leaves the working set as it was. Listings read ids from the
+# sorted indexes without locks, so an id is added there only once its record,
+# fragment and ETag are stored, and removed before they go.
+
+def _apply_medication(med_id: int, medication: Medication, record_change: bool = True, encoded: bytes = None):
+    if encoded is None:
+        encoded = encode_json(medication)
+    etag = json_etag(encoded)
+    _replace_icon_ref(med_id, medication._icon_file)
+    medications[med_id] = medication
+    medication_json[med_id] = encoded
+    _replace_etag(medication_etags, "medications", med_id, etag)
+    with _index_lock:
+        _touch(MEDICATION, med_id)
+        medication_names.add(med_id, medication.name)
+    medication_ids.add(med_id)
+    response_cache.invalidate("medications", ("medication", med_id))
+    if record_change:
+        change_log.append(MEDICATION, med_id, medication, encoded)
+
+
+def _drop_medication(med_id: int, record_change: bool = True):
+    medication_ids.remove(med_id)
+    _replace_icon_ref(med_id, None)
+    with _index_lock:
+        _touch(MEDICATION, med_id)
+        medication_names.remove(med_id)
+    medications.pop(med_id, None)
+    medication_json.pop(med_id, None)
+    _replace_etag(medication_etags, "medications", med_id, None)
+    response_cache.invalidate("medications", ("medication", med_id))
+    if record_change:
+        change_log.append(MEDICATION, med_id)
+
+
+def _apply_inventory(med_id: int, inv: Inventory, etag: str = None, record_change: bool = True, encoded: bytes = None):
+    if encoded is None:
+        encoded = encode_json(inv)
+    etag = etag or json_etag(encoded)
+    inventory[med_id] = inv
+    inventory_json[med_id] = encoded
+    _replace_etag(inventory_etags, "inventory", med_id, etag)
+    with _index_lock:
+        _touch(INVENTORY, med_id)
+        stock_levels.set(med_id, inv.quantity)
+        shelf_items.set(med_id, inv.shelf_id)
+    inventory_ids.add(med_id)
+    response_cache.invalidate("inventory", ("inventory", med_id))
+    if record_change:
+        change_log.append(INVENTORY, med_id, inv, encoded)
+
+
+def _drop_inventory(med_id: int, record_change: bool = True):
+    inventory_ids.remove(med_id)
+    with _index_lock:
+        _touch(INVENTORY, med_id)
+        stock_levels.remove(med_id)
+        shelf_items.remove(med_id)
+    inventory.pop(med_id, None)
+    inventory_json.pop(med_id, None)
+    _replace_etag(inventory_etags, "inventory", med_id, None)
+    response_cache.invalidate("inventory", ("inventory", med_id))
+    if record_change:
+        change_log.append(INVENTORY, med_id)
+
+
+class LocksBusy(Exception):
+    """A record lock was held by another write and the caller would not wait."""
+
+
+@contextmanager
+def record_locks(med_ids, wait: bool = True):
+    # Stripes are always taken in ascending order, so writes that lock
+    # several ids (batches) cannot deadlock with each other
+    held = []
+    try:
+        for stripe in sorted({med_id % LOCK_STRIPES for med_id in med_ids}):
+            lock = _record_locks[stripe]
+            if not lock.acquire(blocking=False):
+                if not wait:
+                    raise LocksBusy()
+                RECORD_LOCK_CONTENTION.inc()
+                start = time.perf_counter()
+                lock.acquire()
+                RECORD_LOCK_WAIT_SECONDS.observe(time.perf_counter() - start)
+            held.append(lock)
+        yield
+    finally:
+        for lock in reversed(held):
+            lock.release()
+
+
+def locked_write(med_ids, write, wait: bool = True):
+    # Runs write(), which checks its preconditions against the working set and
+    # then saves, under the locks of med_ids. That serializes writers in this
+    # process; saves passing `expected` also compare-and-swap in the store, and
+    # if another process changed the record first the working set is synced and
+    # write() runs again against the fresh state. With wait=False it raises
+    # LocksBusy instead of waiting for a lock.
+    for attempt in range(MAX_WRITE_RETRIES + 1):
+        with record_locks(med_ids, wait):
+            try:
+                result = write()
+                break
+            except ConcurrentUpdate:
+                if attempt == MAX_WRITE_RETRIES:
+                    WRITE_CONFLICTS.inc()
+                    raise
+        WRITE_RETRIES.inc()
+        sync_from_repository()
+    if repository.shared:
+        _announce_write()
+    return result
+
+
+async def run_locked_write(med_ids, write, offload: bool = False):
+    # For async endpoints: runs locked_write on the event loop when the store
+    # does not block and every lock is free, and on a worker thread when it
+    # would have to wait, so the loop never blocks on a lock another write
+    # holds on a worker thread
+    if not (offload or repository.blocking):
+        try:
+            return locked_write(med_ids, write, wait=False)
+        except LocksBusy:
+            pass
+    return await run_in_threadpool(locked_write, med_ids, write)
+
+
+def _announce_write():
+    # Any seq at or after the write will do, for the client and the bus alike
+    seq = repository.latest_seq()
+    seqs = written_seqs.get()
+    if seqs is not None:
+        seqs.append(seq)
+    if bus is not None:
+        bus.publish(seq)
+
+
+def save_medication(med_id: int, medication: Medication, expected=ANY):
+    # Encoded first: the memory repository saves into the working set itself
+    encoded = encode_json(medication)
+    repository.save_medication(med_id, medication, expected)
+    _apply_medication(med_id, medication, encoded=encoded)
+
+
+def remove_medication(med_id: int):
+    medication = medications.get(med_id)
+    if medication is not None:
+        repository.remove_medication(med_id)
+        _drop_medication(med_id)
+    return medication
+
+
+def save_inventory(med_id: int, inv: Inventory, etag: str = None, expected=ANY):
+    encoded = encode_json(inv)
+    repository.save_inventory(med_id, inv, expected)
+    _apply_inventory(med_id, inv, etag, encoded=encoded)
+
+
+def save_inventory_many(items, expected: dict = None):
+    # items are (med_id, inventory, etag) tuples; one repository write for all
+    items = [(med_id, inv, etag, encode_json(inv)) for med_id, inv, etag in items]
+    repository.save_inventory_many([(med_id, inv) for med_id, inv, _, _ in items], expected)
+    for med_id, inv, etag, encoded in items:
+        _apply_inventory(med_id, inv, etag, encoded=encoded)
+
+
+def remove_inventory(med_id: int):
+    inv = inventory.get(med_id)
+    if inv is not None:
+        repository.remove_inventory(med_id)
+        _drop_inventory(med_id)
+    return inv
+
+
+def wait_for_index(name: str):
+    # "names" or "inventory"; only blocks while a snapshot load builds them
+    _index_ready[name].wait()
+
+
+def offload_build(encoded: int = 0) -> bool:
+    # Whether an async endpoint builds its response on a worker thread: while
+    # a snapshot load still builds the indexes the build may wait for, or when
+    # it is too large for the event loop (see INLINE_BUILD_LIMIT)
+    if not all(ready.is_set() for ready in _index_ready.values()):
+        return True
+    return encoded > INLINE_BUILD_LIMIT
+
+
+def _clear():
+    medications.clear()
+    inventory.clear()
+    for index in (medication_ids, inventory_ids, medication_names, stock_levels, shelf_items, medication_json, inventory_json, medication_etags, inventory_etags, medication_icons, icon_refs):
+        index.clear()
+    collection_digests.update(medications=0, inventory=0)
+    response_cache.clear()
+
+
+def load_from_repository():
+    global _synced_seq, _synced_at
+    _synced_seq = repository.latest_seq()
+    _synced_at = time.monotonic()
+    loaded = repository.load_snapshot()
+    if loaded is not None:
+        _load_snapshot(*loaded)
+        return
+    all_medications = list(repository.medications())
+    all_inventory = list(repository.inventory())
+
+    _clear()
+    # A reload is not a list of changes: readers of the change log that are
+    # behind it have to reload as well
+    for medication in all_medications:
+        _apply_medication(medication.id, medication, record_change=False)
+    for inv in all_inventory:
+        _apply_inventory(inv.medication_id, inv, record_change=False)
+    change_log.reset()
+    for ready in _index_ready.values():
+        ready.set()
+
+
+def _load_snapshot(snapshot, tail: list):
+    # Maps the snapshot's columns instead of loading record by record, so the
+    # cost hardly depends on its size; the name, stock and shelf indexes are
+    # built in the background and the changes logged after the snapshot are
+    # applied as writes
+    global _index_touched
+    _clear()
+    if snapshot is not None:
+        medications.attach(snapshot.medication_ids, snapshot.medication)
+        medication_json.attach(snapshot.medication_ids, snapshot.medication_json)
+        medication_etags.attach(snapshot.medication_ids, snapshot.medication_etag)
+        medication_ids.load(snapshot.medication_ids.tolist())
+        inventory.load(snapshot.inventory_ids, snapshot.inventory_medication_id, snapshot.inventory_quantity,
+                       snapshot.inventory_shelf_id, snapshot.inventory_shelf_location, snapshot.shelf_ids, snapshot.shelf_locations)
+        inventory_json.attach(snapshot.inventory_ids, snapshot.inventory_json)
+        inventory_etags.attach(snapshot.inventory_ids, snapshot.inventory_etag)
+        inventory_ids.load(snapshot.inventory_ids.tolist())
+        for med_id, icon_file in snapshot.icons.items():
+            _replace_icon_ref(med_id, icon_file)
+        collection_digests.update(snapshot.digests)
+        with _index_lock:
+            _index_touched = {MEDICATION: set(), INVENTORY: set()}
+        for ready in _index_ready.values():
+            ready.clear()
+
+    for kind, med_id, record in tail:
+        if kind == MEDICATION and record is not None:
+            _apply_medication(med_id, record, record_change=False)
+        elif kind == MEDICATION:
+            _drop_medication(med_id, record_change=False)
+        elif record is not None:
+            _apply_inventory(med_id, record, record_change=False)
+        else:
+            _drop_inventory(med_id, record_change=False)
+    change_log.reset()
+
+    if snapshot is not None:
+        threading.Thread(target=_build_indexes, args=(snapshot,), name="index-build", daemon=True).start()
+    else:
+        for ready in _index_ready.values():
+            ready.set()
+
+
+def _build_indexes(snapshot):
+    # A chunk at a time, so writers waiting for _index_lock are not held up
+    global _index_touched
+    ids, quantities, shelf_codes = snapshot.inventory_ids, snapshot.inventory_quantity, snapshot.inventory_shelf_id
+    for start in range(0, len(ids), INDEX_BUILD_CHUNK):
+        with _index_lock:
+            touched = _index_touched[INVENTORY]
+            for i in range(start, min(start + INDEX_BUILD_CHUNK, len(ids))):
+                med_id = ids[i]
+                if med_id not in touched:
+                    stock_levels.set(med_id, quantities[i])
+                    shelf_items.set(med_id, snapshot.shelf_ids[shelf_codes[i]])
+    _index_ready["inventory"].set()
+
+    ids = snapshot.medication_ids
+    for start in range(0, len(ids), INDEX_BUILD_CHUNK):
+        with _index_lock:
+            touched = _index_touched[MEDICATION]
+            for i in range(start, min(start + INDEX_BUILD_CHUNK, len(ids))):
+                med_id = ids[i]
+                if med_id not in touched:
+                    medication_names.add(med_id, decode_json(snapshot.medication_json(i))["name"])
+    with _index_lock:
+        _index_touched = None
+    _index_ready["names"].set()
+
+
+def sync_needed(min_seq: int = 0) -> bool:
+    # Whether to sync from a shared store before a request; min_seq is the
+    # X-Store-Seq the client sent, if any
+    if bus is None:
+        return True
+    return max(bus.latest, min_seq) > _synced_seq or time.monotonic() - _synced_at > STORE_POLL_SECONDS
+
+
+def _applied(kind: str, record_id: int, record) -> bool:
+    # Whether the working set already holds a change read back from the store,
+    # as it does for this process's own writes
+    if kind == MEDICATION:
+        current = medications.get(record_id)
+        if record is None or current is None:
+            return record is None and current is None
+        return current == record and current._icon_file == record._icon_file
+    if record is None:
+        return record_id not in inventory
+    return inventory.get(record_id) == record
+
 
-# In-memory storage for medications
-medications = {}
+def sync_from_repository():
+    # Applies writes made by other processes sharing the repository; changes
+    # the working set already holds are skipped, so this process's own writes
+    # are not recorded in the change log or invalidated a second time
+    global _synced_seq, _synced_at
+    with _sync_lock:
+        _synced_at = time.monotonic()
+        seq, changes = repository.changes_since(_synced_seq)
+        if changes is None:
+            load_from_repository()
+            return
+        for kind, record_id, record in changes:
+            if _applied(kind, record_id, record):
+                continue
+            if kind == MEDICATION and record is not None:
+                _apply_medication(record_id, record)
+            elif kind == MEDICATION:
+                _drop_medication(record_id)
+            elif record is not None:
+                _apply_inventory(record_id, record)
+            else:
+                _drop_inventory(record_id)
+        _synced_seq = seq
 
-# In-memory storage for inventory
-inventory = {}
 
 # Demo data initialization
 def initialize_demo_data():
@@ -21,10 +488,12 @@ def initialize_demo_data():
     ]
 
     for med in demo_medications:
-        medications[med.id] = med
+        save_medication(med.id, med)
 
     for inv in demo_inventory:
-        inventory[inv.medication_id] = inv
+        save_inventory(inv.medication_id, inv)
 
 
-initialize_demo_data()
\ No newline at end of file
+load_from_repository()
+if not medications:
+    initialize_demo_data()
@@ -0,0 +1,135 @@
+import json
+from typing import Iterable, Optional, Type
+
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # the stdlib encoder below produces the same bytes, slower
+    orjson = None
+
+XML_DECLARATION = '<?xml version="1.0" encoding="utf-8"?>\n'
+
+
+def _json_default(obj):
+    # Records are encoded from their field values directly, without .dict()
+    if isinstance(obj, BaseModel):
+        return obj.__dict__
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+if orjson is not None:
+    def encode_json(data) -> bytes:
+        return orjson.dumps(data, default=_json_default)
+
+    decode_json = orjson.loads
+else:
+    # Same settings as Starlette's JSONResponse
+    _json_encoder = json.JSONEncoder(ensure_ascii=False, allow_nan=False, separators=(",", ":"), default=_json_default)
+
+    def encode_json(data) -> bytes:
+        return _json_encoder.encode(data).encode("utf-8")
+
+    decode_json = json.loads
+
+
+def join_json(fragments: Iterable[bytes]) -> bytes:
+    # A JSON array from records that are already encoded
+    return b"[" + b",".join(fragments) + b"]"
+
+
+def escape_xml(text: str) -> str:
+    if "&" in text:
+        text = text.replace("&", "&amp;")
+    if "<" in text:
+        text = text.replace("<", "&lt;")
+    if ">" in text:
+        text = text.replace(">", "&gt;")
+    return text
+
+
+def _xml_text(value) -> str:
+    if value is None:
+        return ""
+    if value is True or value is False:
+        return "true" if value else "false"
+    return escape_xml(str(value))
+
+
+class XMLRecordEncoder:
+    """Writes the fields of one model straight into a precompiled template.
+
+    The element names and their order come from the model once, so encoding a
+    record is a single %-format over its converted values. The output matches
+    xmltodict.unparse(pretty=False) for the same dict.
+    """
+
+    def __init__(self, model: Type[BaseModel]):
+        self.fields = list(model.__fields__)
+        self.template = "".join(f"<{name}>%s</{name}>" for name in self.fields)
+        self.converters = []
+        for field in model.__fields__.values():
+            if field.outer_type_ is int and field.required:
+                self.converters.append(str)
+            elif field.outer_type_ is str and field.required:
+                self.converters.append(escape_xml)
+            else:
+                self.converters.append(_xml_text)
+
+    def encode(self, record) -> str:
+        if isinstance(record, BaseModel):
+            record = record.__dict__
+        return self.template % tuple(convert(record[name]) for name, convert in zip(self.fields, self.converters))
+
+
+_record_encoders = {}
+
+
+def record_encoder(model: Type[BaseModel]) -> XMLRecordEncoder:
+    encoder = _record_encoders.get(model)
+    if encoder is None:
+        encoder = _record_encoders[model] = XMLRecordEncoder(model)
+    return encoder
+
+
+def _write_xml(out: list, tag: str, value, depth: int, indent: Optional[str]):
+    # Generic fallback with xmltodict's conventions: lists repeat the element,
+    # None is an empty element and booleans are lower case.
+    if isinstance(value, BaseModel):
+        value = value.__dict__
+    if isinstance(value, (list, tuple)):
+        for item in value:
+            _write_xml(out, tag, item, depth, indent)
+        return
+    prefix = "\n" + indent * depth if indent is not None else ""
+    if isinstance(value, dict):
+        out.append(f"{prefix}<{tag}>")
+        for key, item in value.items():
+            _write_xml(out, key, item, depth + 1, indent)
+        out.append(f"{prefix}</{tag}>")
+    else:
+        out.append(f"{prefix}<{tag}>{_xml_text(value)}</{tag}>")
+
+
+def encode_xml_item(record, model: Optional[Type[BaseModel]] = None) -> str:
+    # One compact <item> element, for incrementally written list responses
+    if model is not None:
+        return f"<item>{record_encoder(model).encode(record)}</item>"
+    out = []
+    _write_xml(out, "item", record, 0, None)
+    return "".join(out)
+
+
+def encode_xml(data, model: Optional[Type[BaseModel]] = None, pretty: bool = False) -> str:
+    if model is not None and not pretty:
+        encoder = record_encoder(model)
+        if isinstance(data, list):
+            body = "".join(f"<item>{encoder.encode(record)}</item>" for record in data)
+        else:
+            body = encoder.encode(data)
+        return f"{XML_DECLARATION}<response>{body}</response>"
+    if isinstance(data, list):
+        data = {"item": data}  # XML needs a single root element
+    out = [XML_DECLARATION.rstrip("\n") if pretty else XML_DECLARATION]
+    _write_xml(out, "response", data, 0, "\t" if pretty else None)
+    return "".join(out)
@@ -0,0 +1,143 @@
+import hashlib
+import os
+import re
+import tempfile
+from email.utils import formatdate
+
+from fastapi import HTTPException
+from fastapi.responses import FileResponse, StreamingResponse, Response as FastAPIResponse
+
+from app.cache import ResponseCache
+from app.thumbnails import delete_derivatives
+from app.tracing import run_in_threadpool, span
+from app.utils import IMAGE_DIR
+
+ICON_MEDIA_TYPES = {"jpg": "image/jpeg", "jpeg": "image/jpeg", "png": "image/png", "tiff": "image/tiff"}
+DERIVATIVE_MEDIA_TYPES = {"webp": "image/webp"}
+MAX_ICON_BYTES = int(os.environ.get("MAX_ICON_BYTES", str(5 * 1024 * 1024)))
+ICON_CACHE_MAX_BYTES = int(os.environ.get("ICON_CACHE_MAX_BYTES", str(32 * 1024 * 1024)))
+# Icons larger than this are always streamed from disk instead of cached
+ICON_CACHE_MAX_ENTRY = 256 * 1024
+CHUNK_SIZE = 64 * 1024
+
+# Icons are stored under the SHA-256 of their content, so identical uploads
+# share one file and a stored file never changes. Derivatives add their size:
+# "<sha256>.64.webp".
+ICON_FILE_PATTERN = re.compile(r"^[0-9a-f]{64}(\.\d+\.webp|\.(jpg|jpeg|png|tiff))$")
+RANGE_PATTERN = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+# Hot icons and derivatives, keyed by ("icon", file name) and tagged with the
+# content hash; content addressing means entries never go stale, they are only
+# dropped when the files themselves are deleted.
+icon_cache = ResponseCache(max_bytes=ICON_CACHE_MAX_BYTES)
+
+
+def icon_path(icon_file: str) -> str:
+    if not ICON_FILE_PATTERN.match(icon_file):
+        raise ValueError(f"Invalid icon file name: {icon_file!r}")
+    return os.path.join(IMAGE_DIR, icon_file)
+
+
+def icon_etag(icon_file: str) -> str:
+    return f'"{icon_file.rsplit(".", 1)[0]}"'
+
+
+def _store_icon(source, extension: str) -> str:
+    # Runs in a worker thread: copies the upload in chunks to a temporary file
+    # while hashing it, then moves it to its content address.
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    digest = hashlib.sha256()
+    size = 0
+    fd, temp_path = tempfile.mkstemp(dir=IMAGE_DIR, suffix=".upload")
+    try:
+        with os.fdopen(fd, "wb") as target:
+            while chunk := source.read(CHUNK_SIZE):
+                size += len(chunk)
+                if size > MAX_ICON_BYTES:
+                    raise HTTPException(status_code=413, detail=f"Icons are limited to {MAX_ICON_BYTES} bytes")
+                digest.update(chunk)
+                target.write(chunk)
+        icon_file = f"{digest.hexdigest()}.{extension}"
+        os.replace(temp_path, icon_path(icon_file))
+        return icon_file
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+async def store_icon(upload, extension: str) -> str:
+    await upload.seek(0)
+    with span("icon_io"):
+        return await run_in_threadpool(_store_icon, upload.file, extension)
+
+
+def delete_icon_file(icon_file: str, derivatives: bool = True):
+    # derivatives=False keeps the thumbnails, which are named after the content
+    # hash alone and may still serve the same image under another extension
+    icon_cache.invalidate(icon_file.split(".")[0])
+    with span("icon_io"):
+        if derivatives:
+            delete_derivatives(icon_file)
+        try:
+            os.remove(icon_path(icon_file))
+        except FileNotFoundError:
+            pass
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+
+def _read_range(path: str, start: int, length: int):
+    with open(path, "rb") as f:
+        f.seek(start)
+        while length > 0:
+            chunk = f.read(min(CHUNK_SIZE, length))
+            if not chunk:
+                return
+            length -= len(chunk)
+            yield chunk
+
+
+async def icon_response(icon_file: str, range_header: str = None):
+    path = icon_path(icon_file)
+    extension = icon_file.rsplit(".", 1)[1]
+    media_type = ICON_MEDIA_TYPES.get(extension) or DERIVATIVE_MEDIA_TYPES[extension]
+    headers = {"ETag": icon_etag(icon_file), "Accept-Ranges": "bytes"}
+
+    cached = icon_cache.get(("icon", icon_file))
+    if cached is not None and range_header is None:
+        return FastAPIResponse(content=cached[0], media_type=media_type, headers=dict(cached[3], **headers))
+
+    try:
+        with span("icon_io"):
+            stat = await run_in_threadpool(os.stat, path)
+    except FileNotFoundError:
+        raise HTTPException(status_code=404, detail="Image not found")
+    headers["Last-Modified"] = formatdate(stat.st_mtime, usegmt=True)
+
+    if range_header is not None:
+        match = RANGE_PATTERN.match(range_header.strip())
+        if match is None or match.groups() == ("", ""):
+            raise HTTPException(status_code=416, detail="Range Not Satisfiable", headers={"Content-Range": f"bytes */{stat.st_size}"})
+        first, last = match.groups()
+        if first:
+            start, end = int(first), min(int(last), stat.st_size - 1) if last else stat.st_size - 1
+        else:
+            start, end = max(stat.st_size - int(last), 0), stat.st_size - 1
+        if start > end:
+            raise HTTPException(status_code=416, detail="Range Not Satisfiable", headers={"Content-Range": f"bytes */{stat.st_size}"})
+        headers["Content-Range"] = f"bytes {start}-{end}/{stat.st_size}"
+        headers["Content-Length"] = str(end - start + 1)
+        return StreamingResponse(_read_range(path, start, end - start + 1), status_code=206, media_type=media_type, headers=headers)
+
+    if stat.st_size <= ICON_CACHE_MAX_ENTRY:
+        with span("icon_io"):
+            body = await run_in_threadpool(_read_file, path)
+        icon_cache.put(("icon", icon_file), body, media_type, [icon_file.split(".")[0]], headers={"Last-Modified": headers["Last-Modified"]})
+        return FastAPIResponse(content=body, media_type=media_type, headers=headers)
+
+    # Large icons go straight from disk (sendfile where the server supports it)
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=stat)
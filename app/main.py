@@ -1,29 +1,82 @@
-from fastapi import FastAPI
-from prometheus_client import start_http_server, generate_latest, CONTENT_TYPE_LATEST
-from fastapi.responses import Response as FastAPIResponse
+import os
+import threading
+import time
+from typing import Optional
+
+from fastapi import Depends, FastAPI, Header, Request
+from prometheus_client import REGISTRY, CollectorRegistry, start_http_server, generate_latest, CONTENT_TYPE_LATEST, multiprocess
+from fastapi.responses import JSONResponse, Response as FastAPIResponse
 
 from app.routes.medications import router as medications_router
 from app.routes.inventory import router as inventory_router
-from app.metrics import INVENTORY_GAUGE, REQUEST_COUNT  # Updated import
+from app.routes.changes import router as changes_router
+from app.routes.admin import router as admin_router, require_admin
+from app.middleware import PrometheusMiddleware, TracingMiddleware, StoreSeqMiddleware, AdmissionMiddleware
+from app.data import repository, bus, sync_needed, sync_from_repository
+from app.tracing import run_in_threadpool
+from app.repository import ConcurrentUpdate
+
+# Scrapes within this many seconds of each other share one rendering of /metrics
+METRICS_CACHE_TTL = float(os.environ.get("METRICS_CACHE_TTL", "1.0"))
 
 app = FastAPI()
 
-# Middleware to track requests
-@app.middleware("http")
-async def prometheus_middleware(request, call_next):
-    response = await call_next(request)
-    REQUEST_COUNT.labels(method=request.method, endpoint=request.url.path).inc()
-    return response
+# Middleware to track requests; trace logs and profiles are taken inside it
+app.add_middleware(TracingMiddleware)
+# Sheds load ahead of tracing and the routes, but inside the request metrics
+app.add_middleware(AdmissionMiddleware, router=app.router)
+app.add_middleware(PrometheusMiddleware)
+if repository.shared:
+    app.add_middleware(StoreSeqMiddleware)
+
+async def sync_with_store(x_store_seq: Optional[int] = Header(None, description="X-Store-Seq of an earlier write; the response reflects at least that write, whichever node serves it")):
+    if sync_needed(x_store_seq or 0):
+        await run_in_threadpool(sync_from_repository)
+
+# Pick up writes from other workers before handling a request when the store is shared
+dependencies = [Depends(sync_with_store)] if repository.shared else []
 
 # Include routers
-app.include_router(medications_router, prefix="/medications", tags=["Medications"])
-app.include_router(inventory_router, prefix="/inventory", tags=["Inventory"])
+app.include_router(medications_router, prefix="/medications", tags=["Medications"], dependencies=dependencies)
+app.include_router(inventory_router, prefix="/inventory", tags=["Inventory"], dependencies=dependencies)
+app.include_router(changes_router, prefix="/changes", tags=["Changes"], dependencies=dependencies)
+app.include_router(admin_router, prefix="/admin", tags=["Admin"], dependencies=[Depends(require_admin)])
+
+@app.on_event("shutdown")
+def close_repository():
+    # Flushes and syncs the write-ahead log of a "wal://" store
+    repository.close()
+    if bus is not None:
+        bus.close()
+
+@app.exception_handler(ConcurrentUpdate)
+async def concurrent_update_handler(request: Request, exc: ConcurrentUpdate):
+    # Another worker kept changing the record while this write was retried
+    return JSONResponse(status_code=409, content={"detail": "Conflict: the record was changed concurrently, please retry"})
+
+_metrics_lock = threading.Lock()
+_metrics_cache = (0.0, b"")
+
+def render_metrics() -> bytes:
+    global _metrics_cache
+    with _metrics_lock:
+        rendered_at, output = _metrics_cache
+        if time.monotonic() - rendered_at >= METRICS_CACHE_TTL:
+            if "PROMETHEUS_MULTIPROC_DIR" in os.environ:
+                # Aggregate the samples every worker wrote to the shared directory
+                registry = CollectorRegistry()
+                multiprocess.MultiProcessCollector(registry)
+            else:
+                registry = REGISTRY
+            output = generate_latest(registry)
+            _metrics_cache = (time.monotonic(), output)
+        return output
 
 @app.get("/metrics", summary="Get metrics", description="Retrieve Prometheus metrics.")
 def get_metrics():
-    return FastAPIResponse(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+    return FastAPIResponse(render_metrics(), media_type=CONTENT_TYPE_LATEST)
 
 if __name__ == "__main__":
     import uvicorn
     start_http_server(8001)  # Start Prometheus metrics server on port 8001
-    uvicorn.run(app, host="0.0.0.0", port=8000)
\ No newline at end of file
+    uvicorn.run(app, host="0.0.0.0", port=8000)
@@ -1,14 +1,149 @@
-from prometheus_client import Gauge, Counter
+from prometheus_client import Gauge, Counter, Histogram
 
 # Define Prometheus metrics
+# When PROMETHEUS_MULTIPROC_DIR is set every worker writes its samples there and
+# /metrics aggregates them; gauges declare how their per-process values combine.
 INVENTORY_GAUGE = Gauge(
     "inventory_quantity",
     "Quantity of medications in inventory",
-    ["medication_id", "shelf_id", "shelf_location"]
+    ["medication_id", "shelf_id", "shelf_location"],
+    multiprocess_mode="mostrecent"
 )
 
+# Labelled with the route template (e.g. /medications/{med_id}), never the raw
+# path, so the number of series is bounded by the number of routes.
 REQUEST_COUNT = Counter(
     "request_count",
     "Total number of requests",
     ["method", "endpoint"]
 )
+
+REQUEST_LATENCY = Histogram(
+    "request_latency_seconds",
+    "Request latency per route",
+    ["method", "endpoint"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+)
+
+# Time spent in the parts of request handling that app/tracing.py instruments:
+# validation, etag, serialize and icon_io
+STAGE_LATENCY = Histogram(
+    "stage_latency_seconds",
+    "Time spent per request handling stage",
+    ["stage"],
+    buckets=(0.00001, 0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.05, 0.1, 0.5)
+)
+
+PROFILED_REQUESTS = Counter(
+    "profiled_requests",
+    "Number of requests run under the sampling profiler",
+    ["trigger"]
+)
+
+RESPONSE_CACHE_HITS = Counter(
+    "response_cache_hits",
+    "Number of responses served from the response cache",
+    ["resource"]
+)
+
+RESPONSE_CACHE_MISSES = Counter(
+    "response_cache_misses",
+    "Number of response cache lookups that had to serialize",
+    ["resource"]
+)
+
+RESPONSE_CACHE_BYTES = Gauge(
+    "response_cache_bytes",
+    "Total size of the encoded bodies held in the response cache",
+    multiprocess_mode="livesum"
+)
+
+THUMBNAIL_QUEUE_DEPTH = Gauge(
+    "thumbnail_queue_depth",
+    "Number of icons waiting for or undergoing derivative generation",
+    multiprocess_mode="livesum"
+)
+
+THUMBNAIL_PROCESSING_SECONDS = Histogram(
+    "thumbnail_processing_seconds",
+    "Time spent generating all derivatives of one icon",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+)
+
+THUMBNAIL_FAILURES = Counter(
+    "thumbnail_failures",
+    "Number of icons whose derivatives could not be generated"
+)
+
+CHANGE_STREAM_SUBSCRIBERS = Gauge(
+    "change_stream_subscribers",
+    "Number of open GET /changes/stream connections",
+    multiprocess_mode="livesum"
+)
+
+RECORD_LOCK_CONTENTION = Counter(
+    "record_lock_contention",
+    "Number of writes that had to wait for another write holding their record's lock"
+)
+
+RECORD_LOCK_WAIT_SECONDS = Histogram(
+    "record_lock_wait_seconds",
+    "Time contended writes spent waiting for their record's lock",
+    buckets=(0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+)
+
+WRITE_RETRIES = Counter(
+    "write_retries",
+    "Number of writes retried because another process changed the record first"
+)
+
+WRITE_CONFLICTS = Counter(
+    "write_conflicts",
+    "Number of writes that still found the record changed after retrying"
+)
+
+INVALIDATIONS_PUBLISHED = Counter(
+    "invalidations_published",
+    "Number of writes this process announced to the other nodes on the invalidation bus"
+)
+
+INVALIDATIONS_RECEIVED = Counter(
+    "invalidations_received",
+    "Number of writes of other nodes announced to this process on the invalidation bus"
+)
+
+# Labelled with the route template like the request metrics; reason is one of
+# client_rate, route_rate, queue_full or queue_timeout
+ADMISSION_SHED = Counter(
+    "admission_shed",
+    "Number of requests turned away by admission control",
+    ["endpoint", "reason"]
+)
+
+ADMISSION_QUEUED = Counter(
+    "admission_queued",
+    "Number of expensive requests that had to wait for a free slot",
+    ["endpoint"]
+)
+
+ADMISSION_QUEUE_DEPTH = Gauge(
+    "admission_queue_depth",
+    "Number of expensive requests waiting for a free slot",
+    ["endpoint"],
+    multiprocess_mode="livesum"
+)
+
+
+def set_inventory_gauge(med_id: int, inv, previous=None):
+    # An item that moved shelves gets a new label set; drop the old series
+    # instead of leaving it behind with the last quantity it had there
+    if previous is not None and (previous.shelf_id, previous.shelf_location) != (inv.shelf_id, inv.shelf_location):
+        remove_inventory_gauge(med_id, previous)
+    INVENTORY_GAUGE.labels(medication_id=med_id, shelf_id=inv.shelf_id, shelf_location=inv.shelf_location).set(inv.quantity)
+
+
+def remove_inventory_gauge(med_id: int, inv):
+    try:
+        INVENTORY_GAUGE.remove(med_id, inv.shelf_id, inv.shelf_location)
+    except KeyError:
+        pass
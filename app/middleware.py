@@ -0,0 +1,266 @@
+import logging
+import random
+import threading
+import time
+from urllib.parse import parse_qsl
+
+from starlette.routing import Match
+
+from app import admission, tracing
+from app.admission import client_buckets, route_buckets, expensive_limits, exempt, is_expensive, retry_after
+from app.encoders import encode_json
+from app.metrics import REQUEST_COUNT, REQUEST_LATENCY, PROFILED_REQUESTS, ADMISSION_SHED
+from app.profiling import SamplingProfiler, store_profile
+from app.tracing import settings, request_spans, current_profiler, run_in_threadpool
+from app.data import written_seqs
+
+UNMATCHED_ROUTE = "<unmatched>"
+KNOWN_METHODS = frozenset(("GET", "HEAD", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"))
+
+trace_logger = logging.getLogger("app.trace")
+
+
+class PrometheusMiddleware:
+    """Pure ASGI middleware counting requests and timing them per route template.
+
+    Unlike @app.middleware("http") it does not wrap the request and response in
+    Starlette objects or run the app in a separate task.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._children = {}
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            # The router stores the matched route in the (shared) scope
+            route = scope.get("route")
+            method = scope["method"] if scope["method"] in KNOWN_METHODS else "OTHER"
+            key = (method, route.path if route is not None else UNMATCHED_ROUTE)
+            children = self._children.get(key)
+            if children is None:
+                children = self._children[key] = (
+                    REQUEST_COUNT.labels(method=key[0], endpoint=key[1]),
+                    REQUEST_LATENCY.labels(method=key[0], endpoint=key[1]),
+                )
+            children[0].inc()
+            children[1].observe(time.perf_counter() - start)
+
+
+class StoreSeqMiddleware:
+    """Adds X-Store-Seq to the responses of requests that wrote to a shared store.
+
+    It is the store's sequence number after the write. A client that sends it
+    back in the X-Store-Seq header of a later request reads its own write on
+    whichever node serves that request: the node syncs up to it first.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        seqs = []
+
+        async def send_seq(message):
+            if message["type"] == "http.response.start" and seqs:
+                message["headers"] = [*message.get("headers", []), (b"x-store-seq", str(max(seqs)).encode())]
+            await send(message)
+
+        token = written_seqs.set(seqs)
+        try:
+            await self.app(scope, receive, send_seq)
+        finally:
+            written_seqs.reset(token)
+
+
+class AdmissionMiddleware:
+    """Pure ASGI middleware turning requests away before they reach the routes.
+
+    Every request takes a token from its client's bucket (429 Too Many
+    Requests when empty) and from its route's (503 Service Unavailable);
+    expensive requests (see app/admission.py) take EXPENSIVE_COST tokens
+    and then wait for one of their listing's slots, and are shed with a 503
+    when the queue for them is full or they waited too long. Every shed
+    response carries Retry-After. /metrics and /admin are never limited.
+    """
+
+    def __init__(self, app, router):
+        self.app = app
+        self.router = router
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or exempt(scope["path"]):
+            await self.app(scope, receive, send)
+            return
+
+        settings = admission.settings
+        expensive = is_expensive(scope)
+        if settings.client_rate or settings.route_rate:
+            cost = settings.expensive_cost if expensive else 1.0
+            now = time.monotonic()
+            client = scope.get("client")
+            client_bucket = route_bucket = None
+            if settings.client_rate:
+                client_bucket = client_buckets.get(client[0] if client else None, settings.client_burst, now)
+                wait = client_bucket.wait(cost, settings.client_rate, settings.client_burst, now)
+                if wait:
+                    await self._shed(scope, send, 429, "client_rate", wait)
+                    return
+            if settings.route_rate:
+                route_bucket = route_buckets.get((scope["method"], self._endpoint(scope)), settings.route_burst, now)
+                wait = route_bucket.wait(cost, settings.route_rate, settings.route_burst, now)
+                if wait:
+                    await self._shed(scope, send, 503, "route_rate", wait)
+                    return
+            # Only taken once both buckets admit the request
+            if client_bucket is not None:
+                client_bucket.take(cost, settings.client_burst)
+            if route_bucket is not None:
+                route_bucket.take(cost, settings.route_burst)
+
+        if not expensive:
+            await self.app(scope, receive, send)
+            return
+        limit = expensive_limits[scope["path"]]
+        reason = await limit.acquire()
+        if reason is not None:
+            await self._shed(scope, send, 503, reason, settings.queue_timeout)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            limit.release()
+
+    def _endpoint(self, scope) -> str:
+        # The route template, stored in the scope like the router does so
+        # PrometheusMiddleware counts a shed request under its route too
+        route = scope.get("route")
+        if route is None:
+            for candidate in self.router.routes:
+                match, child_scope = candidate.matches(scope)
+                if match is Match.FULL:
+                    route = scope["route"] = candidate
+                    break
+        return route.path if route is not None else UNMATCHED_ROUTE
+
+    async def _shed(self, scope, send, status: int, reason: str, wait: float):
+        ADMISSION_SHED.labels(endpoint=self._endpoint(scope), reason=reason).inc()
+        body = encode_json({"detail": "Too many requests, please retry later" if status == 429 else "Service overloaded, please retry later"})
+        await send({"type": "http.response.start", "status": status, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode()),
+            (b"retry-after", retry_after(wait).encode()),
+        ]})
+        await send({"type": "http.response.body", "body": body})
+
+
+def _profile_trigger(scope):
+    # "request" for an admin asking for the profile (?profile=1 or
+    # X-Profile: 1), "sample" for a request picked by the sample rate
+    if tracing.ADMIN_TOKEN is None:
+        return None
+    query = scope["query_string"]
+    requested = b"profile=" in query and ("profile", "1") in parse_qsl(query.decode("latin-1"))
+    token = None
+    for name, value in scope["headers"]:
+        if name == b"x-profile" and value == b"1":
+            requested = True
+        elif name == b"x-admin-token":
+            token = value.decode("latin-1")
+    if requested and tracing.is_admin(token):
+        return "request"
+    if settings.profile_sample_rate and random.random() < settings.profile_sample_rate:
+        return "sample"
+    return None
+
+
+class TracingMiddleware:
+    """Pure ASGI middleware for per-request trace logs and sampling profiles.
+
+    A request an admin profiles with ?profile=1 gets the collapsed-stack
+    profile as its response body (the original status is in
+    X-Profiled-Status); requests sampled by profile_sample_rate are handled
+    normally and their profiles stored for GET /admin/profiles. With neither
+    trace logging nor an ADMIN_TOKEN configured, requests pass straight
+    through.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or (tracing.ADMIN_TOKEN is None and not settings.trace_log):
+            await self.app(scope, receive, send)
+            return
+        trigger = _profile_trigger(scope)
+        if trigger is None and not settings.trace_log:
+            await self.app(scope, receive, send)
+            return
+
+        status = [None]
+
+        async def send_through(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+            await send(message)
+
+        async def capture(message):
+            # The profile replaces the response
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+
+        spans = []
+        spans_token = request_spans.set(spans) if settings.trace_log else None
+        profiler = None
+        if trigger is not None:
+            PROFILED_REQUESTS.labels(trigger=trigger).inc()
+            profiler = SamplingProfiler()
+            profiler.add_thread(threading.get_ident(), "loop")
+            profiler_token = current_profiler.set(profiler)
+            profiler.start()
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, capture if trigger == "request" else send_through)
+        finally:
+            elapsed = time.perf_counter() - start
+            if profiler is not None:
+                profiler.stop()
+                current_profiler.reset(profiler_token)
+            if spans_token is not None:
+                request_spans.reset(spans_token)
+                self._log(scope, status[0], elapsed, spans)
+
+        if trigger == "request":
+            body = profiler.collapsed().encode()
+            await send({"type": "http.response.start", "status": 200, "headers": [
+                (b"content-type", b"text/plain; charset=utf-8"),
+                (b"content-length", str(len(body)).encode()),
+                (b"x-profiled-status", str(status[0]).encode()),
+                (b"x-profile-samples", str(profiler.samples).encode()),
+            ]})
+            await send({"type": "http.response.body", "body": body})
+        elif trigger == "sample":
+            route = scope.get("route")
+            await run_in_threadpool(store_profile, profiler.collapsed(), scope["method"], route.path if route is not None else UNMATCHED_ROUTE)
+
+    @staticmethod
+    def _log(scope, status, elapsed: float, spans: list):
+        totals = {}
+        for stage, seconds in spans:
+            totals[stage] = totals.get(stage, 0.0) + seconds
+        route = scope.get("route")
+        trace_logger.info(
+            "%s %s %s %.3fms %s", scope["method"], route.path if route is not None else UNMATCHED_ROUTE, status,
+            elapsed * 1000, " ".join(f"{stage}={seconds * 1000:.3f}ms" for stage, seconds in totals.items())
+        )
@@ -1,11 +1,17 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, PrivateAttr, conint
 from typing import Optional
 
+# Ids and quantities are stored as signed 64-bit integers (app/columns.py)
+Int64 = conint(ge=-2**63, le=2**63 - 1)
+
 class Medication(BaseModel):
-    id: int
+    id: Int64
     name: str
     description: Optional[str] = None
     icon_url: Optional[str] = None
+    # Content-addressed file name of the uploaded icon ("<sha256>.<ext>").
+    # Private, so clients can neither see nor set it.
+    _icon_file: Optional[str] = PrivateAttr(default=None)
 
     class Config:
         schema_extra = {
@@ -18,8 +24,8 @@ class Medication(BaseModel):
         }
 
 class Inventory(BaseModel):
-    medication_id: int
-    quantity: int
+    medication_id: Int64
+    quantity: Int64
     shelf_id: str
     shelf_location: str
 
@@ -31,4 +37,49 @@ class Inventory(BaseModel):
                 "shelf_id": "A1",
                 "shelf_location": "Shelf 1"
             }
-        }
\ No newline at end of file
+        }
+
+class InventoryBatchItem(Inventory):
+    if_match: Optional[str] = None
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "medication_id": 1,
+                "quantity": 100,
+                "shelf_id": "A1",
+                "shelf_location": "Shelf 1",
+                "if_match": "\"3f2a9c...\""
+            }
+        }
+
+class TracingSettingsUpdate(BaseModel):
+    stage_timing: Optional[bool] = None
+    trace_log: Optional[bool] = None
+    profile_sample_rate: Optional[float] = Field(None, ge=0, le=1)
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "trace_log": True,
+                "profile_sample_rate": 0.01
+            }
+        }
+
+class AdmissionSettingsUpdate(BaseModel):
+    client_rate: Optional[float] = Field(None, ge=0)
+    client_burst: Optional[float] = Field(None, ge=1)
+    route_rate: Optional[float] = Field(None, ge=0)
+    route_burst: Optional[float] = Field(None, ge=1)
+    expensive_cost: Optional[float] = Field(None, ge=1)
+    expensive_concurrency: Optional[int] = Field(None, ge=1)
+    expensive_queue: Optional[int] = Field(None, ge=0)
+    queue_timeout: Optional[float] = Field(None, gt=0)
+
+    class Config:
+        schema_extra = {
+            "example": {
+                "client_rate": 50,
+                "expensive_concurrency": 2
+            }
+        }
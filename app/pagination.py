@@ -0,0 +1,76 @@
+import base64
+import binascii
+from bisect import bisect_left, bisect_right
+
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+
+
+class SortedIds:
+    """Ids of a collection kept in ascending order for cursor paging."""
+
+    def __init__(self):
+        self._ids = []
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def __contains__(self, item_id: int) -> bool:
+        i = bisect_left(self._ids, item_id)
+        return i < len(self._ids) and self._ids[i] == item_id
+
+    def add(self, item_id: int):
+        i = bisect_left(self._ids, item_id)
+        if i == len(self._ids) or self._ids[i] != item_id:
+            self._ids.insert(i, item_id)
+
+    def remove(self, item_id: int):
+        i = bisect_left(self._ids, item_id)
+        if i < len(self._ids) and self._ids[i] == item_id:
+            del self._ids[i]
+
+    def clear(self):
+        self._ids.clear()
+
+    def load(self, ids):
+        # ids must already be in ascending order
+        self._ids = list(ids)
+
+    def after(self, last_id, limit: int) -> list:
+        return page_after(self._ids, last_id, limit)
+
+    def all(self) -> list:
+        return list(self._ids)
+
+
+def page_after(ids: list, last_id, limit: int) -> list:
+    start = 0 if last_id is None else bisect_right(ids, last_id)
+    return ids[start:start + limit]
+
+
+def iter_ids(fetch, last_id=None, chunk_size: int = STREAM_CHUNK_SIZE):
+    # Walks a collection a chunk at a time, re-seeking after the last id seen,
+    # so concurrent inserts and deletes never invalidate the iteration.
+    while True:
+        chunk = fetch(last_id, chunk_size)
+        if not chunk:
+            return
+        yield from chunk
+        last_id = chunk[-1]
+
+
+def encode_cursor(last_id: int) -> str:
+    return base64.urlsafe_b64encode(str(last_id).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> int:
+    try:
+        return int(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode())
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        raise ValueError(f"Invalid cursor: {cursor!r}")
+
+
+def set_next_page_headers(response, request, last_id: int):
+    next_cursor = encode_cursor(last_id)
+    response.headers["Link"] = f'<{request.url.include_query_params(cursor=next_cursor)}>; rel="next"'
+    response.headers["X-Next-Cursor"] = next_cursor
@@ -0,0 +1,103 @@
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "/tmp/profiles")
+PROFILE_INTERVAL = float(os.environ.get("PROFILE_INTERVAL", "0.001"))
+MAX_STORED_PROFILES = int(os.environ.get("MAX_STORED_PROFILES", "100"))
+
+PROFILE_NAME_PATTERN = re.compile(r"^[0-9]+-[A-Za-z0-9_]+\.folded$")
+
+
+class SamplingProfiler:
+    """Samples the call stacks of registered threads from a background thread.
+
+    Only threads working on the profiled request are registered: the event
+    loop thread (which also runs other requests' coroutines in between) and
+    worker threads while they run code for it. The result is in the collapsed
+    stack format ("outer;inner;leaf count" per line) read by flamegraph.pl and
+    speedscope.
+    """
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self.samples = 0
+        self._threads = {}
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._run, name="profiler", daemon=True)
+        self._frame_names = {}
+
+    def add_thread(self, ident: int, label: str):
+        self._threads[ident] = label
+
+    def remove_thread(self, ident: int):
+        self._threads.pop(ident, None)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for ident, label in list(self._threads.items()):
+                frame = frames.get(ident)
+                if frame is not None:
+                    self.stacks[self._stack(label, frame)] += 1
+                    self.samples += 1
+
+    def _stack(self, label: str, frame) -> str:
+        names = []
+        while frame is not None:
+            code = frame.f_code
+            name = self._frame_names.get(code)
+            if name is None:
+                path = code.co_filename.replace(os.sep, "/").rsplit("/", 2)
+                name = self._frame_names[code] = f"{code.co_name} ({'/'.join(path[-2:])})"
+            names.append(name)
+            frame = frame.f_back
+        names.append(label)
+        return ";".join(reversed(names))
+
+    def collapsed(self) -> str:
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common())
+
+
+def store_profile(profile: str, method: str, route: str) -> str:
+    # Keeps the newest MAX_STORED_PROFILES profiles in PROFILE_DIR
+    os.makedirs(PROFILE_DIR, exist_ok=True)
+    name = f"{time.time_ns()}-{method}{re.sub(r'[^A-Za-z0-9]+', '_', route)}.folded"
+    with open(os.path.join(PROFILE_DIR, name), "w") as f:
+        f.write(profile)
+    for old in stored_profiles()[MAX_STORED_PROFILES:]:
+        try:
+            os.remove(os.path.join(PROFILE_DIR, old))
+        except FileNotFoundError:
+            pass
+    return name
+
+
+def stored_profiles() -> list:
+    # Newest first
+    try:
+        names = [name for name in os.listdir(PROFILE_DIR) if PROFILE_NAME_PATTERN.match(name)]
+    except FileNotFoundError:
+        return []
+    return sorted(names, key=lambda name: int(name.split("-", 1)[0]), reverse=True)
+
+
+def load_profile(name: str):
+    if not PROFILE_NAME_PATTERN.match(name):
+        return None
+    try:
+        with open(os.path.join(PROFILE_DIR, name)) as f:
+            return f.read()
+    except FileNotFoundError:
+        return None
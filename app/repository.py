@@ -0,0 +1,528 @@
+import logging
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from typing import Iterable, Iterator, Optional
+
+from app.encoders import encode_json, decode_json
+from app.models import Medication, Inventory
+from app.snapshots import RecordTable, Snapshot, write_snapshot
+from app.wal import WAL_FSYNC, WriteAheadLog, list_segments, read_segment, sync_directory
+
+MEDICATION = "medication"
+INVENTORY = "inventory"
+
+# `expected` value of an unconditional write
+ANY = object()
+
+# Log entries written before LogRepository compacts the log into a snapshot
+SNAPSHOT_EVERY = int(os.environ.get("SNAPSHOT_EVERY", "10000"))
+SNAPSHOT_FILE = "snapshot"
+
+logger = logging.getLogger(__name__)
+
+
+class ConcurrentUpdate(Exception):
+    """A conditional write found a different record than the one it expected."""
+
+
+class Repository:
+    """Store of record behind the in-memory working set in app/data.py.
+
+    Every write goes to the repository first and is then applied to the
+    working set. changes_since() lets a process pick up writes made by other
+    processes sharing the same store; it returns the latest sequence number
+    and the (kind, id, record) changes after `seq`, with record None for a
+    deletion, or None instead of the changes if they are no longer retained
+    and the caller has to reload everything.
+
+    Writes take an `expected` record (None for "must not exist") and raise
+    ConcurrentUpdate, without writing, if the stored record is different.
+
+    Stores that keep snapshots return the latest one and the (kind, id,
+    record) changes logged after it from load_snapshot(), so app/data.py can
+    map it instead of loading record by record; others return None.
+    """
+
+    # True when other processes may write to the same store
+    shared = False
+    # True when writes wait for the disk, so async handlers hand them to a
+    # worker thread instead of running them on the event loop
+    blocking = False
+
+    def get_medication(self, med_id: int) -> Optional[Medication]:
+        raise NotImplementedError
+
+    def get_inventory(self, med_id: int) -> Optional[Inventory]:
+        raise NotImplementedError
+
+    def medications(self) -> Iterator[Medication]:
+        raise NotImplementedError
+
+    def inventory(self) -> Iterator[Inventory]:
+        raise NotImplementedError
+
+    def save_medication(self, med_id: int, medication: Medication, expected=ANY):
+        raise NotImplementedError
+
+    def save_inventory(self, med_id: int, inv: Inventory, expected=ANY):
+        self.save_inventory_many([(med_id, inv)], None if expected is ANY else {med_id: expected})
+
+    def save_inventory_many(self, items: Iterable, expected: dict = None):
+        # expected maps medication ids to the records their writes expect
+        raise NotImplementedError
+
+    def remove_medication(self, med_id: int):
+        raise NotImplementedError
+
+    def remove_inventory(self, med_id: int):
+        raise NotImplementedError
+
+    def latest_seq(self) -> int:
+        return 0
+
+    def changes_since(self, seq: int):
+        return seq, []
+
+    def load_snapshot(self):
+        return None
+
+    def close(self):
+        pass
+
+
+class MemoryRepository(Repository):
+    """Process-local dict store; nothing survives a restart.
+
+    app/data.py passes in its own working-set dicts so the data is held once.
+    """
+
+    def __init__(self, medications: dict = None, inventory: dict = None):
+        self._medications = {} if medications is None else medications
+        self._inventory = {} if inventory is None else inventory
+
+    def get_medication(self, med_id: int) -> Optional[Medication]:
+        return self._medications.get(med_id)
+
+    def get_inventory(self, med_id: int) -> Optional[Inventory]:
+        return self._inventory.get(med_id)
+
+    def medications(self) -> Iterator[Medication]:
+        return iter(list(self._medications.values()))
+
+    def inventory(self) -> Iterator[Inventory]:
+        return iter(list(self._inventory.values()))
+
+    def save_medication(self, med_id: int, medication: Medication, expected=ANY):
+        if expected is not ANY:
+            _check(_medication_params, med_id, self._medications.get(med_id), expected)
+        self._medications[med_id] = medication
+
+    def save_inventory_many(self, items: Iterable, expected: dict = None):
+        items = list(items)
+        for med_id, record in (expected or {}).items():
+            _check(_inventory_params, med_id, self._inventory.get(med_id), record)
+        for med_id, inv in items:
+            self._inventory[med_id] = inv
+
+    def remove_medication(self, med_id: int):
+        self._medications.pop(med_id, None)
+
+    def remove_inventory(self, med_id: int):
+        self._inventory.pop(med_id, None)
+
+
+def _encode_entry(kind: str, med_id: int, record) -> bytes:
+    if record is None:
+        return encode_json([kind, med_id])
+    params = _medication_params(med_id, record) if kind == MEDICATION else _inventory_params(med_id, record)
+    return encode_json([kind, *params])
+
+
+def _decode_entry(entry: bytes) -> tuple:
+    # Records were validated before they were logged
+    kind, *row = decode_json(entry)
+    if len(row) == 1:
+        return kind, row[0], None
+    if kind == MEDICATION:
+        record = Medication.construct(id=row[0], name=row[1], description=row[2], icon_url=row[3])
+        record._icon_file = row[4]
+    else:
+        record = Inventory.construct(medication_id=row[0], quantity=row[1], shelf_id=row[2], shelf_location=row[3])
+    return kind, row[0], record
+
+
+class LogRepository(MemoryRepository):
+    """Dict store made durable by a write-ahead log plus snapshots.
+
+    Every write is appended to the log in `directory` (see app/wal.py) and
+    committed before it is applied. Once `snapshot_every` entries have been
+    logged, the log moves on to a new segment and a background thread merges
+    the previous snapshot and the closed segments into a new snapshot (see
+    app/snapshots.py), after which the segments are deleted. Opening the store
+    cuts off a write torn by a crash at the end of the log.
+
+    Given the working-set maps of app/data.py, filling them is left to
+    app/data.py, which maps the snapshot from load_snapshot(); otherwise the
+    store loads its own.
+    """
+
+    blocking = True
+
+    def __init__(self, directory: str, medications: dict = None, inventory: dict = None,
+                 fsync: str = WAL_FSYNC, snapshot_every: int = SNAPSHOT_EVERY):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        # Held for a whole compaction, and while snapshot and segments are
+        # swapped or read
+        self._compaction_lock = threading.Lock()
+        self._files_lock = threading.Lock()
+        snapshot, tail, last_seq = self._recover(truncate=True)
+        self._log = WriteAheadLog(directory, last_seq + 1, fsync)
+        self._since_snapshot = len(tail)
+        # Handed to the first load_snapshot() if nothing was written before it
+        self._recovered = (last_seq, snapshot, tail) if medications is not None else None
+        if medications is None:
+            medications, inventory = RecordTable(cache=True), RecordTable(cache=True)
+            if snapshot is not None:
+                medications.attach(snapshot.medication_ids, snapshot.medication)
+                inventory.attach(snapshot.inventory_ids, snapshot.inventory_item)
+            for kind, med_id, record in tail:
+                table = medications if kind == MEDICATION else inventory
+                if record is None:
+                    table.pop(med_id, None)
+                else:
+                    table[med_id] = record
+        super().__init__(medications, inventory)
+
+    def _snapshot_path(self) -> str:
+        return os.path.join(self.directory, SNAPSHOT_FILE)
+
+    def _recover(self, truncate: bool = False):
+        # The snapshot, the changes logged after it and the last entry number
+        with self._files_lock:
+            path = self._snapshot_path()
+            snapshot = Snapshot(path) if os.path.exists(path) else None
+            last_seq = snapshot.seq if snapshot is not None else 0
+            tail = []
+            for first_seq, segment in list_segments(self.directory):
+                if first_seq > last_seq + 1:
+                    raise RuntimeError(f"Log entries {last_seq + 1} to {first_seq - 1} are missing in {self.directory}")
+                entries, valid_length = read_segment(segment)
+                for seq, entry in enumerate(entries, first_seq):
+                    if seq > last_seq:
+                        tail.append(_decode_entry(entry))
+                        last_seq = seq
+                if truncate and valid_length < os.path.getsize(segment):
+                    logger.warning("Truncating torn write at the end of %s", segment)
+                    with open(segment, "r+b") as f:
+                        f.truncate(valid_length)
+                        os.fsync(f.fileno())
+            return snapshot, tail, last_seq
+
+    def load_snapshot(self):
+        # Reads back what is on disk, so only call it while nothing is written
+        recovered, self._recovered = self._recovered, None
+        if recovered is not None and recovered[0] == self._log.last_seq:
+            return recovered[1:]
+        self._log.commit(self._log.last_seq)
+        snapshot, tail, _ = self._recover()
+        return snapshot, tail
+
+    def _write(self, entries: list):
+        self._log.commit(self._log.append(entries))
+        self._since_snapshot += len(entries)
+        if self._since_snapshot >= self.snapshot_every and self._compaction_lock.acquire(blocking=False):
+            threading.Thread(target=self._compact_in_background, name="wal-compaction", daemon=True).start()
+
+    def save_medication(self, med_id: int, medication: Medication, expected=ANY):
+        if expected is not ANY:
+            _check(_medication_params, med_id, self._medications.get(med_id), expected)
+        self._write([_encode_entry(MEDICATION, med_id, medication)])
+        self._medications[med_id] = medication
+
+    def save_inventory_many(self, items: Iterable, expected: dict = None):
+        items = list(items)
+        for med_id, record in (expected or {}).items():
+            _check(_inventory_params, med_id, self._inventory.get(med_id), record)
+        self._write([_encode_entry(INVENTORY, med_id, inv) for med_id, inv in items])
+        for med_id, inv in items:
+            self._inventory[med_id] = inv
+
+    def remove_medication(self, med_id: int):
+        self._write([_encode_entry(MEDICATION, med_id, None)])
+        self._medications.pop(med_id, None)
+
+    def remove_inventory(self, med_id: int):
+        self._write([_encode_entry(INVENTORY, med_id, None)])
+        self._inventory.pop(med_id, None)
+
+    def snapshot_now(self):
+        # Compacts everything logged so far into a new snapshot
+        with self._compaction_lock:
+            self._compact()
+
+    def _compact_in_background(self):
+        try:
+            self._compact()
+        except Exception:
+            logger.exception("Compacting the log in %s failed", self.directory)
+        finally:
+            self._compaction_lock.release()
+
+    def _compact(self):
+        upto = self._log.rotate()
+        self._since_snapshot = 0
+        path = self._snapshot_path()
+        previous = Snapshot(path) if os.path.exists(path) else None
+        base_seq = previous.seq if previous is not None else 0
+        if upto == base_seq:
+            return
+        closed = [(first_seq, segment) for first_seq, segment in list_segments(self.directory) if first_seq <= upto]
+        changes = {MEDICATION: {}, INVENTORY: {}}
+        for first_seq, segment in closed:
+            entries, _ = read_segment(segment)
+            for seq, entry in enumerate(entries, first_seq):
+                if base_seq < seq <= upto:
+                    kind, med_id, record = _decode_entry(entry)
+                    changes[kind][med_id] = record
+        write_snapshot(path + ".tmp", upto, previous, changes[MEDICATION], changes[INVENTORY])
+        with self._files_lock:
+            os.replace(path + ".tmp", path)
+            sync_directory(self.directory)
+            for _, segment in closed:
+                os.remove(segment)
+
+    def close(self):
+        with self._compaction_lock:
+            self._log.close()
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS medications (
+    id INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    description TEXT,
+    icon_url TEXT,
+    icon_file TEXT
+);
+CREATE INDEX IF NOT EXISTS medications_name ON medications (name);
+CREATE TABLE IF NOT EXISTS inventory (
+    medication_id INTEGER PRIMARY KEY,
+    quantity INTEGER NOT NULL,
+    shelf_id TEXT NOT NULL,
+    shelf_location TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS inventory_quantity ON inventory (quantity);
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    kind TEXT NOT NULL,
+    record_id INTEGER NOT NULL
+);
+"""
+
+# Statements are kept as constants so every pooled connection reuses its
+# cached prepared statement for them.
+SELECT_MEDICATION = "SELECT id, name, description, icon_url, icon_file FROM medications WHERE id = ?"
+SELECT_MEDICATIONS = "SELECT id, name, description, icon_url, icon_file FROM medications ORDER BY id"
+UPSERT_MEDICATION = "INSERT OR REPLACE INTO medications (id, name, description, icon_url, icon_file) VALUES (?, ?, ?, ?, ?)"
+DELETE_MEDICATION = "DELETE FROM medications WHERE id = ?"
+SELECT_INVENTORY_ITEM = "SELECT medication_id, quantity, shelf_id, shelf_location FROM inventory WHERE medication_id = ?"
+SELECT_INVENTORY = "SELECT medication_id, quantity, shelf_id, shelf_location FROM inventory ORDER BY medication_id"
+UPSERT_INVENTORY = "INSERT OR REPLACE INTO inventory (medication_id, quantity, shelf_id, shelf_location) VALUES (?, ?, ?, ?)"
+DELETE_INVENTORY = "DELETE FROM inventory WHERE medication_id = ?"
+INSERT_CHANGE = "INSERT INTO changes (kind, record_id) VALUES (?, ?)"
+SELECT_LATEST_SEQ = "SELECT COALESCE(MAX(seq), 0) FROM changes"
+SELECT_OLDEST_SEQ = "SELECT MIN(seq) FROM changes"
+SELECT_CHANGES = "SELECT kind, record_id, MAX(seq) FROM changes WHERE seq > ? GROUP BY kind, record_id ORDER BY MAX(seq)"
+PRUNE_CHANGES = "DELETE FROM changes WHERE seq <= ?"
+
+
+# Columns added after the first release, added to existing databases on open
+MIGRATIONS = [("medications", "icon_file", "ALTER TABLE medications ADD COLUMN icon_file TEXT")]
+
+
+def _medication_params(med_id: int, medication: Medication) -> tuple:
+    return (med_id, medication.name, medication.description, medication.icon_url, medication._icon_file)
+
+
+def _inventory_params(med_id: int, inv: Inventory) -> tuple:
+    return (med_id, inv.quantity, inv.shelf_id, inv.shelf_location)
+
+
+def _check(params, med_id: int, current, expected):
+    # Records are compared as the rows they are stored as
+    if (current is None) != (expected is None) or (current is not None and params(med_id, current) != params(med_id, expected)):
+        raise ConcurrentUpdate(f"Record {med_id} was changed concurrently")
+
+
+def _medication(row) -> Medication:
+    medication = Medication(id=row[0], name=row[1], description=row[2], icon_url=row[3])
+    medication._icon_file = row[4]
+    return medication
+
+
+def _inventory(row) -> Inventory:
+    return Inventory(medication_id=row[0], quantity=row[1], shelf_id=row[2], shelf_location=row[3])
+
+
+class SQLiteRepository(Repository):
+    """SQLite store in WAL mode, shareable by several worker processes.
+
+    Readers never block the single writer, connections come from a small
+    pool, and every write also appends to a `changes` table which other
+    processes poll through changes_since().
+    """
+
+    shared = True
+    blocking = True
+
+    def __init__(self, path: str, pool_size: int = 4, change_retention: int = 100_000):
+        self.path = path
+        self.change_retention = change_retention
+        self._pool = queue.Queue()
+        self._writes = 0
+        self._watch_lock = threading.Lock()
+        for _ in range(pool_size):
+            self._pool.put(self._connect())
+        with self._connection() as conn:
+            conn.executescript(SCHEMA)
+            for table, column, statement in MIGRATIONS:
+                if column not in [info[1] for info in conn.execute(f"PRAGMA table_info({table})")]:
+                    conn.execute(statement)
+        # data_version only changes when *another* connection commits, which
+        # makes it a cheap "did anything happen?" check before querying.
+        self._watch = self._connect()
+        self._data_version = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None, cached_statements=64)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA busy_timeout=5000")
+        return conn
+
+    @contextmanager
+    def _connection(self):
+        conn = self._pool.get()
+        try:
+            yield conn
+        finally:
+            self._pool.put(conn)
+
+    @contextmanager
+    def _transaction(self):
+        with self._connection() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        self._writes += 1
+        if self._writes % 1000 == 0:
+            self._prune_changes()
+
+    def _prune_changes(self):
+        with self._connection() as conn:
+            latest = conn.execute(SELECT_LATEST_SEQ).fetchone()[0]
+            conn.execute(PRUNE_CHANGES, (latest - self.change_retention,))
+
+    def get_medication(self, med_id: int) -> Optional[Medication]:
+        with self._connection() as conn:
+            row = conn.execute(SELECT_MEDICATION, (med_id,)).fetchone()
+        return _medication(row) if row else None
+
+    def get_inventory(self, med_id: int) -> Optional[Inventory]:
+        with self._connection() as conn:
+            row = conn.execute(SELECT_INVENTORY_ITEM, (med_id,)).fetchone()
+        return _inventory(row) if row else None
+
+    def medications(self) -> Iterator[Medication]:
+        with self._connection() as conn:
+            rows = conn.execute(SELECT_MEDICATIONS).fetchall()
+        return (_medication(row) for row in rows)
+
+    def inventory(self) -> Iterator[Inventory]:
+        with self._connection() as conn:
+            rows = conn.execute(SELECT_INVENTORY).fetchall()
+        return (_inventory(row) for row in rows)
+
+    def save_medication(self, med_id: int, medication: Medication, expected=ANY):
+        with self._transaction() as conn:
+            if expected is not ANY:
+                # BEGIN IMMEDIATE holds the write lock, so no other process can
+                # change the row between this check and the write
+                row = conn.execute(SELECT_MEDICATION, (med_id,)).fetchone()
+                _check(_medication_params, med_id, _medication(row) if row else None, expected)
+            conn.execute(UPSERT_MEDICATION, _medication_params(med_id, medication))
+            conn.execute(INSERT_CHANGE, (MEDICATION, med_id))
+
+    def save_inventory_many(self, items: Iterable, expected: dict = None):
+        items = list(items)
+        with self._transaction() as conn:
+            for med_id, record in (expected or {}).items():
+                row = conn.execute(SELECT_INVENTORY_ITEM, (med_id,)).fetchone()
+                _check(_inventory_params, med_id, _inventory(row) if row else None, record)
+            conn.executemany(UPSERT_INVENTORY, [_inventory_params(med_id, inv) for med_id, inv in items])
+            conn.executemany(INSERT_CHANGE, [(INVENTORY, med_id) for med_id, _ in items])
+
+    def remove_medication(self, med_id: int):
+        with self._transaction() as conn:
+            conn.execute(DELETE_MEDICATION, (med_id,))
+            conn.execute(INSERT_CHANGE, (MEDICATION, med_id))
+
+    def remove_inventory(self, med_id: int):
+        with self._transaction() as conn:
+            conn.execute(DELETE_INVENTORY, (med_id,))
+            conn.execute(INSERT_CHANGE, (INVENTORY, med_id))
+
+    def latest_seq(self) -> int:
+        with self._connection() as conn:
+            return conn.execute(SELECT_LATEST_SEQ).fetchone()[0]
+
+    def changes_since(self, seq: int):
+        with self._watch_lock:
+            data_version = self._watch.execute("PRAGMA data_version").fetchone()[0]
+            if data_version == self._data_version:
+                return seq, []
+            self._data_version = data_version
+
+        with self._connection() as conn:
+            conn.execute("BEGIN")
+            try:
+                oldest = conn.execute(SELECT_OLDEST_SEQ).fetchone()[0]
+                if oldest is not None and oldest > seq + 1:
+                    return conn.execute(SELECT_LATEST_SEQ).fetchone()[0], None
+                changes = []
+                latest = seq
+                for kind, record_id, change_seq in conn.execute(SELECT_CHANGES, (seq,)).fetchall():
+                    statement, build = (SELECT_MEDICATION, _medication) if kind == MEDICATION else (SELECT_INVENTORY_ITEM, _inventory)
+                    row = conn.execute(statement, (record_id,)).fetchone()
+                    changes.append((kind, record_id, build(row) if row else None))
+                    latest = max(latest, change_seq)
+                return latest, changes
+            finally:
+                conn.execute("COMMIT")
+
+    def close(self):
+        self._watch.close()
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+
+
+def open_repository(url: str, medications: dict = None, inventory: dict = None) -> Repository:
+    # "memory://", "sqlite:///relative/path.db", "sqlite:////absolute/path.db",
+    # "wal:///relative/directory" or "wal:////absolute/directory". The dict
+    # stores hold their records in `medications` and `inventory` when given.
+    if url.startswith("sqlite:///"):
+        return SQLiteRepository(url[len("sqlite:///"):])
+    if url.startswith("wal:///"):
+        return LogRepository(url[len("wal:///"):], medications, inventory)
+    if url in ("", "memory://"):
+        return MemoryRepository(medications, inventory)
+    raise ValueError(f"Unsupported STORAGE_URL: {url}")
@@ -0,0 +1,47 @@
+from fastapi import APIRouter, HTTPException, Header
+from fastapi.responses import Response as FastAPIResponse
+from typing import Optional, List
+
+from app.models import TracingSettingsUpdate, AdmissionSettingsUpdate
+from app.profiling import stored_profiles, load_profile
+from app import admission
+from app.tracing import settings, is_admin, run_in_threadpool
+
+router = APIRouter()
+
+async def require_admin(x_admin_token: Optional[str] = Header(None, description="Token configured with ADMIN_TOKEN")):
+    if not is_admin(x_admin_token):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+@router.get("/tracing", response_model=dict, summary="Get the tracing settings", description="Whether stage timing and trace logs are on and which fraction of requests is profiled, for the worker handling the request.")
+async def get_tracing():
+    return settings.as_dict()
+
+@router.put("/tracing", response_model=dict, summary="Change the tracing settings", description="Switch stage timing or trace logs on or off, or set the fraction of requests to profile (0 to stop). Fields left out keep their value. Applies to the worker handling the request.")
+async def update_tracing(update: TracingSettingsUpdate):
+    for name, value in update.dict(exclude_none=True).items():
+        setattr(settings, name, value)
+    return settings.as_dict()
+
+@router.get("/admission", response_model=dict, summary="Get the admission limits", description="The token bucket rates and bursts and the limits on expensive requests, for the worker handling the request.")
+async def get_admission():
+    return admission.settings.as_dict()
+
+@router.put("/admission", response_model=dict, summary="Change the admission limits", description="Set the per-client and per-route rates (0 to switch a limit off) and bursts, the cost of expensive requests and how many of them are served or may wait at once. Fields left out keep their value. Applies to the worker handling the request.")
+async def update_admission(update: AdmissionSettingsUpdate):
+    for name, value in update.dict(exclude_none=True).items():
+        setattr(admission.settings, name, value)
+    for limit in admission.expensive_limits.values():
+        limit.admit_waiting()
+    return admission.settings.as_dict()
+
+@router.get("/profiles", response_model=List[str], summary="Get the stored profiles", description="Names of the profiles stored for sampled requests, newest first.")
+async def get_profiles():
+    return await run_in_threadpool(stored_profiles)
+
+@router.get("/profiles/{name}", summary="Get a stored profile", description="A stored profile in the collapsed stack format read by flamegraph.pl and speedscope.")
+async def get_profile(name: str):
+    profile = await run_in_threadpool(load_profile, name)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    return FastAPIResponse(content=profile, media_type="text/plain")
@@ -0,0 +1,68 @@
+from fastapi import APIRouter, HTTPException, Header, Query
+from fastapi.responses import StreamingResponse
+from app.tracing import TimedRoute, run_in_threadpool
+from typing import Optional, List
+
+from app.changes import change_log
+from app.data import repository, sync_from_repository
+from app.metrics import CHANGE_STREAM_SUBSCRIBERS
+from app.utils import serialize_records
+
+router = APIRouter(route_class=TimedRoute)
+
+MAX_CHANGES = 1000
+
+# An idle stream sends a comment this often, which also notices clients that
+# went away; with a shared store it is also how often other workers' writes
+# are picked up
+IDLE_SECONDS = 1.0 if repository.shared else 15.0
+
+EXPIRED_DETAIL = "Changes after this seq are no longer retained; reload the collections and resume from their X-Change-Seq header"
+
+@router.get("/", response_model=List[dict], summary="Get changes", description="Retrieve the medication and inventory changes after a sequence number, oldest first. Each change carries the record as it is after the change, or null for a deletion. Responds with 410 when some of those changes are no longer retained.")
+async def get_changes(
+    since: int = Query(..., ge=0, description="Sequence number of the last change already seen (0 for all retained changes since startup)"),
+    limit: int = Query(MAX_CHANGES, ge=1, le=MAX_CHANGES, description="Maximum number of changes to return"),
+    accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
+):
+    entries = change_log.since(since, limit)
+    if entries is None:
+        raise HTTPException(status_code=410, detail=EXPIRED_DETAIL)
+    response = serialize_records([(entry, body) for _, entry, body in entries], accept, None)
+    # Where the next request should continue from
+    response.headers["X-Change-Seq"] = str(entries[-1][0] if entries else since)
+    return response
+
+@router.get("/stream", summary="Stream changes", description="Server-Sent Events stream of medication and inventory changes, one `change` event per change with its seq as the event id. Reconnecting with Last-Event-ID resumes after that change. A client that falls too far behind gets a `reset` event and has to reload.")
+async def stream_changes(
+    since: Optional[int] = Query(None, ge=0, description="Sequence number to start after; defaults to Last-Event-ID, or to the latest change"),
+    last_event_id: Optional[str] = Header(None, description="Id of the last event received, sent by EventSource when reconnecting")
+):
+    if since is None:
+        since = int(last_event_id) if last_event_id and last_event_id.isdigit() else change_log.last_seq
+    if change_log.since(since, 0) is None:
+        raise HTTPException(status_code=410, detail=EXPIRED_DETAIL)
+    return StreamingResponse(_event_stream(since), media_type="text/event-stream", headers={"Cache-Control": "no-cache"})
+
+async def _event_stream(since: int):
+    # Reads the log at the client's pace: the next batch is only fetched once
+    # the previous one was sent, so a slow client holds no buffer of its own
+    # and only notices it fell behind when its position leaves the log.
+    CHANGE_STREAM_SUBSCRIBERS.inc()
+    try:
+        while True:
+            entries = change_log.since(since, MAX_CHANGES)
+            if entries is None:
+                yield b"event: reset\ndata: {}\n\n"
+                return
+            if entries:
+                for seq, _, body in entries:
+                    yield b"id: %d\nevent: change\ndata: %s\n\n" % (seq, body)
+                since = entries[-1][0]
+            elif not await change_log.wait(since, IDLE_SECONDS):
+                if repository.shared:
+                    # Other workers' writes only reach this process's log through a sync
+                    await run_in_threadpool(sync_from_repository)
+                yield b": keep-alive\n\n"
+    finally:
+        CHANGE_STREAM_SUBSCRIBERS.dec()
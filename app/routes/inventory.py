@@ -1,27 +1,193 @@
-from fastapi import APIRouter, HTTPException, Header, Response, Query, Body
+from fastapi import APIRouter, HTTPException, Header, Request, Response, Query, Body
+from pydantic import ValidationError
 from typing import Optional, List
+import json
 
-from app.models import Inventory
-from app.utils import serialize_response, generate_etag
-from app.metrics import INVENTORY_GAUGE  # Updated import
-from app.data import medications, inventory  # Import data and initialization
+from app.models import Inventory, InventoryBatchItem
+from app.utils import serialize_response, serialize_records, stream_response, LIST_MEDIA_TYPES, generate_etag, response_media_type, collection_etag, etag_matches, NDJSON_MEDIA_TYPE
+from app.cache import cached_response, cached_response_async
+from app.changes import change_log
+from app.pagination import MAX_PAGE_SIZE, decode_cursor, iter_ids, page_after, set_next_page_headers
+from app.metrics import set_inventory_gauge
+from app.data import medications, inventory, inventory_ids, stock_levels, shelf_items, inventory_etags, inventory_json, collection_digests, run_locked_write, wait_for_index, offload_build, save_inventory, save_inventory_many  # Import data and initialization
+from app.stock import EMPTY, LOW
+from app.columns import vectorized
+from app.tracing import TimedRoute, run_offloaded
 
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 
-@router.get("/", response_model=List[Inventory], summary="Get all inventory items", description="Retrieve all inventory items or filter for empty inventory items.")
-def get_inventory(
+MAX_BATCH_SIZE = 10000
+
+@router.get("/", response_model=List[Inventory], summary="Get all inventory items", description="Retrieve all inventory items or filter for empty or low-stock inventory items. Also supports cursor-based paging and streaming.")
+async def get_inventory(
+    request: Request,
     empty: Optional[bool] = Query(None, description="Filter for empty inventory items"),
-    accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
+    low_stock: Optional[bool] = Query(None, description="Filter for inventory items at or below the low-stock threshold (but not empty)"),
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of inventory items to return"),
+    cursor: Optional[str] = Query(None, description="Cursor from the previous page's Link header"),
+    stream: Optional[bool] = Query(None, description="Stream the inventory items as NDJSON (or incrementally written XML)"),
+    if_none_match: Optional[str] = Header(None, description="Collection ETag value to check against the current ETag"),
+    accept: str = Header("application/json", description="Specify the response format (application/json, application/x-ndjson or application/xml)")
 ):
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    media_type = response_media_type(accept, LIST_MEDIA_TYPES)
+    if stream or media_type == NDJSON_MEDIA_TYPE:
+        ids = await run_offloaded(offload_build(), _matching_ids, empty, low_stock)
+        if limit is None:
+            page = iter_ids(inventory_ids.after, after) if ids is None else page_after(ids, after, len(ids))
+        else:
+            ids = inventory_ids.after(after, limit + 1) if ids is None else page_after(ids, after, limit + 1)
+            page = ids[:limit]
+        records = ((inventory[med_id], inventory_json[med_id]) for med_id in page if med_id in inventory)
+        response = stream_response(records, accept, Inventory)
+        if limit is not None and len(ids) > limit:
+            set_next_page_headers(response, request, ids[limit - 1])
+        response.headers["Vary"] = "Accept"
+        return response
+
+    etag = collection_etag(collection_digests["inventory"], empty, low_stock, stock_levels.low_stock_threshold, limit, after, media_type)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
+    response = await cached_response_async(
+        ("inventory", empty, low_stock, stock_levels.low_stock_threshold, limit, after, media_type),
+        ["inventory"],
+        lambda: _list_inventory(request, empty, low_stock, limit, after, media_type),
+        offload_build(encoded=len(inventory) if limit is None else 0)
+    )
+    response.headers["ETag"] = etag
+    response.headers["Vary"] = "Accept"
+    return response
+
+def _matching_ids(empty: Optional[bool], low_stock: Optional[bool]):
+    # Sorted ids for a filtered listing, or None for the whole collection
+    if empty or low_stock:
+        wait_for_index("inventory")
     if empty:
-        empty_inventory = [inv.dict() for inv in inventory.values() if inv.quantity == 0]
-        if not empty_inventory:
+        matched_ids = stock_levels.ids(EMPTY)
+        if not matched_ids:
             raise HTTPException(status_code=404, detail="No empty inventory found")
-        return serialize_response(empty_inventory, accept)
-    return serialize_response([inv.dict() for inv in inventory.values()], accept)
+        return matched_ids
+    if low_stock:
+        matched_ids = stock_levels.ids(LOW)
+        if not matched_ids:
+            raise HTTPException(status_code=404, detail="No low-stock inventory found")
+        return matched_ids
+    return None
+
+def _list_inventory(request: Request, empty: Optional[bool], low_stock: Optional[bool], limit: Optional[int], after: Optional[int], accept: str):
+    seq = change_log.last_seq
+    matched_ids = _matching_ids(empty, low_stock)
+    if limit is None:
+        page = inventory_ids.all() if matched_ids is None else page_after(matched_ids, after, len(matched_ids))
+        response = serialize_records([(inventory[med_id], inventory_json[med_id]) for med_id in page], accept, Inventory)
+    else:
+        page = inventory_ids.after(after, limit + 1) if matched_ids is None else page_after(matched_ids, after, limit + 1)
+        response = serialize_records([(inventory[med_id], inventory_json[med_id]) for med_id in page[:limit]], accept, Inventory)
+        if len(page) > limit:
+            set_next_page_headers(response, request, page[limit - 1])
+    # Every change up to this seq is reflected in the listing, so a client
+    # that reloads it can resume GET /changes from there
+    response.headers["X-Change-Seq"] = str(seq)
+    return response
+
+@router.get("/stats", response_model=dict, summary="Get inventory statistics", description="Number of inventory items, total units and how many items are empty or low on stock, optionally broken down per shelf_id or shelf_location.")
+async def get_inventory_stats(
+    group_by: Optional[str] = Query(None, regex="^(shelf_id|shelf_location)$", description="Break the totals down per shelf_id or shelf_location"),
+    if_none_match: Optional[str] = Header(None, description="ETag value to check against the current ETag"),
+    accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
+):
+    media_type = response_media_type(accept)
+    etag = collection_etag(collection_digests["inventory"], "stats", group_by, stock_levels.low_stock_threshold, media_type)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
+    response = await cached_response_async(
+        ("inventory_stats", group_by, stock_levels.low_stock_threshold, media_type),
+        ["inventory"],
+        lambda: serialize_response(inventory.stats(stock_levels.low_stock_threshold, group_by), accept),
+        _offload_aggregate()
+    )
+    response.headers["ETag"] = etag
+    response.headers["Vary"] = "Accept"
+    return response
+
+@router.get("/shelves", response_model=List[dict], summary="Get all shelves", description="Number of inventory items, total units and empty and low-stock counts per shelf. Also supports querying for near-empty shelves.")
+async def get_shelves(
+    near_empty: Optional[bool] = Query(None, description="Only shelves on which every item is empty or at or below the low-stock threshold"),
+    if_none_match: Optional[str] = Header(None, description="ETag value to check against the current ETag"),
+    accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
+):
+    media_type = response_media_type(accept)
+    etag = collection_etag(collection_digests["inventory"], "shelves", near_empty, stock_levels.low_stock_threshold, media_type)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
+    response = await cached_response_async(
+        ("shelves", near_empty, stock_levels.low_stock_threshold, media_type),
+        ["inventory"],
+        lambda: serialize_response(_shelf_summaries(near_empty), accept),
+        _offload_aggregate()
+    )
+    response.headers["ETag"] = etag
+    response.headers["Vary"] = "Accept"
+    return response
+
+def _offload_aggregate() -> bool:
+    # numpy aggregates take milliseconds even for a million items, and would
+    # wait for the GIL between every numpy call on a worker thread; the first
+    # one imports numpy, and the Python fallback is a hundred times slower
+    return not vectorized() or offload_build()
+
+def _shelf_summaries(near_empty: Optional[bool]) -> list:
+    # Items that were never placed have an empty shelf_id and are not a shelf
+    shelves = [group for group in inventory.stats(stock_levels.low_stock_threshold, "shelf_id")["groups"] if group["shelf_id"]]
+    if near_empty:
+        shelves = [group for group in shelves if group["empty"] + group["low_stock"] == group["items"]]
+    return shelves
+
+@router.get("/shelves/{shelf_id}", response_model=List[Inventory], summary="Get the inventory on a shelf", description="Retrieve all inventory items on a specific shelf, in medication ID order. Also supports cursor-based paging.")
+async def get_shelf_inventory(
+    request: Request,
+    shelf_id: str,
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of inventory items to return"),
+    cursor: Optional[str] = Query(None, description="Cursor from the previous page's Link header"),
+    if_none_match: Optional[str] = Header(None, description="Collection ETag value to check against the current ETag"),
+    accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
+):
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    media_type = response_media_type(accept)
+    etag = collection_etag(collection_digests["inventory"], "shelf", shelf_id, limit, after, media_type)
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
+    response = await cached_response_async(
+        ("shelf", shelf_id, limit, after, media_type),
+        ["inventory"],
+        lambda: _list_shelf(request, shelf_id, limit, after, accept),
+        offload_build(encoded=len(inventory) if limit is None else 0)
+    )
+    response.headers["ETag"] = etag
+    response.headers["Vary"] = "Accept"
+    return response
+
+def _list_shelf(request: Request, shelf_id: str, limit: Optional[int], after: Optional[int], accept: str):
+    wait_for_index("inventory")
+    matched_ids = shelf_items.ids(shelf_id)
+    if not matched_ids:
+        raise HTTPException(status_code=404, detail="No inventory found on this shelf")
+    page = page_after(matched_ids, after, len(matched_ids) if limit is None else limit + 1)
+    response = serialize_records([(inventory[med_id], inventory_json[med_id]) for med_id in page[:limit]], accept, Inventory)
+    if limit is not None and len(page) > limit:
+        set_next_page_headers(response, request, page[limit - 1])
+    return response
 
 @router.get("/{med_id}", response_model=Inventory, summary="Get an inventory item", description="Retrieve a specific inventory item by medication ID.")
-def get_inventory_item(
+async def get_inventory_item(
     med_id: int, 
     if_none_match: Optional[str] = Header(None, description="ETag value to check against the current ETag"),
     accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
@@ -30,47 +196,137 @@ def get_inventory_item(
     if inv is None:
         raise HTTPException(status_code=404, detail="Inventory for this medication not found")
     
-    etag = generate_etag(inv)
-    if if_none_match == etag:
-        return Response(status_code=304)
+    etag = inventory_etags[med_id]
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
     
-    response = serialize_response(inv.dict(), accept)
+    response = cached_response(
+        ("inventory_item", med_id, response_media_type(accept)),
+        [("inventory", med_id)],
+        lambda: serialize_response(inv, accept, Inventory, inventory_json[med_id])
+    )
     response.headers["ETag"] = etag
     return response
 
 @router.put("/{med_id}", response_model=Inventory, summary="Update an inventory item", description="Update the inventory details for a specific medication.")
-def update_inventory(
+async def update_inventory(
     med_id: int, 
     updated_inventory: Inventory = Body(..., description="Updated inventory details"),  # Accept JSON payload
     if_match: Optional[str] = Header(None, description="ETag value to check against the current ETag"),
     accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
 ):
-    if med_id not in medications:
-        raise HTTPException(status_code=404, detail="Medication not found")
-    
-    inv = inventory.get(med_id)
-    if inv:
-        current_etag = generate_etag(inv)
-        if if_match != current_etag:
-            raise HTTPException(status_code=412, detail="Precondition Failed")
-        # Update inventory details
-        inv.quantity = updated_inventory.quantity
-        inv.shelf_id = updated_inventory.shelf_id
-        inv.shelf_location = updated_inventory.shelf_location
-    else:
-        # Create a new inventory item if it doesn't exist
-        inventory[med_id] = updated_inventory
-        inv = updated_inventory
-
-    # Update Prometheus metric
-    INVENTORY_GAUGE.labels(
-        medication_id=med_id, 
-        shelf_id=inv.shelf_id, 
-        shelf_location=inv.shelf_location
-    ).set(inv.quantity)
-    
-    # Generate new ETag and prepare response
-    etag = generate_etag(inv)
-    response = serialize_response(inv.dict(), accept)
-    response.headers["ETag"] = etag
-    return response
\ No newline at end of file
+    def write():
+        # Checked and saved under the item's lock, so two writers with the
+        # same If-Match cannot both succeed and a concurrent delete of the
+        # medication is either seen or waited for
+        if med_id not in medications:
+            raise HTTPException(status_code=404, detail="Medication not found")
+
+        previous = inventory.get(med_id)
+        if previous:
+            if not etag_matches(if_match, inventory_etags[med_id], weak=False):
+                raise HTTPException(status_code=412, detail="Precondition Failed")
+            # Update inventory details
+            inv = previous.copy(update={
+                "quantity": updated_inventory.quantity,
+                "shelf_id": updated_inventory.shelf_id,
+                "shelf_location": updated_inventory.shelf_location
+            })
+        else:
+            # Create a new inventory item if it doesn't exist
+            inv = updated_inventory
+        save_inventory(med_id, inv, expected=previous)
+
+        # Update Prometheus metric, moving the series if the item changed shelves
+        set_inventory_gauge(med_id, inv, previous)
+
+        # Prepare response with the ETag computed by save_inventory
+        response = serialize_response(inv, accept, Inventory, inventory_json[med_id])
+        response.headers["ETag"] = inventory_etags[med_id]
+        return response
+
+    return await run_locked_write([med_id], write)
+
+@router.patch("/", summary="Update inventory items in bulk", description="Apply a list of inventory updates, sent as a JSON array or as NDJSON. Each item may carry its own if_match ETag. With atomic=true either every update is applied or none is.")
+async def update_inventory_batch(
+    request: Request,
+    atomic: bool = Query(False, description="Apply all updates or none of them"),
+    accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
+):
+    try:
+        payload = await _read_batch(request)
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Request body must be a JSON array or NDJSON")
+    if len(payload) > MAX_BATCH_SIZE:
+        raise HTTPException(status_code=413, detail=f"Batches are limited to {MAX_BATCH_SIZE} items")
+
+    # Items are parsed up front; they are checked and saved while holding the
+    # locks of every id in the batch
+    updates = []
+    for item in payload:
+        try:
+            updates.append(InventoryBatchItem.parse_obj(item))
+        except ValidationError as e:
+            med_id = item.get("medication_id") if isinstance(item, dict) else None
+            updates.append({"medication_id": med_id, "status": 422, "detail": e.errors()})
+    med_ids = [update.medication_id for update in updates if isinstance(update, InventoryBatchItem)]
+    return await run_locked_write(med_ids, lambda: _apply_batch(updates, atomic, accept), offload_build(encoded=len(med_ids)))
+
+def _apply_batch(updates: list, atomic: bool, accept: str):
+    # Single validation pass: every item is checked against the state it would
+    # see if the items before it were applied, nothing is written yet.
+    results = []
+    accepted = []
+    pending_etags = {}
+    previous = {}
+    for update in updates:
+        if isinstance(update, dict):
+            results.append(update)
+            continue
+        med_id = update.medication_id
+        if med_id not in medications:
+            results.append({"medication_id": med_id, "status": 404, "detail": "Medication not found"})
+            continue
+        if med_id not in previous:
+            previous[med_id] = inventory.get(med_id)
+        current_etag = pending_etags.get(med_id, inventory_etags.get(med_id))
+        if update.if_match is not None and (current_etag is None or not etag_matches(update.if_match, current_etag, weak=False)):
+            results.append({"medication_id": med_id, "status": 412, "detail": "Precondition Failed"})
+            continue
+        inv = Inventory(**update.dict(exclude={"if_match"}))
+        pending_etags[med_id] = generate_etag(inv)
+        results.append({"medication_id": med_id, "status": 200, "etag": pending_etags[med_id]})
+        accepted.append((inv, pending_etags[med_id]))
+
+    failed = len(accepted) < len(results)
+    if atomic and failed:
+        for result in results:
+            if result["status"] == 200:
+                result.update(status=424, detail="Failed Dependency")
+                del result["etag"]
+        response = serialize_response({"results": results}, accept)
+        response.status_code = 409
+        return response
+
+    # The store only takes the batch if none of its items changed meanwhile
+    save_inventory_many(((inv.medication_id, inv, etag) for inv, etag in accepted), {inv.medication_id: previous[inv.medication_id] for inv, _ in accepted})
+    _set_inventory_gauges((inv for inv, _ in accepted), previous)
+
+    response = serialize_response({"results": results}, accept)
+    response.status_code = 207 if failed else 200
+    return response
+
+async def _read_batch(request: Request) -> list:
+    body = await request.body()
+    if request.headers.get("content-type", "").startswith(NDJSON_MEDIA_TYPE):
+        return [json.loads(line) for line in body.splitlines() if line.strip()]
+    payload = json.loads(body)
+    if not isinstance(payload, list):
+        raise ValueError("Expected a JSON array")
+    return payload
+
+def _set_inventory_gauges(items, previous: dict):
+    # Only the final state of each medication in the batch is exported
+    latest = {inv.medication_id: inv for inv in items}
+    for med_id, inv in latest.items():
+        set_inventory_gauge(med_id, inv, previous.get(med_id))
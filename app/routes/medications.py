@@ -1,40 +1,116 @@
-from fastapi import APIRouter, HTTPException, Header, Response, Query, UploadFile, File
+from fastapi import APIRouter, HTTPException, Header, Request, Response, Query, UploadFile, File
 from typing import Optional, List
 import hashlib
 import re
-import os
 
 from app.models import Medication, Inventory
-from app.utils import serialize_response, generate_etag, IMAGE_DIR
+from app.utils import serialize_response, serialize_records, stream_response, LIST_MEDIA_TYPES, response_media_type, collection_etag, etag_matches, NDJSON_MEDIA_TYPE
+from app.icons import ICON_MEDIA_TYPES, store_icon, icon_etag, icon_response, delete_icon_file
+from app.thumbnails import ICON_SIZES, schedule_derivatives, ready_derivative
+from app.cache import cached_response, cached_response_async
+from app.changes import change_log
+from app.pagination import MAX_PAGE_SIZE, decode_cursor, iter_ids, page_after, set_next_page_headers
 from app.routes.inventory import inventory
-from app.metrics import INVENTORY_GAUGE  # Updated import
-from app.data import medications, inventory  # Import data and initialization
-from fastapi.responses import Response as FastAPIResponse  # Fix import for FastAPIResponse
+from app.metrics import set_inventory_gauge, remove_inventory_gauge
+from app.data import medications, inventory, medication_ids, medication_names, stock_levels, medication_etags, medication_json, collection_digests, icon_refs, run_locked_write, wait_for_index, offload_build, save_medication, remove_medication, save_inventory, remove_inventory  # Import data and initialization
+from app.stock import EMPTY
+from app.search import REGEX_TIMEOUT, PatternTooComplex, SearchTimeout
+from app.tracing import TimedRoute, run_in_threadpool, run_offloaded
 
-router = APIRouter()
+router = APIRouter(route_class=TimedRoute)
 
-@router.get("/", response_model=List[Medication], summary="Get all medications", description="Retrieve all medications or search medications by name using a regex pattern. Also supports querying for out-of-stock medications.")
-def get_medications(
+@router.get("/", response_model=List[Medication], summary="Get all medications", description="Retrieve all medications or search medications by name using a regex pattern. Also supports querying for out-of-stock medications, cursor-based paging and streaming.")
+async def get_medications(
+    request: Request,
     regex: Optional[str] = Query(None, description="Regex pattern to search medication names"),
+    ignore_case: Optional[bool] = Query(None, description="Match the regex pattern case-insensitively"),
     out_of_stock: Optional[bool] = Query(None, description="Filter for out-of-stock medications"),
-    accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
+    limit: Optional[int] = Query(None, ge=1, le=MAX_PAGE_SIZE, description="Maximum number of medications to return"),
+    cursor: Optional[str] = Query(None, description="Cursor from the previous page's Link header"),
+    stream: Optional[bool] = Query(None, description="Stream the medications as NDJSON (or incrementally written XML)"),
+    if_none_match: Optional[str] = Header(None, description="Collection ETag value to check against the current ETag"),
+    accept: str = Header("application/json", description="Specify the response format (application/json, application/x-ndjson or application/xml)")
 ):
+    try:
+        after = decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+    media_type = response_media_type(accept, LIST_MEDIA_TYPES)
+    if stream or media_type == NDJSON_MEDIA_TYPE:
+        ids = await run_offloaded(bool(regex) or offload_build(), _matching_ids, regex, ignore_case, out_of_stock)
+        if limit is None:
+            page = iter_ids(medication_ids.after, after) if ids is None else page_after(ids, after, len(ids))
+        else:
+            ids = medication_ids.after(after, limit + 1) if ids is None else page_after(ids, after, limit + 1)
+            page = ids[:limit]
+        records = ((medications[med_id], medication_json[med_id]) for med_id in page if med_id in medications)
+        response = stream_response(records, accept, Medication)
+        if limit is not None and len(ids) > limit:
+            set_next_page_headers(response, request, ids[limit - 1])
+        response.headers["Vary"] = "Accept"
+        return response
+
+    etag = collection_etag(
+        collection_digests["medications"],
+        collection_digests["inventory"] if out_of_stock else None,
+        regex, ignore_case, out_of_stock, limit, after, media_type
+    )
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag, "Vary": "Accept"})
+    response = await cached_response_async(
+        ("medications", regex, ignore_case, out_of_stock, limit, after, media_type),
+        ["medications", "inventory"] if out_of_stock else ["medications"],
+        lambda: _list_medications(request, regex, ignore_case, out_of_stock, limit, after, media_type),
+        bool(regex) or offload_build(encoded=len(medications) if limit is None else 0)
+    )
+    response.headers["ETag"] = etag
+    response.headers["Vary"] = "Accept"
+    return response
+
+def _matching_ids(regex: Optional[str], ignore_case: Optional[bool], out_of_stock: Optional[bool]):
+    # Sorted ids for a filtered listing, or None for the whole collection
     if out_of_stock:
-        matched_medications = [med.dict() for med_id, med in medications.items() if inventory[med_id].quantity == 0]
-        if not matched_medications:
+        wait_for_index("inventory")
+        matched_ids = [med_id for med_id in stock_levels.ids(EMPTY) if med_id in medications]
+        if not matched_ids:
             raise HTTPException(status_code=404, detail="No out-of-stock medications found")
-        return serialize_response(matched_medications, accept)
+        return matched_ids
 
     if regex:
-        matched_medications = [med.dict() for med in medications.values() if re.search(regex, med.name)]
-        if not matched_medications:
+        wait_for_index("names")
+        try:
+            matched_ids = medication_names.search(regex, re.IGNORECASE if ignore_case else 0, REGEX_TIMEOUT)
+        except re.error:
+            raise HTTPException(status_code=400, detail="Invalid regex pattern")
+        except PatternTooComplex as e:
+            raise HTTPException(status_code=400, detail=f"Regex pattern too complex: {e}")
+        except SearchTimeout:
+            raise HTTPException(status_code=400, detail="Regex search took too long")
+        if not matched_ids:
             raise HTTPException(status_code=404, detail="No medications found matching the search criteria")
-        return serialize_response(matched_medications, accept)
+        return matched_ids
+
+    return None
 
-    return serialize_response([med.dict() for med in medications.values()], accept)
+def _list_medications(request: Request, regex: Optional[str], ignore_case: Optional[bool], out_of_stock: Optional[bool], limit: Optional[int], after: Optional[int], accept: str):
+    seq = change_log.last_seq
+    matched_ids = _matching_ids(regex, ignore_case, out_of_stock)
+    if limit is None:
+        page = medication_ids.all() if matched_ids is None else page_after(matched_ids, after, len(matched_ids))
+        response = serialize_records([(medications[med_id], medication_json[med_id]) for med_id in page], accept, Medication)
+    else:
+        page = medication_ids.after(after, limit + 1) if matched_ids is None else page_after(matched_ids, after, limit + 1)
+        response = serialize_records([(medications[med_id], medication_json[med_id]) for med_id in page[:limit]], accept, Medication)
+        if len(page) > limit:
+            set_next_page_headers(response, request, page[limit - 1])
+    # Every change up to this seq is reflected in the listing, so a client
+    # that reloads it can resume GET /changes from there
+    response.headers["X-Change-Seq"] = str(seq)
+    return response
 
 @router.get("/{med_id}", response_model=Medication, summary="Get a medication by ID", description="Retrieve a specific medication by its ID.")
-def get_medication(
+async def get_medication(
     med_id: int, 
     response: Response, 
     if_none_match: Optional[str] = Header(None, description="ETag value to check against the current ETag"),
@@ -44,112 +120,173 @@ def get_medication(
     if medication is None:
         raise HTTPException(status_code=404, detail="Medication not found")
     
-    etag = generate_etag(medication)
-    if if_none_match == etag:
-        response.status_code = 304
-        return
+    etag = medication_etags[med_id]
+    if etag_matches(if_none_match, etag):
+        return Response(status_code=304, headers={"ETag": etag})
     
     response.headers["ETag"] = etag
-    re: Response = serialize_response(medication.dict(), accept)
+    re: Response = cached_response(
+        ("medication", med_id, response_media_type(accept)),
+        [("medication", med_id)],
+        lambda: serialize_response(medication, accept, Medication, medication_json[med_id])
+    )
     re.headers["ETag"] = etag
     return re
 
 
 @router.post("/", response_model=Medication, summary="Create a new medication", description="Create a new medication with the given details.")
-def create_medication(
+async def create_medication(
     medication: Medication, 
     response: Response,
     accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
 ):
-    if medication.id in medications:
-        raise HTTPException(status_code=400, detail="Medication with this ID already exists")
-    
-    # Add medication to the medications dictionary
-    medications[medication.id] = medication
-    
-    # Add a new inventory item for the medication
-    inventory[medication.id] = Inventory(
-        medication_id=medication.id, 
-        quantity=0, 
-        shelf_id="", 
-        shelf_location=""
-    )
-    
-    # Initialize the Prometheus metric for the new inventory item
-    INVENTORY_GAUGE.labels(medication_id=medication.id, shelf_id="", shelf_location="").set(0)
-    
-    # Set the ETag header
-    response.headers["ETag"] = generate_etag(medication)
-    
-    return serialize_response(medication.dict(), accept)
+    def write():
+        if medication.id in medications:
+            raise HTTPException(status_code=400, detail="Medication with this ID already exists")
+
+        # Add medication to the medications dictionary and the name index
+        save_medication(medication.id, medication, expected=None)
+
+        # Add a new inventory item for the medication
+        save_inventory(medication.id, Inventory(
+            medication_id=medication.id,
+            quantity=0,
+            shelf_id="",
+            shelf_location=""
+        ))
+
+        # Initialize the Prometheus metric for the new inventory item
+        set_inventory_gauge(medication.id, inventory[medication.id])
+
+        # Set the ETag header
+        created = serialize_response(medication, accept, Medication, medication_json[medication.id])
+        created.headers["ETag"] = medication_etags[medication.id]
+        return created
+
+    return await run_locked_write([medication.id], write)
 
 @router.put("/{med_id}", response_model=Medication, summary="Update a medication", description="Update an existing medication by its ID.")
-def update_medication(
+async def update_medication(
     med_id: int, 
     updated_medication: Medication, 
     response: Response, 
     if_match: Optional[str] = Header(None, description="ETag value to check against the current ETag"),
     accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
 ):
-    medication = medications.get(med_id)
-    if medication is None:
-        raise HTTPException(status_code=404, detail="Medication not found")
-    
-    current_etag = generate_etag(medication)
-    if if_match != current_etag:
-        raise HTTPException(status_code=412, detail="Precondition Failed")
+    def write():
+        # Checked and saved under the medication's lock, so two writers with
+        # the same If-Match cannot both succeed
+        medication = medications.get(med_id)
+        if medication is None:
+            raise HTTPException(status_code=404, detail="Medication not found")
 
-    medications[med_id] = updated_medication
-    response.headers["ETag"] = generate_etag(updated_medication)
-    return serialize_response(updated_medication.dict(), accept)
+        if not etag_matches(if_match, medication_etags[med_id], weak=False):
+            raise HTTPException(status_code=412, detail="Precondition Failed")
+
+        # Icons are managed by the icon endpoints
+        updated_medication.icon_url = medication.icon_url
+        updated_medication._icon_file = medication._icon_file
+        save_medication(med_id, updated_medication, expected=medication)
+        updated = serialize_response(updated_medication, accept, Medication, medication_json[med_id])
+        updated.headers["ETag"] = medication_etags[med_id]
+        return updated
+
+    return await run_locked_write([med_id], write)
 
 @router.delete("/{med_id}", response_model=Medication, summary="Delete a medication", description="Delete a medication by its ID.")
-def delete_medication(
+async def delete_medication(
     med_id: int,
     accept: str = Header("application/json", description="Specify the response format (application/json or application/xml)")
 ):
-    medication = medications.pop(med_id, None)
-    if medication is None:
-        raise HTTPException(status_code=404, detail="Medication not found")
-    inventory.pop(med_id, None)  # Also remove from inventory
-    return serialize_response(medication.dict(), accept)
+    def write():
+        medication = remove_medication(med_id)
+        if medication is None:
+            raise HTTPException(status_code=404, detail="Medication not found")
+        inv = remove_inventory(med_id)  # Also remove from inventory
+        if inv is not None:
+            remove_inventory_gauge(med_id, inv)
+        return medication
+
+    medication = await run_locked_write([med_id], write)
+    if medication._icon_file is not None:
+        await run_in_threadpool(_release_icon, medication._icon_file)
+    return serialize_response(medication, accept, Medication)
 
 @router.post("/{med_id}/icon", response_model=dict, summary="Upload an icon for a medication", description="Upload an icon image for a specific medication. Supported file types are: jpg, jpeg, png, tiff.")
 async def upload_medication_icon(med_id: int, file: UploadFile = File(...)):
-    medication = medications.get(med_id)
-    if medication is None:
+    if med_id not in medications:
         raise HTTPException(status_code=404, detail="Medication not found")
     
     file_extension = file.filename.split('.')[-1].lower()
-    if file_extension not in ["jpg", "jpeg", "png", "tiff"]:
+    if file_extension not in ICON_MEDIA_TYPES:
         raise HTTPException(status_code=400, detail="Unsupported file type. Supported types are: jpg, jpeg, png, tiff.")
     
-    file_location = f"{IMAGE_DIR}/{med_id}.{file_extension}"
-    with open(file_location, "wb") as f:
-        f.write(await file.read())
-    
-    medication.icon_url = f"/medications/{med_id}/icon"
-    return {"message": "Icon uploaded successfully", "icon_url": medication.icon_url}
+    # Streamed to disk in chunks on a worker thread, stored under its content hash
+    icon_file = await store_icon(file, file_extension)
+
+    # Re-read the medication under its lock: it may have changed while the
+    # upload was stored
+    def write():
+        medication = medications.get(med_id)
+        if medication is None:
+            return None, None
+        updated = medication.copy(update={"icon_url": f"/medications/{med_id}/icon"})
+        updated._icon_file = icon_file
+        save_medication(med_id, updated, expected=medication)
+        return medication._icon_file, updated
 
-@router.get("/{med_id}/icon", summary="Get the icon for a medication", description="Retrieve the uploaded icon image for a specific medication.")
-async def get_image(med_id: int):
-    for extension in ["jpg", "jpeg", "png", "tiff"]:
-        file_location = f"{IMAGE_DIR}/{med_id}.{extension}"
-        if os.path.exists(file_location):
-            return FastAPIResponse(content=open(file_location, "rb").read(), media_type=f"image/{extension}")
-    raise HTTPException(status_code=404, detail="Image not found")
+    previous_icon, updated = await run_locked_write([med_id], write)
+    if updated is None:
+        await run_in_threadpool(_release_icon, icon_file)
+        raise HTTPException(status_code=404, detail="Medication not found")
+    if previous_icon is not None and previous_icon != icon_file:
+        await run_in_threadpool(_release_icon, previous_icon)
+    # Thumbnails are rendered in a background process pool
+    schedule_derivatives(icon_file)
+    return {"message": "Icon uploaded successfully", "icon_url": updated.icon_url}
+
+@router.get("/{med_id}/icon", summary="Get the icon for a medication", description="Retrieve the uploaded icon image for a specific medication, or a pre-generated WebP thumbnail of it. Supports If-None-Match and single byte ranges.")
+async def get_image(
+    med_id: int,
+    size: Optional[int] = Query(None, description="Thumbnail size in pixels (64, 128 or 256); the original is served until the thumbnail is ready"),
+    if_none_match: Optional[str] = Header(None, description="ETag value to check against the current ETag"),
+    range: Optional[str] = Header(None, description="Single byte range, e.g. bytes=0-1023")
+):
+    medication = medications.get(med_id)
+    if medication is None or medication._icon_file is None:
+        raise HTTPException(status_code=404, detail="Image not found")
+    icon_file = medication._icon_file
+    if size is not None:
+        if size not in ICON_SIZES:
+            raise HTTPException(status_code=400, detail="Unsupported icon size. Supported sizes are: 64, 128, 256.")
+        icon_file = await ready_derivative(icon_file, size) or icon_file
+    if etag_matches(if_none_match, icon_etag(icon_file)):
+        return Response(status_code=304, headers={"ETag": icon_etag(icon_file)})
+    return await icon_response(icon_file, range)
 
 @router.delete("/{med_id}/icon", summary="Delete the icon for a medication", description="Delete the uploaded icon image for a specific medication.")
 async def delete_medication_icon(med_id: int):
-    medication = medications.get(med_id)
-    if medication is None:
-        raise HTTPException(status_code=404, detail="Medication not found")
-    
-    # Check and delete the icon file
-    for extension in ["jpg", "jpeg", "png", "tiff"]:
-        file_location = f"{IMAGE_DIR}/{med_id}.{extension}"
-        if os.path.exists(file_location):
-            os.remove(file_location)
-            return {"message": "Icon deleted successfully"}
-    
-    raise HTTPException(status_code=404, detail="Icon not found")
\ No newline at end of file
+    def write():
+        medication = medications.get(med_id)
+        if medication is None:
+            raise HTTPException(status_code=404, detail="Medication not found")
+
+        icon_file = medication._icon_file
+        if icon_file is None:
+            raise HTTPException(status_code=404, detail="Icon not found")
+
+        updated = medication.copy(update={"icon_url": None})
+        updated._icon_file = None
+        save_medication(med_id, updated, expected=medication)
+        return icon_file
+
+    icon_file = await run_locked_write([med_id], write)
+    await run_in_threadpool(_release_icon, icon_file)
+    return {"message": "Icon deleted successfully"}
+
+def _release_icon(icon_file: str):
+    # Identical uploads share a file; only delete it once nothing references
+    # it, and its derivatives once no file with the same content hash does
+    if icon_file not in icon_refs:
+        digest = icon_file.split(".")[0]
+        delete_icon_file(icon_file, derivatives=not any(name.split(".")[0] == digest for name in list(icon_refs)))
@@ -0,0 +1,272 @@
+import os
+import re
+import time
+from collections import defaultdict
+from functools import lru_cache
+
+import regex
+
+try:
+    import re._parser as sre_parse  # Python 3.11+
+except ImportError:  # pragma: no cover
+    import sre_parse
+
+PATTERN_CACHE_SIZE = 256
+
+# Longest pattern a search accepts
+MAX_PATTERN_LENGTH = 256
+# Seconds a search may spend matching names before it gives up. Matching uses
+# the regex module rather than re because it can time out within a single
+# match, which is where catastrophic backtracking spends its time.
+REGEX_TIMEOUT = float(os.environ.get("REGEX_TIMEOUT", "1.0"))
+
+# Names are indexed with two start and two end markers so that anchored
+# queries of any length ("^A", "n$") still produce at least one trigram.
+START = "\x02\x02"
+END = "\x03\x03"
+
+
+class PatternTooComplex(ValueError):
+    """The pattern is too long or could backtrack exponentially."""
+
+
+class SearchTimeout(Exception):
+    """Matching the candidates took longer than the search's timeout."""
+
+
+# The body of a {m,n} repetition; regex reads any other braced text after
+# an item as a fuzzy matching constraint ("{e<=1}") where re reads literals
+_REPEAT_BODY = re.compile(r"\d*,?\d*")
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def compile_pattern(pattern: str, flags: int = 0) -> regex.Pattern:
+    # re flags have the same values in regex, whose default (VERSION0)
+    # syntax is re's except where check_dialect refuses the pattern
+    return regex.compile(pattern, flags)
+
+
+def check_dialect(pattern: str):
+    # Raises re.error for a pattern that re, which the index and the checks
+    # below parse it with, and regex, which matches it, would read
+    # differently: POSIX classes in a set ("[[:alpha:]]") and fuzzy
+    # constraints ("(ab){e<=1}") are literal characters to re
+    i = 0
+    in_set = False
+    while i < len(pattern):
+        char = pattern[i]
+        if char == "\\":
+            i += 2
+            continue
+        if in_set:
+            if char == "]" and i > set_start:
+                in_set = False
+            elif char == "[" and pattern[i + 1:i + 2] == ":":
+                raise re.error("POSIX character classes are not supported", pattern, i)
+        elif char == "[":
+            in_set = True
+            # A "]" right after "[" or "[^" is a member rather than the end
+            set_start = i + 2 if pattern[i + 1:i + 2] == "^" else i + 1
+        elif char == "{":
+            end = pattern.find("}", i)
+            if end != -1 and not _REPEAT_BODY.fullmatch(pattern, i + 1, end):
+                raise re.error("fuzzy matching is not supported", pattern, i)
+        i += 1
+
+
+def _is_plain(text: str) -> bool:
+    return text.isascii() and text.isprintable()
+
+
+def _trigrams(text: str) -> set:
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def _literal_runs(items, runs: list, current: list) -> list:
+    # Walks a parsed pattern sequence and collects runs of consecutive literal
+    # characters that every match must contain. Anything that is not a plain
+    # literal, a group or an anchor ends the current run.
+    for op, av in items:
+        if op is sre_parse.LITERAL and _is_plain(chr(av)):
+            current.append(chr(av).lower())
+        elif op is sre_parse.SUBPATTERN:
+            current = _literal_runs(av[-1], runs, current)
+        elif op is sre_parse.AT and av in (sre_parse.AT_BEGINNING, sre_parse.AT_BEGINNING_STRING):
+            runs.append("".join(current))
+            current = [START]
+        elif op is sre_parse.AT and av in (sre_parse.AT_END, sre_parse.AT_END_STRING):
+            current.append(END)
+            runs.append("".join(current))
+            current = []
+        else:
+            runs.append("".join(current))
+            current = []
+    return current
+
+
+_REPEATS = (sre_parse.MAX_REPEAT, sre_parse.MIN_REPEAT)
+
+
+def _children(op, av) -> list:
+    # The sequences nested in a parsed node
+    if op is sre_parse.SUBPATTERN:
+        return [av[-1]]
+    if op is sre_parse.BRANCH:
+        return av[1]
+    if op in _REPEATS or op is getattr(sre_parse, "POSSESSIVE_REPEAT", None):
+        return [av[2]]
+    if op in (sre_parse.ASSERT, sre_parse.ASSERT_NOT):
+        return [av[1]]
+    if op is sre_parse.GROUPREF_EXISTS:
+        return [item for item in av[1:] if item is not None]
+    if op is getattr(sre_parse, "ATOMIC_GROUP", None):
+        return [av]
+    return []
+
+
+def _first_chars(items):
+    # Lowercased characters a match of the sequence can start with, or None
+    # when that is not a small known set
+    for op, av in items:
+        if op is sre_parse.AT:
+            continue
+        if op is sre_parse.LITERAL:
+            return {chr(av).lower()}
+        if op is sre_parse.IN:
+            chars = set()
+            for item_op, item_av in av:
+                if item_op is sre_parse.LITERAL:
+                    chars.add(chr(item_av).lower())
+                elif item_op is sre_parse.RANGE and item_av[1] - item_av[0] < 256:
+                    chars.update(chr(c).lower() for c in range(item_av[0], item_av[1] + 1))
+                else:
+                    return None
+            return chars
+        if op is sre_parse.SUBPATTERN:
+            return _first_chars(av[-1])
+        if op in _REPEATS and av[0] > 0:
+            return _first_chars(av[2])
+        return None
+    return None
+
+
+def _overlapping(alternatives) -> bool:
+    seen = set()
+    for alternative in alternatives:
+        chars = _first_chars(alternative)
+        if chars is None or chars & seen:
+            return True
+        seen |= chars
+    return False
+
+
+def _check_backtracking(items, repeated: bool):
+    # Inside a repetition, a quantifier of variable width or alternatives
+    # that can start alike give the matcher exponentially many ways to split
+    # a name that does not match: (a+)+, (\w+\s?)*, (a|ab)*
+    for op, av in items:
+        if op in _REPEATS:
+            if repeated and av[0] != av[1]:
+                raise PatternTooComplex("nested quantifiers")
+            _check_backtracking(av[2], repeated or av[1] > 1)
+        elif op is sre_parse.BRANCH:
+            if repeated and _overlapping(av[1]):
+                raise PatternTooComplex("repeated alternatives that overlap")
+            for alternative in av[1]:
+                _check_backtracking(alternative, repeated)
+        else:
+            for child in _children(op, av):
+                _check_backtracking(child, repeated)
+
+
+@lru_cache(maxsize=PATTERN_CACHE_SIZE)
+def check_pattern(pattern: str, flags: int = 0):
+    # Raises re.error for an invalid pattern or one re and regex read
+    # differently, and PatternTooComplex for one a
+    # search refuses rather than let it spend REGEX_TIMEOUT; the check errs
+    # on the side of refusing
+    if len(pattern) > MAX_PATTERN_LENGTH:
+        raise PatternTooComplex(f"longer than {MAX_PATTERN_LENGTH} characters")
+    check_dialect(pattern)
+    _check_backtracking(sre_parse.parse(pattern, flags), False)
+
+
+def required_literals(pattern: str, flags: int = 0) -> list:
+    runs = []
+    runs.append("".join(_literal_runs(sre_parse.parse(pattern, flags), runs, [])))
+    return [run for run in runs if len(run) >= 3]
+
+
+class NameIndex:
+    """Trigram index over medication names used to prune regex searches.
+
+    Names that are not printable ASCII are never indexed and are always
+    returned as candidates, so case folding can only ever widen the candidate
+    set and the final regex check stays authoritative.
+    """
+
+    def __init__(self):
+        self._names = {}
+        self._postings = defaultdict(set)
+        self._unindexed = set()
+
+    def __len__(self) -> int:
+        return len(self._names)
+
+    def add(self, med_id: int, name: str):
+        if med_id in self._names:
+            self.remove(med_id)
+        self._names[med_id] = name
+        if not _is_plain(name):
+            self._unindexed.add(med_id)
+            return
+        for gram in _trigrams(f"{START}{name.lower()}{END}"):
+            self._postings[gram].add(med_id)
+
+    def remove(self, med_id: int):
+        name = self._names.pop(med_id, None)
+        if name is None:
+            return
+        if med_id in self._unindexed:
+            self._unindexed.discard(med_id)
+            return
+        for gram in _trigrams(f"{START}{name.lower()}{END}"):
+            postings = self._postings[gram]
+            postings.discard(med_id)
+            if not postings:
+                del self._postings[gram]
+
+    def clear(self):
+        self._names.clear()
+        self._postings.clear()
+        self._unindexed.clear()
+
+    def candidates(self, pattern: str, flags: int = 0) -> set:
+        grams = set()
+        for run in required_literals(pattern, flags):
+            grams |= _trigrams(run)
+        if not grams:
+            return set(self._names)
+        postings = sorted((self._postings.get(gram, set()) for gram in grams), key=len)
+        return postings[0].intersection(*postings[1:]) | self._unindexed
+
+    def search(self, pattern: str, flags: int = 0, timeout: float = None) -> list:
+        # Raises SearchTimeout once matching has taken longer than timeout
+        check_pattern(pattern, flags)
+        compiled = compile_pattern(pattern, flags)
+        names = self._names
+        if timeout is None:
+            return sorted(med_id for med_id in self.candidates(pattern, flags) if compiled.search(names[med_id]))
+        deadline = time.monotonic() + timeout
+        matched = []
+        try:
+            for med_id in self.candidates(pattern, flags):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise SearchTimeout()
+                if compiled.search(names[med_id], timeout=remaining):
+                    matched.append(med_id)
+        except TimeoutError:
+            raise SearchTimeout() from None
+        matched.sort()
+        return matched
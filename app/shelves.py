@@ -0,0 +1,39 @@
+class ShelfIndex:
+    """Medication ids per shelf_id, so shelf lookups never scan the inventory."""
+
+    def __init__(self):
+        self._shelf = {}
+        self._items = {}
+
+    def set(self, med_id: int, shelf_id: str):
+        previous = self._shelf.get(med_id)
+        if previous == shelf_id:
+            return
+        if previous is not None:
+            self._discard(previous, med_id)
+        self._shelf[med_id] = shelf_id
+        self._items.setdefault(shelf_id, set()).add(med_id)
+
+    def remove(self, med_id: int):
+        shelf_id = self._shelf.pop(med_id, None)
+        if shelf_id is not None:
+            self._discard(shelf_id, med_id)
+
+    def _discard(self, shelf_id: str, med_id: int):
+        items = self._items[shelf_id]
+        items.discard(med_id)
+        if not items:
+            del self._items[shelf_id]
+
+    def clear(self):
+        self._shelf.clear()
+        self._items.clear()
+
+    def shelf_of(self, med_id: int):
+        return self._shelf.get(med_id)
+
+    def ids(self, shelf_id: str) -> list:
+        return sorted(self._items.get(shelf_id, ()))
+
+    def shelves(self) -> list:
+        return sorted(self._items)
@@ -0,0 +1,356 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+from array import array
+from bisect import bisect_left
+from collections.abc import MutableMapping
+
+from app.encoders import encode_json, decode_json
+from app.models import Medication, Inventory
+
+MAGIC = b"MEDSNAP1"
+# Magic, then offset and length of the JSON index at the end of the file
+HEADER = struct.Struct("<8sQQ")
+ALIGNMENT = 8
+
+_MISSING = object()
+
+
+def record_digest(fragment: bytes) -> bytes:
+    # The hash app.utils.json_etag hex-encodes into a record's ETag
+    return hashlib.blake2b(fragment, digest_size=16).digest()
+
+
+def write_snapshot(path: str, seq: int, previous, medications: dict, inventory: dict):
+    """Writes a new snapshot: `previous` (a Snapshot or None) with the changed
+    records in `medications` and `inventory` (id -> record, None for deleted).
+
+    Every column is a separately addressable section, so a reader can map the
+    file and use the columns in place. Runs of unchanged records are copied
+    from the previous snapshot section by section, so the cost depends on the
+    number of changes more than on the size of the store.
+    """
+    icons = dict(previous.icons) if previous is not None else {}
+    shelf_ids = _Codes(previous.shelf_ids if previous is not None else ())
+    shelf_locations = _Codes(previous.shelf_locations if previous is not None else ())
+    digests = dict(previous.digests) if previous is not None else {"medications": 0, "inventory": 0}
+
+    medication_sections = _Sections("medication", {})
+    for start, end, med_id, replaced in _merge(previous.medication_ids if previous is not None else (), medications):
+        if med_id is None:
+            medication_sections.copy(previous, start, end)
+            continue
+        if replaced is not None:
+            digests["medications"] ^= int.from_bytes(previous.medication_digest(replaced), "big")
+            icons.pop(med_id, None)
+        medication = medications[med_id]
+        if medication is not None:
+            digest = medication_sections.append(med_id, encode_json(medication))
+            digests["medications"] ^= int.from_bytes(digest, "big")
+            if medication._icon_file is not None:
+                icons[med_id] = medication._icon_file
+
+    inventory_sections = _Sections("inventory", INVENTORY_COLUMNS)
+    for start, end, med_id, replaced in _merge(previous.inventory_ids if previous is not None else (), inventory):
+        if med_id is None:
+            inventory_sections.copy(previous, start, end)
+            continue
+        if replaced is not None:
+            digests["inventory"] ^= int.from_bytes(previous.inventory_digest(replaced), "big")
+        inv = inventory[med_id]
+        if inv is not None:
+            digest = inventory_sections.append(
+                med_id, encode_json(inv), medication_id=inv.medication_id, quantity=inv.quantity,
+                shelf_id=shelf_ids.code(inv.shelf_id), shelf_location=shelf_locations.code(inv.shelf_location)
+            )
+            digests["inventory"] ^= int.from_bytes(digest, "big")
+
+    index = {
+        "seq": seq,
+        "sections": {},
+        "shelf_ids": shelf_ids.values,
+        "shelf_locations": shelf_locations.values,
+        "icons": {str(med_id): icon_file for med_id, icon_file in icons.items()},
+        # XOR of the record digests, as kept in app.data.collection_digests
+        "digests": digests,
+    }
+    with open(path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, 0, 0))
+        for name, data in (*medication_sections.sections(), *inventory_sections.sections()):
+            f.write(b"\0" * (-f.tell() % ALIGNMENT))
+            index["sections"][name] = [f.tell(), len(data)]
+            f.write(data)
+        encoded_index = json.dumps(index).encode()
+        index_offset = f.tell()
+        f.write(encoded_index)
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, index_offset, len(encoded_index)))
+        f.flush()
+        os.fsync(f.fileno())
+
+
+# Fixed-size columns of the inventory besides its ids, and their array types
+INVENTORY_COLUMNS = {"medication_id": "q", "quantity": "q", "shelf_id": "i", "shelf_location": "i"}
+
+
+def _merge(ids, changes: dict):
+    # In id order: (start, end, None, None) for each run of unchanged rows of
+    # the previous snapshot, and (None, None, id, row it replaces or None)
+    # for each changed id
+    position = 0
+    for med_id in sorted(changes):
+        i = bisect_left(ids, med_id, position)
+        if i > position:
+            yield position, i, None, None
+        replaced = i if i < len(ids) and ids[i] == med_id else None
+        yield None, None, med_id, replaced
+        position = i + 1 if replaced is not None else i
+    if position < len(ids):
+        yield position, len(ids), None, None
+
+
+class _Codes:
+    # Shelf codes of the previous snapshot stay valid in the new one
+    def __init__(self, values):
+        self.values = list(values)
+        self._codes = {value: code for code, value in enumerate(self.values)}
+
+    def code(self, value: str) -> int:
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        return code
+
+
+class _Sections:
+    # The sections of one collection while a snapshot is written
+    def __init__(self, prefix: str, columns: dict):
+        self.prefix = prefix
+        self.ids = array("q")
+        self.offsets = array("q", [0])
+        self.digests = bytearray()
+        self.json = bytearray()
+        self.columns = {name: array(typecode) for name, typecode in columns.items()}
+
+    def append(self, med_id: int, fragment: bytes, **values) -> bytes:
+        digest = record_digest(fragment)
+        self.ids.append(med_id)
+        self.json += fragment
+        self.offsets.append(len(self.json))
+        self.digests += digest
+        for name, value in values.items():
+            self.columns[name].append(value)
+        return digest
+
+    def copy(self, snapshot, start: int, end: int):
+        # Rows start to end of the same collection in an older snapshot
+        sections = snapshot.sections
+        offsets = sections[f"{self.prefix}_offsets"]
+        shift = len(self.json) - offsets[start]
+        self.ids.frombytes(sections[f"{self.prefix}_ids"][start:end].cast("B"))
+        self.json += sections[f"{self.prefix}_json"][offsets[start]:offsets[end]]
+        self.offsets.extend([offset + shift for offset in offsets[start + 1:end + 1]])
+        self.digests += sections[f"{self.prefix}_digests"][start * 16:end * 16]
+        for name, column in self.columns.items():
+            column.frombytes(sections[f"{self.prefix}_{name}"][start:end].cast("B"))
+
+    def sections(self):
+        yield f"{self.prefix}_ids", self.ids.tobytes()
+        for name, column in self.columns.items():
+            yield f"{self.prefix}_{name}", column.tobytes()
+        yield f"{self.prefix}_offsets", self.offsets.tobytes()
+        yield f"{self.prefix}_digests", bytes(self.digests)
+        yield f"{self.prefix}_json", bytes(self.json)
+
+
+class Snapshot:
+    """A snapshot file mapped into memory.
+
+    Columns are memoryviews into the mapping, so opening a snapshot costs the
+    same whatever its size; records are only decoded when asked for, and
+    the operating system pages the file in as they are.
+    """
+
+    def __init__(self, path: str):
+        with open(path, "rb") as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, index_offset, index_length = HEADER.unpack_from(self._mmap)
+        if magic != MAGIC or index_offset == 0:
+            raise ValueError(f"Not a complete snapshot: {path}")
+        index = json.loads(self._mmap[index_offset:index_offset + index_length])
+        view = memoryview(self._mmap)
+        typecodes = dict({f"inventory_{name}": typecode for name, typecode in INVENTORY_COLUMNS.items()},
+                         medication_ids="q", medication_offsets="q", inventory_ids="q", inventory_offsets="q")
+        self.sections = {}
+        for name, (offset, length) in index["sections"].items():
+            section = view[offset:offset + length]
+            self.sections[name] = section.cast(typecodes[name]) if name in typecodes else section
+
+        self.seq = index["seq"]
+        self.shelf_ids = index["shelf_ids"]
+        self.shelf_locations = index["shelf_locations"]
+        self.icons = {int(med_id): icon_file for med_id, icon_file in index["icons"].items()}
+        self.digests = index["digests"]
+        self.medication_ids = self.sections["medication_ids"]
+        self.inventory_ids = self.sections["inventory_ids"]
+        self.inventory_medication_id = self.sections["inventory_medication_id"]
+        self.inventory_quantity = self.sections["inventory_quantity"]
+        self.inventory_shelf_id = self.sections["inventory_shelf_id"]
+        self.inventory_shelf_location = self.sections["inventory_shelf_location"]
+        self._medication_offsets = self.sections["medication_offsets"]
+        self._medication_digests = self.sections["medication_digests"]
+        self._medication_json = self.sections["medication_json"]
+        self._inventory_offsets = self.sections["inventory_offsets"]
+        self._inventory_digests = self.sections["inventory_digests"]
+        self._inventory_json = self.sections["inventory_json"]
+
+    def medication_json(self, i: int) -> bytes:
+        return self._medication_json[self._medication_offsets[i]:self._medication_offsets[i + 1]].tobytes()
+
+    def medication_digest(self, i: int) -> bytes:
+        return self._medication_digests[i * 16:i * 16 + 16].tobytes()
+
+    def medication_etag(self, i: int) -> str:
+        return f'"{self._medication_digests[i * 16:i * 16 + 16].hex()}"'
+
+    def medication(self, i: int) -> Medication:
+        medication = Medication.construct(**decode_json(self.medication_json(i)))
+        medication._icon_file = self.icons.get(self.medication_ids[i])
+        return medication
+
+    def inventory_json(self, i: int) -> bytes:
+        return self._inventory_json[self._inventory_offsets[i]:self._inventory_offsets[i + 1]].tobytes()
+
+    def inventory_digest(self, i: int) -> bytes:
+        return self._inventory_digests[i * 16:i * 16 + 16].tobytes()
+
+    def inventory_etag(self, i: int) -> str:
+        return f'"{self._inventory_digests[i * 16:i * 16 + 16].hex()}"'
+
+    def inventory_item(self, i: int) -> Inventory:
+        return Inventory.construct(
+            medication_id=self.inventory_medication_id[i],
+            quantity=self.inventory_quantity[i],
+            shelf_id=self.shelf_ids[self.inventory_shelf_id[i]],
+            shelf_location=self.shelf_locations[self.inventory_shelf_location[i]]
+        )
+
+
+class RecordTable(MutableMapping):
+    """A dict that can be backed by a column of a snapshot.
+
+    attach() gives it a base: the snapshot's sorted ids and a function that
+    decodes the value at a position. Base values are found by binary search
+    and decoded on access (and kept, with cache=True); writes and deletions
+    go to an overlay and shadow the base. Without a base it is a thin wrapper
+    around a dict.
+    """
+
+    def __init__(self, cache: bool = False):
+        self._values = {}
+        self._cache = {} if cache else None
+        self._shadowed = set()
+        self._ids = ()
+        self._decode = None
+        self._lock = threading.Lock()
+
+    def attach(self, ids, decode):
+        self.clear()
+        self._ids = ids
+        self._decode = decode
+
+    def _base_index(self, key) -> int:
+        ids = self._ids
+        i = bisect_left(ids, key)
+        if i < len(ids) and ids[i] == key and key not in self._shadowed:
+            return i
+        return -1
+
+    def __getitem__(self, key):
+        try:
+            return self._values[key]
+        except KeyError:
+            pass
+        if self._cache is not None:
+            value = self._cache.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+        i = self._base_index(key)
+        if i < 0:
+            # Possibly written since the first lookup; KeyError otherwise
+            return self._values[key]
+        value = self._decode(i)
+        if self._cache is not None:
+            with self._lock:
+                if key not in self._shadowed:
+                    self._cache[key] = value
+        return value
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key) -> bool:
+        return key in self._values or self._base_index(key) >= 0
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            # The new value is visible before the base one is shadowed, so a
+            # concurrent reader always finds one of them
+            self._values[key] = value
+            if self._base_index(key) >= 0:
+                self._shadowed.add(key)
+                if self._cache is not None:
+                    self._cache.pop(key, None)
+
+    def __delitem__(self, key):
+        with self._lock:
+            in_base = self._base_index(key) >= 0
+            if in_base:
+                self._shadowed.add(key)
+                if self._cache is not None:
+                    self._cache.pop(key, None)
+            if self._values.pop(key, _MISSING) is _MISSING and not in_base:
+                raise KeyError(key)
+
+    def pop(self, key, default=_MISSING):
+        with self._lock:
+            value = self._values.pop(key, _MISSING)
+            i = self._base_index(key)
+            if i >= 0:
+                if value is _MISSING:
+                    value = self._cache.get(key, _MISSING) if self._cache is not None else _MISSING
+                    if value is _MISSING:
+                        value = self._decode(i)
+                self._shadowed.add(key)
+                if self._cache is not None:
+                    self._cache.pop(key, None)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        return value
+
+    def __len__(self) -> int:
+        return len(self._ids) - len(self._shadowed) + len(self._values)
+
+    def __iter__(self):
+        shadowed = self._shadowed
+        keys = [key for key in self._ids if key not in shadowed] if shadowed else list(self._ids)
+        keys.extend(list(self._values))
+        return iter(keys)
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            if self._cache is not None:
+                self._cache.clear()
+            self._shadowed.clear()
+            self._ids = ()
+            self._decode = None
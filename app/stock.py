@@ -0,0 +1,63 @@
+import os
+
+EMPTY = "empty"
+LOW = "low"
+IN_STOCK = "in_stock"
+
+LOW_STOCK_THRESHOLD = int(os.environ.get("LOW_STOCK_THRESHOLD", "10"))
+
+
+class StockIndex:
+    """Buckets medication ids by stock state so filters never scan the inventory.
+
+    A quantity of zero is EMPTY, anything up to and including the low-stock
+    threshold is LOW, and everything above it is IN_STOCK.
+    """
+
+    def __init__(self, low_stock_threshold: int = LOW_STOCK_THRESHOLD):
+        self.low_stock_threshold = low_stock_threshold
+        self._quantities = {}
+        self._state = {}
+        self._buckets = {EMPTY: set(), LOW: set(), IN_STOCK: set()}
+
+    def _state_for(self, quantity: int) -> str:
+        if quantity <= 0:
+            return EMPTY
+        if quantity <= self.low_stock_threshold:
+            return LOW
+        return IN_STOCK
+
+    def set(self, med_id: int, quantity: int):
+        state = self._state_for(quantity)
+        previous = self._state.get(med_id)
+        if previous != state:
+            if previous is not None:
+                self._buckets[previous].discard(med_id)
+            self._buckets[state].add(med_id)
+            self._state[med_id] = state
+        self._quantities[med_id] = quantity
+
+    def remove(self, med_id: int):
+        state = self._state.pop(med_id, None)
+        if state is not None:
+            self._buckets[state].discard(med_id)
+            del self._quantities[med_id]
+
+    def clear(self):
+        self._quantities.clear()
+        self._state.clear()
+        for bucket in self._buckets.values():
+            bucket.clear()
+
+    def set_low_stock_threshold(self, threshold: int):
+        self.low_stock_threshold = threshold
+        quantities = dict(self._quantities)
+        self.clear()
+        for med_id, quantity in quantities.items():
+            self.set(med_id, quantity)
+
+    def ids(self, state: str) -> list:
+        return sorted(self._buckets[state])
+
+    def count(self, state: str) -> int:
+        return len(self._buckets[state])
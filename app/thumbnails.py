@@ -0,0 +1,112 @@
+import logging
+import os
+import threading
+import time
+from typing import Optional
+
+from starlette.concurrency import run_in_threadpool
+
+from app.metrics import THUMBNAIL_QUEUE_DEPTH, THUMBNAIL_PROCESSING_SECONDS, THUMBNAIL_FAILURES
+from app.utils import IMAGE_DIR
+
+ICON_SIZES = (64, 128, 256)
+DERIVATIVE_FORMAT = "webp"
+THUMBNAIL_WORKERS = int(os.environ.get("THUMBNAIL_WORKERS", "2"))
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = {}
+_ready = set()
+
+
+def derivative_file(icon_file: str, size: int) -> str:
+    # Derivatives are named after the source's content hash, so identical
+    # uploads share them just like they share the original.
+    return f"{icon_file.split('.')[0]}.{size}.{DERIVATIVE_FORMAT}"
+
+
+def render_derivatives(image_dir: str, icon_file: str, sizes: tuple) -> float:
+    # Runs in a worker process; Pillow is only ever imported there.
+    from PIL import Image
+
+    start = time.perf_counter()
+    with Image.open(os.path.join(image_dir, icon_file)) as image:
+        image.load()
+        if image.mode not in ("RGB", "RGBA"):
+            image = image.convert("RGBA")
+        for size in sizes:
+            target = os.path.join(image_dir, derivative_file(icon_file, size))
+            if os.path.exists(target):
+                continue
+            thumbnail = image.copy()
+            thumbnail.thumbnail((size, size))
+            thumbnail.save(target + ".tmp", format=DERIVATIVE_FORMAT, quality=80, method=4)
+            os.replace(target + ".tmp", target)
+    return time.perf_counter() - start
+
+
+def _get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            # Imported with the first upload, not at startup
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+            # spawn, not fork: the server process is multi-threaded
+            _executor = ProcessPoolExecutor(max_workers=THUMBNAIL_WORKERS, mp_context=multiprocessing.get_context("spawn"))
+        return _executor
+
+
+def _finished(icon_file: str, future):
+    _pending.pop(icon_file, None)
+    THUMBNAIL_QUEUE_DEPTH.dec()
+    if future.cancelled():
+        return
+    error = future.exception()
+    if error is not None:
+        THUMBNAIL_FAILURES.inc()
+        logger.warning("Could not generate derivatives for %s: %s", icon_file, error)
+        return
+    THUMBNAIL_PROCESSING_SECONDS.observe(future.result())
+    _ready.update(derivative_file(icon_file, size) for size in ICON_SIZES)
+
+
+def schedule_derivatives(icon_file: str):
+    if icon_file in _pending:
+        return _pending[icon_file]
+    THUMBNAIL_QUEUE_DEPTH.inc()
+    future = _get_executor().submit(render_derivatives, IMAGE_DIR, icon_file, ICON_SIZES)
+    _pending[icon_file] = future
+    future.add_done_callback(lambda done: _finished(icon_file, done))
+    return future
+
+
+def _remove_derivatives(icon_file: str):
+    for size in ICON_SIZES:
+        name = derivative_file(icon_file, size)
+        _ready.discard(name)
+        try:
+            os.remove(os.path.join(IMAGE_DIR, name))
+        except FileNotFoundError:
+            pass
+
+
+def delete_derivatives(icon_file: str):
+    future = _pending.get(icon_file)
+    if future is not None and not future.cancel():
+        # Already rendering: clean up once the worker is done writing
+        future.add_done_callback(lambda _: _remove_derivatives(icon_file))
+    _remove_derivatives(icon_file)
+
+
+async def ready_derivative(icon_file: str, size: int) -> Optional[str]:
+    name = derivative_file(icon_file, size)
+    if name in _ready:
+        return name
+    # Another worker process may have rendered it
+    if await run_in_threadpool(os.path.exists, os.path.join(IMAGE_DIR, name)):
+        _ready.add(name)
+        return name
+    return None
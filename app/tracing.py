@@ -0,0 +1,145 @@
+import asyncio
+import hmac
+import os
+import threading
+import time
+from contextlib import nullcontext
+from contextvars import ContextVar
+
+from fastapi.routing import APIRoute
+from starlette.concurrency import run_in_threadpool as _run_in_threadpool
+
+from app.metrics import STAGE_LATENCY
+
+# Required in X-Admin-Token for the /admin endpoints and ?profile=1; when
+# unset, neither is available
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN") or None
+
+STAGES = ("validation", "etag", "serialize", "icon_io")
+
+
+class TracingSettings:
+    """Switches for the instrumentation, changed at runtime via PUT /admin/tracing.
+
+    They are per process: with several workers each one has its own.
+    """
+
+    def __init__(self):
+        self.stage_timing = os.environ.get("STAGE_TIMING", "1") == "1"
+        self.trace_log = os.environ.get("TRACE_LOG", "0") == "1"
+        self.profile_sample_rate = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+
+    def as_dict(self) -> dict:
+        return {"stage_timing": self.stage_timing, "trace_log": self.trace_log, "profile_sample_rate": self.profile_sample_rate}
+
+
+settings = TracingSettings()
+
+# Spans of the current request, set by TracingMiddleware while trace logging
+request_spans = ContextVar("request_spans", default=None)
+
+# Profiler of the current request, set by TracingMiddleware while profiling
+current_profiler = ContextVar("current_profiler", default=None)
+
+_stage_histograms = {stage: STAGE_LATENCY.labels(stage=stage) for stage in STAGES}
+_no_span = nullcontext()
+
+
+def is_admin(token) -> bool:
+    return ADMIN_TOKEN is not None and token is not None and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+
+class _Span:
+    __slots__ = ("stage", "start")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        record_stage(self.stage, time.perf_counter() - self.start)
+
+
+def span(stage: str):
+    # Times the block as one of STAGES; a shared no-op when stage timing is off
+    return _Span(stage) if settings.stage_timing else _no_span
+
+
+def record_stage(stage: str, seconds: float):
+    _stage_histograms[stage].observe(seconds)
+    spans = request_spans.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+
+def _call_registered(func, args, kwargs):
+    # Lets the profiler of the request sample this worker thread while it runs
+    profiler = current_profiler.get()
+    if profiler is None:
+        return func(*args, **kwargs)
+    ident = threading.get_ident()
+    profiler.add_thread(ident, "worker")
+    try:
+        return func(*args, **kwargs)
+    finally:
+        profiler.remove_thread(ident)
+
+
+async def run_in_threadpool(func, *args, **kwargs):
+    # starlette's run_in_threadpool, with the thread visible to ?profile=1
+    return await _run_in_threadpool(_call_registered, func, args, kwargs)
+
+
+async def run_offloaded(offload: bool, func, *args, **kwargs):
+    # For async endpoints: runs func on a worker thread when it may block or
+    # take long, and right away on the event loop otherwise
+    if offload:
+        return await run_in_threadpool(func, *args, **kwargs)
+    return func(*args, **kwargs)
+
+
+# When the current request's route handler started, for the validation stage
+_handler_start = ContextVar("handler_start", default=None)
+
+
+def _timed_endpoint(call):
+    # FastAPI has read the body and validated every parameter by the time it
+    # calls the endpoint; sync endpoints are sent to the threadpool here
+    # instead of by FastAPI, so the hand-off is not counted as validation
+    def validated():
+        start = _handler_start.get()
+        if start is not None:
+            record_stage("validation", time.perf_counter() - start)
+
+    if asyncio.iscoroutinefunction(call):
+        async def endpoint(**values):
+            validated()
+            return await call(**values)
+    else:
+        async def endpoint(**values):
+            validated()
+            return await run_in_threadpool(call, **values)
+    return endpoint
+
+
+class TimedRoute(APIRoute):
+    """APIRoute recording the "validation" stage: request parsing, parameter
+    and body validation and dependencies, up to the call of the endpoint.
+    """
+
+    def get_route_handler(self):
+        self.dependant.call = _timed_endpoint(self.dependant.call)
+        handler = super().get_route_handler()
+
+        async def timed_handler(request):
+            if not settings.stage_timing:
+                return await handler(request)
+            token = _handler_start.set(time.perf_counter())
+            try:
+                return await handler(request)
+            finally:
+                _handler_start.reset(token)
+
+        return timed_handler
@@ -1,15 +1,157 @@
+import asyncio
 import hashlib
-import xmltodict
-from fastapi.responses import JSONResponse, Response as FastAPIResponse
+from functools import lru_cache
+from itertools import islice
+from typing import Tuple
+from fastapi.responses import StreamingResponse, Response as FastAPIResponse
+
+from app.encoders import XML_DECLARATION, encode_json, join_json, encode_xml, encode_xml_item
+from app.pagination import STREAM_CHUNK_SIZE
+from app.tracing import span
 
 IMAGE_DIR = "/tmp/images"
 
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+JSON_MEDIA_TYPE = "application/json"
+XML_MEDIA_TYPE = "application/xml"
+
+# What single records can be served as, and what lists can, in order of
+# preference; the first one wins ties and an Accept header matching nothing.
+RECORD_MEDIA_TYPES = (JSON_MEDIA_TYPE, XML_MEDIA_TYPE)
+LIST_MEDIA_TYPES = (JSON_MEDIA_TYPE, XML_MEDIA_TYPE, NDJSON_MEDIA_TYPE)
+
+MEDIA_TYPE_ALIASES = {"text/xml": XML_MEDIA_TYPE}
+
 def generate_etag(obj) -> str:
-    obj_data = f"{obj.dict()}"
-    return hashlib.md5(obj_data.encode()).hexdigest()
-
-def serialize_response(data, accept: str):
-    if accept == "application/xml":
-        return FastAPIResponse(content=xmltodict.unparse({"response": data}, pretty=True), media_type="application/xml")
-    else:
-        return JSONResponse(content=data)
\ No newline at end of file
+    # Content hash over the record's JSON encoding; the data layer calls this
+    # once per mutation and stores the result, so request handlers never hash.
+    return json_etag(encode_json(obj))
+
+def json_etag(body: bytes) -> str:
+    with span("etag"):
+        return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+def etag_digest(etag: str) -> int:
+    return int(etag.strip('"'), 16)
+
+def collection_etag(*parts) -> str:
+    # Weak ETag for a list representation, derived from the collection digests
+    # and whatever else (filters, media type) shapes the response.
+    with span("etag"):
+        return f'W/"{hashlib.blake2b(repr(parts).encode(), digest_size=16).hexdigest()}"'
+
+def etag_matches(header, etag: str, weak: bool = True) -> bool:
+    # weak=True is the If-None-Match comparison, weak=False the If-Match one
+    if not header:
+        return False
+    if header.strip() == "*":
+        return True
+    for candidate in header.split(","):
+        candidate = candidate.strip()
+        if candidate.startswith("W/") or etag.startswith("W/"):
+            if not weak:
+                continue
+            candidate = candidate[2:] if candidate.startswith("W/") else candidate
+            if candidate == (etag[2:] if etag.startswith("W/") else etag):
+                return True
+        elif candidate == etag:
+            return True
+    return False
+
+def _parse_accept(accept: str):
+    ranges = []
+    for part in accept.split(","):
+        media_range, *params = part.split(";")
+        media_range = media_range.strip().lower()
+        if not media_range:
+            continue
+        quality, options = 1.0, {}
+        for param in params:
+            name, _, value = param.partition("=")
+            name, value = name.strip().lower(), value.strip().strip('"').lower()
+            if name == "q":
+                try:
+                    quality = max(0.0, min(1.0, float(value)))
+                except ValueError:
+                    quality = 0.0
+            else:
+                options[name] = value
+        ranges.append((MEDIA_TYPE_ALIASES.get(media_range, media_range), quality, options))
+    return ranges
+
+def _specificity(media_range: str, media_type: str) -> int:
+    if media_range == media_type:
+        return 3
+    if media_range == media_type.split("/")[0] + "/*":
+        return 2
+    if media_range == "*/*":
+        return 1
+    return 0
+
+@lru_cache(maxsize=1024)
+def negotiate(accept: str, offers: Tuple[str, ...] = RECORD_MEDIA_TYPES) -> Tuple[str, bool]:
+    # Picks the offer with the highest q-value of its most specific matching
+    # range, per RFC 9110. Returns the media type and whether pretty-printing
+    # was asked for ("application/xml; pretty=true").
+    if not accept:
+        return offers[0], False
+    ranges = _parse_accept(accept)
+    best, best_quality, best_pretty = offers[0], 0.0, False
+    for offer in offers:
+        # Ties keep the first range; options dicts cannot be compared
+        matched = max(((_specificity(media_range, offer), quality, options) for media_range, quality, options in ranges),
+                      key=lambda match: (match[0], match[1]), default=(0, 0.0, {}))
+        specificity, quality, options = matched
+        if specificity and quality > best_quality:
+            best, best_quality, best_pretty = offer, quality, options.get("pretty") == "true"
+    return best, best_pretty
+
+def response_media_type(accept: str, offers: Tuple[str, ...] = RECORD_MEDIA_TYPES) -> str:
+    # The negotiated representation, as used in response cache keys
+    media_type, pretty = negotiate(accept, offers)
+    return f"{media_type}; pretty=true" if pretty else media_type
+
+def serialize_response(data, accept: str, model=None, fragment: bytes = None):
+    # model (Medication, Inventory) lets XML use its precompiled record encoder;
+    # fragment is data already encoded as JSON by the data layer.
+    media_type, pretty = negotiate(accept, RECORD_MEDIA_TYPES)
+    with span("serialize"):
+        if media_type == XML_MEDIA_TYPE:
+            return FastAPIResponse(content=encode_xml(data, model, pretty), media_type=XML_MEDIA_TYPE)
+        else:
+            return FastAPIResponse(content=fragment if fragment is not None else encode_json(data), media_type=JSON_MEDIA_TYPE)
+
+def serialize_records(records, accept: str, model):
+    # records are (record, JSON fragment) pairs; JSON lists just join the fragments
+    media_type, pretty = negotiate(accept, RECORD_MEDIA_TYPES)
+    with span("serialize"):
+        if media_type == XML_MEDIA_TYPE:
+            return FastAPIResponse(content=encode_xml([record for record, _ in records], model, pretty), media_type=XML_MEDIA_TYPE)
+        return FastAPIResponse(content=join_json(fragment for _, fragment in records), media_type=JSON_MEDIA_TYPE)
+
+def stream_response(records, accept: str, model):
+    # Encodes (record, JSON fragment) pairs as they are pulled from the
+    # generator, STREAM_CHUNK_SIZE at a time, on the event loop; other requests
+    # run between chunks and the response never holds more than one chunk.
+    if negotiate(accept, LIST_MEDIA_TYPES)[0] == XML_MEDIA_TYPE:
+        return StreamingResponse(_xml_stream(records, model), media_type=XML_MEDIA_TYPE)
+    return StreamingResponse(_ndjson_stream(records), media_type=NDJSON_MEDIA_TYPE)
+
+async def _chunks(records):
+    records = iter(records)
+    chunk = list(islice(records, STREAM_CHUNK_SIZE))
+    while chunk:
+        yield chunk
+        # Sending a chunk need not suspend, so yield to other requests here
+        await asyncio.sleep(0)
+        chunk = list(islice(records, STREAM_CHUNK_SIZE))
+
+async def _ndjson_stream(records):
+    async for chunk in _chunks(records):
+        yield b"".join([fragment + b"\n" for _, fragment in chunk])
+
+async def _xml_stream(records, model):
+    yield XML_DECLARATION + "<response>"
+    async for chunk in _chunks(records):
+        yield "".join([encode_xml_item(record, model) for record, _ in chunk])
+    yield "</response>"
@@ -0,0 +1,175 @@
+import os
+import struct
+import threading
+import zlib
+
+# "always" syncs every commit, "interval" every WAL_FSYNC_INTERVAL seconds
+# from a background thread, "never" leaves it to the operating system. The
+# latter two lose at most the last moments of writes when the machine (not
+# just the process) goes down.
+WAL_FSYNC = os.environ.get("WAL_FSYNC", "interval")
+WAL_FSYNC_INTERVAL = float(os.environ.get("WAL_FSYNC_INTERVAL", "1.0"))
+FSYNC_POLICIES = ("always", "interval", "never")
+
+SEGMENT_PREFIX = "wal."
+# Payload length and CRC-32 of the payload
+FRAME = struct.Struct("<II")
+
+
+def segment_name(first_seq: int) -> str:
+    return f"{SEGMENT_PREFIX}{first_seq:020d}"
+
+
+def list_segments(directory: str) -> list:
+    # (sequence number of the first entry, path) in order
+    return sorted(
+        (int(name[len(SEGMENT_PREFIX):]), os.path.join(directory, name))
+        for name in os.listdir(directory) if name.startswith(SEGMENT_PREFIX) and name[len(SEGMENT_PREFIX):].isdigit()
+    )
+
+
+def read_segment(path: str):
+    # Returns the entries of a segment and the length of its valid prefix;
+    # reading stops at the first torn or corrupt frame
+    with open(path, "rb") as f:
+        data = f.read()
+    entries = []
+    position = 0
+    while position + FRAME.size <= len(data):
+        length, crc = FRAME.unpack_from(data, position)
+        end = position + FRAME.size + length
+        if end > len(data):
+            break
+        payload = data[position + FRAME.size:end]
+        if zlib.crc32(payload) != crc:
+            break
+        entries.append(payload)
+        position = end
+    return entries, position
+
+
+def sync_directory(directory: str):
+    fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+class WriteAheadLog:
+    """Append-only log of encoded entries in numbered segment files.
+
+    Entries are numbered consecutively; each segment is named after the
+    number of its first entry. Writers append() their entries, which only
+    queues them, and then commit() the returned number: one of the waiting
+    committers writes everything queued so far with a single write (and, with
+    the "always" policy, a single fsync) while the others wait for it, so
+    concurrent writers share the cost of a sync.
+    """
+
+    def __init__(self, directory: str, next_seq: int, fsync: str = WAL_FSYNC, fsync_interval: float = WAL_FSYNC_INTERVAL):
+        if fsync not in FSYNC_POLICIES:
+            raise ValueError(f"Unsupported WAL_FSYNC: {fsync}")
+        self.directory = directory
+        self.fsync = fsync
+        self._lock = threading.Lock()
+        self._written = threading.Condition(self._lock)
+        self._pending = []
+        self._appended = next_seq - 1
+        self._durable = next_seq - 1
+        self._writing = False
+        self._unsynced = False
+        self._error = None
+        self._file = self._open_segment(next_seq)
+        self._stop = threading.Event()
+        self._syncer = None
+        if fsync == "interval":
+            self._syncer = threading.Thread(target=self._sync_periodically, args=(fsync_interval,), name="wal-fsync", daemon=True)
+            self._syncer.start()
+
+    def _open_segment(self, first_seq: int):
+        f = open(os.path.join(self.directory, segment_name(first_seq)), "ab")
+        sync_directory(self.directory)
+        return f
+
+    @property
+    def last_seq(self) -> int:
+        return self._appended
+
+    def append(self, entries: list) -> int:
+        # Returns the number of the last entry, to pass to commit()
+        frames = [FRAME.pack(len(entry), zlib.crc32(entry)) + entry for entry in entries]
+        with self._lock:
+            self._pending.extend(frames)
+            self._appended += len(frames)
+            return self._appended
+
+    def commit(self, seq: int):
+        with self._lock:
+            while self._durable < seq:
+                if self._error is not None:
+                    raise OSError("Write-ahead log failed") from self._error
+                if self._writing:
+                    self._written.wait()
+                    continue
+                batch, upto = self._pending, self._appended
+                self._pending = []
+                self._writing = True
+                self._lock.release()
+                try:
+                    self._write(batch)
+                except BaseException as exc:
+                    self._lock.acquire()
+                    # Later entries may depend on the lost ones: fail them all
+                    self._error = exc
+                    self._writing = False
+                    self._written.notify_all()
+                    raise
+                self._lock.acquire()
+                self._writing = False
+                self._durable = upto
+                self._written.notify_all()
+
+    def _write(self, frames: list):
+        self._file.write(b"".join(frames))
+        self._file.flush()
+        if self.fsync == "always":
+            os.fsync(self._file.fileno())
+        else:
+            self._unsynced = True
+
+    def _sync_periodically(self, interval: float):
+        while not self._stop.wait(interval):
+            with self._lock:
+                if self._unsynced and not self._file.closed:
+                    self._unsynced = False
+                    os.fsync(self._file.fileno())
+
+    def rotate(self) -> int:
+        # Writes out and syncs the current segment and starts a new one;
+        # returns the number of the last entry in the closed segment
+        with self._lock:
+            while self._writing:
+                self._written.wait()
+            if self._error is not None:
+                raise OSError("Write-ahead log failed") from self._error
+            batch, self._pending = self._pending, []
+            self._file.write(b"".join(batch))
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._unsynced = False
+            self._durable = self._appended
+            self._file = self._open_segment(self._appended + 1)
+            self._written.notify_all()
+            return self._appended
+
+    def close(self):
+        self._stop.set()
+        if self._syncer is not None:
+            self._syncer.join()
+        self.commit(self._appended)
+        with self._lock:
+            if not self._file.closed:
+                os.fsync(self._file.fileno())
+                self._file.close()
@@ -0,0 +1,86 @@
+"""Load test of conflicting conditional writes.
+
+Every worker thread repeatedly reads the same few inventory items and PUTs
+them back with quantity + 1 under If-Match, retrying on 412. At the end each
+item's quantity must equal the number of successful PUTs for it, i.e. no
+update was lost. Runs in-process by default, or against a running server with
+--url (e.g. several uvicorn workers on a shared SQLite store). Run from the
+repository root:
+
+    python -m benchmarks.bench_concurrent_writes [--workers 16] [--items 4] [--increments 50] [--url http://127.0.0.1:8000]
+"""
+import argparse
+import random
+import threading
+import time
+
+import httpx
+from fastapi.testclient import TestClient
+
+FIRST_ID = 3_000_000
+
+
+def make_client(url):
+    if url:
+        return httpx.Client(base_url=url)
+    from app.main import app
+    return TestClient(app)
+
+
+def run(workers: int, items: int, increments: int, url):
+    client = make_client(url)
+    med_ids = list(range(FIRST_ID, FIRST_ID + items))
+    for med_id in med_ids:
+        client.delete(f"/medications/{med_id}")
+        assert client.post("/medications/", json={"id": med_id, "name": f"Contended {med_id}"}).status_code == 200
+
+    successes = {med_id: 0 for med_id in med_ids}
+    conflicts = [0]
+    lock = threading.Lock()
+
+    def worker(seed: int):
+        rng = random.Random(seed)
+        worker_client = make_client(url)
+        for _ in range(increments):
+            med_id = rng.choice(med_ids)
+            while True:
+                current = worker_client.get(f"/inventory/{med_id}")
+                inv = current.json()
+                response = worker_client.put(
+                    f"/inventory/{med_id}",
+                    json=dict(inv, quantity=inv["quantity"] + 1),
+                    headers={"If-Match": current.headers["ETag"]}
+                )
+                if response.status_code == 200:
+                    with lock:
+                        successes[med_id] += 1
+                    break
+                assert response.status_code in (409, 412), response.text
+                with lock:
+                    conflicts[0] += 1
+
+    threads = [threading.Thread(target=worker, args=(seed,)) for seed in range(workers)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    lost = {med_id: successes[med_id] - client.get(f"/inventory/{med_id}").json()["quantity"] for med_id in med_ids}
+    writes = sum(successes.values())
+    print(f"{workers} workers, {items} items: {writes} writes in {elapsed:.2f}s ({writes / elapsed:.0f} writes/s), {conflicts[0]} precondition failures retried")
+    print(f"lost updates: {sum(lost.values())}")
+    for med_id in med_ids:
+        client.delete(f"/medications/{med_id}")
+    return sum(lost.values())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--workers", type=int, default=16)
+    parser.add_argument("--items", type=int, default=4)
+    parser.add_argument("--increments", type=int, default=50)
+    parser.add_argument("--url", default=None, help="Base URL of a running server; in-process when omitted")
+    args = parser.parse_args()
+    raise SystemExit(1 if run(args.workers, args.items, args.increments, args.url) else 0)
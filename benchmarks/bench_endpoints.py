@@ -0,0 +1,85 @@
+"""Per-endpoint micro-benchmarks of the JSON response path.
+
+For every read endpoint this times the encoding the handler does (the old
+.dict() + JSONResponse route next to the stored-fragment one) and a full
+in-process ASGI request. The response cache is cleared before every request
+so the encoding is measured rather than the cache. Run from the repository
+root:
+
+    python -m benchmarks.bench_endpoints [--records 10000] [--repeat 20]
+"""
+import argparse
+import asyncio
+import time
+
+from fastapi.responses import JSONResponse
+from httpx import AsyncClient
+
+from app.main import app
+from app.cache import response_cache
+from app.data import medications, inventory, medication_json, inventory_json, medication_ids, inventory_ids, save_medication, save_inventory
+from app.encoders import join_json
+from app.models import Medication, Inventory
+
+BASE_URL = "http://bench"
+FIRST_ID = 2_000_000
+
+
+def seed(count: int):
+    for med_id in range(FIRST_ID, FIRST_ID + count):
+        save_medication(med_id, Medication(id=med_id, name=f"Bench {med_id}", description="Benchmark record"))
+        save_inventory(med_id, Inventory(medication_id=med_id, quantity=med_id % 50, shelf_id="B1", shelf_location="Shelf 1"))
+
+
+def endpoints():
+    # (request path, old encoding, new encoding)
+    return [
+        ("/medications/", lambda: JSONResponse([medications[i].dict() for i in medication_ids.all()]).body,
+            lambda: join_json([medication_json[i] for i in medication_ids.all()])),
+        ("/medications/?limit=100", lambda: JSONResponse([medications[i].dict() for i in medication_ids.after(None, 100)]).body,
+            lambda: join_json([medication_json[i] for i in medication_ids.after(None, 100)])),
+        (f"/medications/{FIRST_ID}", lambda: JSONResponse(medications[FIRST_ID].dict()).body,
+            lambda: medication_json[FIRST_ID]),
+        ("/inventory/", lambda: JSONResponse([inventory[i].dict() for i in inventory_ids.all()]).body,
+            lambda: join_json([inventory_json[i] for i in inventory_ids.all()])),
+        (f"/inventory/{FIRST_ID}", lambda: JSONResponse(inventory[FIRST_ID].dict()).body,
+            lambda: inventory_json[FIRST_ID]),
+    ]
+
+
+def timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+async def request_time(client: AsyncClient, path: str, repeat: int) -> float:
+    total = 0.0
+    for _ in range(repeat):
+        response_cache.clear()
+        start = time.perf_counter()
+        response = await client.get(path)
+        total += time.perf_counter() - start
+        assert response.status_code == 200
+    return total / repeat
+
+
+async def run(records: int, repeat: int):
+    seed(records)
+    print(f"{'endpoint':>28} {'old encode ms':>14} {'new encode ms':>14} {'speedup':>8} {'request ms':>11}")
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        for path, old, new in endpoints():
+            assert old() == new()
+            old_time = timed(old, repeat)
+            new_time = timed(new, repeat)
+            request = await request_time(client, path, repeat)
+            print(f"{path:>28} {old_time * 1000:>14.3f} {new_time * 1000:>14.3f} {old_time / new_time:>7.1f}x {request * 1000:>11.3f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=10000)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    asyncio.run(run(args.records, args.repeat))
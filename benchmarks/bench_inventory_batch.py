@@ -0,0 +1,76 @@
+"""Compare PATCH /inventory/ batches with a loop of single-item PUTs.
+
+Both variants run in-process over ASGI, so the numbers measure the
+application rather than the network. Run from the repository root:
+
+    python -m benchmarks.bench_inventory_batch [--items 5000] [--batch-size 1000]
+"""
+import argparse
+import asyncio
+import time
+
+from httpx import AsyncClient
+
+from app.main import app
+from app.data import inventory_etags, save_medication, save_inventory
+from app.models import Medication, Inventory
+
+BASE_URL = "http://bench"
+FIRST_ID = 1_000_000
+
+
+def seed(count: int) -> list:
+    med_ids = list(range(FIRST_ID, FIRST_ID + count))
+    for med_id in med_ids:
+        save_medication(med_id, Medication(id=med_id, name=f"Bench {med_id}"))
+        save_inventory(med_id, Inventory(medication_id=med_id, quantity=0, shelf_id="", shelf_location=""))
+    return med_ids
+
+
+def update_for(med_id: int, quantity: int) -> dict:
+    return {"medication_id": med_id, "quantity": quantity, "shelf_id": "B1", "shelf_location": "Shelf 1"}
+
+
+async def put_loop(client: AsyncClient, med_ids: list, quantity: int):
+    for med_id in med_ids:
+        response = await client.put(
+            f"/inventory/{med_id}",
+            json=update_for(med_id, quantity),
+            headers={"If-Match": inventory_etags[med_id]}
+        )
+        assert response.status_code == 200
+
+
+async def patch_batches(client: AsyncClient, med_ids: list, quantity: int, batch_size: int):
+    for start in range(0, len(med_ids), batch_size):
+        batch = [
+            dict(update_for(med_id, quantity), if_match=inventory_etags[med_id])
+            for med_id in med_ids[start:start + batch_size]
+        ]
+        response = await client.patch("/inventory/", json=batch)
+        assert response.status_code == 200
+
+
+async def run(items: int, batch_size: int):
+    med_ids = seed(items)
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        start = time.perf_counter()
+        await put_loop(client, med_ids, 1)
+        single = time.perf_counter() - start
+
+        start = time.perf_counter()
+        await patch_batches(client, med_ids, 2, batch_size)
+        batched = time.perf_counter() - start
+
+    print(f"{'variant':>22} {'seconds':>8} {'updates/s':>10}")
+    print(f"{'PUT loop':>22} {single:>8.2f} {items / single:>10.0f}")
+    print(f"{f'PATCH x{batch_size}':>22} {batched:>8.2f} {items / batched:>10.0f}")
+    print(f"speedup: {single / batched:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=5000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+    asyncio.run(run(args.items, args.batch_size))
@@ -0,0 +1,84 @@
+"""Compare the columnar inventory store with a dict of Inventory objects.
+
+Reports the memory each representation holds and the time to compute the
+per-shelf statistics behind GET /inventory/stats?group_by=shelf_id. Run from
+the repository root:
+
+    python -m benchmarks.bench_inventory_stats [--sizes 100000 1000000]
+"""
+import argparse
+import random
+import time
+import tracemalloc
+
+from app import columns
+from app.columns import InventoryColumns
+from app.models import Inventory
+
+THRESHOLD = 10
+
+
+def generate(count: int, seed: int = 42):
+    rng = random.Random(seed)
+    shelves = [f"{aisle}{number}" for aisle in "ABCDEFGH" for number in range(1, 26)]
+    for med_id in range(1, count + 1):
+        shelf_id = rng.choice(shelves)
+        yield Inventory.construct(medication_id=med_id, quantity=rng.randint(0, 200), shelf_id=shelf_id, shelf_location=f"Shelf {shelf_id}")
+
+
+def measured(build):
+    tracemalloc.start()
+    store = build()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return store, size
+
+
+def dict_stats(store: dict) -> dict:
+    # What the aggregate costs over one object per item
+    groups = {}
+    for inv in store.values():
+        group = groups.setdefault(inv.shelf_id, [0, 0, 0, 0])
+        group[0] += 1
+        group[1] += inv.quantity
+        if inv.quantity <= 0:
+            group[2] += 1
+        elif inv.quantity <= THRESHOLD:
+            group[3] += 1
+    return groups
+
+
+def timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def run(sizes, repeat: int):
+    print(f"{'rows':>9} {'dict MB':>8} {'columns MB':>11} {'dict ms':>8} {'python ms':>10} {'numpy ms':>9}")
+    numpy = columns._numpy()
+    for size in sizes:
+        dict_store, dict_size = measured(lambda: {inv.medication_id: inv for inv in generate(size)})
+        column_store, column_size = measured(lambda: _columns(generate(size)))
+        dict_time = timed(lambda: dict_stats(dict_store), repeat)
+        columns.numpy = None
+        python_time = timed(lambda: column_store.stats(THRESHOLD, "shelf_id"), repeat)
+        columns.numpy = numpy
+        numpy_time = timed(lambda: column_store.stats(THRESHOLD, "shelf_id"), repeat) if numpy is not None else float("nan")
+        print(f"{size:>9} {dict_size / 2**20:>8.1f} {column_size / 2**20:>11.1f} {dict_time * 1000:>8.1f} {python_time * 1000:>10.1f} {numpy_time * 1000:>9.2f}")
+
+
+def _columns(items) -> InventoryColumns:
+    store = InventoryColumns()
+    for inv in items:
+        store[inv.medication_id] = inv
+    return store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
@@ -0,0 +1,60 @@
+"""Compare the trigram name index with the original linear regex scan.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_search [--sizes 10000 100000 1000000]
+"""
+import argparse
+import random
+import re
+import string
+import time
+
+from app.search import NameIndex
+
+QUERIES = ["^Asp", "^par", "(?i)profen", "cilli", "mol$", "^Ibu.*en$"]
+
+
+def generate_names(count: int, seed: int = 42) -> dict:
+    rng = random.Random(seed)
+    stems = ["Aspirin", "Ibuprofen", "Paracetamol", "Amoxicillin", "Metformin", "Lisinopril", "Omeprazole"]
+    names = {}
+    for med_id in range(1, count + 1):
+        suffix = "".join(rng.choices(string.ascii_lowercase, k=6))
+        names[med_id] = f"{rng.choice(stems)} {suffix}" if rng.random() < 0.01 else f"{suffix.title()}{rng.choice(string.ascii_lowercase)}ine"
+    return names
+
+
+def linear_scan(names: dict, pattern: str) -> list:
+    return [med_id for med_id, name in names.items() if re.search(pattern, name)]
+
+
+def timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def run(sizes, repeat: int):
+    print(f"{'size':>9} {'query':>12} {'linear ms':>10} {'index ms':>10} {'speedup':>8}")
+    for size in sizes:
+        names = generate_names(size)
+        index = NameIndex()
+        start = time.perf_counter()
+        for med_id, name in names.items():
+            index.add(med_id, name)
+        print(f"{size:>9} {'(build)':>12} {'':>10} {(time.perf_counter() - start) * 1000:>10.1f}")
+        for query in QUERIES:
+            assert sorted(linear_scan(names, query)) == index.search(query)
+            linear = timed(lambda: linear_scan(names, query), repeat)
+            indexed = timed(lambda: index.search(query), repeat)
+            print(f"{size:>9} {query:>12} {linear * 1000:>10.2f} {indexed * 1000:>10.2f} {linear / indexed:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
@@ -0,0 +1,99 @@
+"""Measure how quickly a fresh worker comes up and answers its first requests.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_startup [--runs 5] [--top 10]
+
+Every run starts a new interpreter. The import of app.main is timed with
+python -X importtime, which also names the modules that cost the most; then
+uvicorn is started and timed until GET /medications/1 answers, after which
+each of a few routes is requested once cold and then again warm.
+"""
+import argparse
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import urllib.error
+import urllib.request
+
+COLD_PATHS = ["/medications/1", "/medications/?limit=100", "/inventory/?limit=100", "/inventory/stats", "/inventory/shelves", "/changes/?since=0"]
+WARM_REPEAT = 20
+
+
+def import_profile() -> list:
+    # (cumulative microseconds, self microseconds, module) per imported module
+    stderr = subprocess.run([sys.executable, "-X", "importtime", "-c", "import app.main"], check=True, capture_output=True, text=True).stderr
+    modules = []
+    for line in stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        own, cumulative, name = line[len("import time:"):].split("|")
+        modules.append((int(cumulative), int(own), name.strip()))
+    return modules
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def get(url: str) -> float:
+    start = time.perf_counter()
+    with urllib.request.urlopen(url) as response:
+        response.read()
+    return time.perf_counter() - start
+
+
+def serve_once(paths: list):
+    # Seconds from spawning uvicorn until its first response, and the cold
+    # and median warm latency of every path
+    port = free_port()
+    base = f"http://127.0.0.1:{port}"
+    start = time.perf_counter()
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"], env=dict(os.environ))
+    try:
+        while True:
+            try:
+                get(base + "/medications/1")
+                break
+            except (urllib.error.URLError, ConnectionError):
+                if server.poll() is not None:
+                    raise RuntimeError("uvicorn exited before serving a request")
+                time.sleep(0.002)
+        ready = time.perf_counter() - start
+        latencies = {}
+        for path in paths:
+            cold = get(base + path)
+            warm = statistics.median(get(base + path) for _ in range(WARM_REPEAT))
+            latencies[path] = (cold, warm)
+        return ready, latencies
+    finally:
+        server.terminate()
+        server.wait()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--top", type=int, default=10)
+    args = parser.parse_args()
+
+    profiles = [import_profile() for _ in range(args.runs)]
+    totals = [next(cumulative for cumulative, _, name in modules if name == "app.main") for modules in profiles]
+    print(f"{'import app.main':>36} {min(totals) / 1e6:>8.3f}s (median {statistics.median(totals) / 1e6:.3f}s)")
+    print("slowest modules of the fastest run (cumulative, self):")
+    for cumulative, own, name in sorted(profiles[totals.index(min(totals))], reverse=True)[:args.top]:
+        print(f"{name:>36} {cumulative / 1e6:>8.3f}s {own / 1e6:>8.3f}s")
+
+    runs = [serve_once(COLD_PATHS) for _ in range(args.runs)]
+    ready = [run[0] for run in runs]
+    print(f"{'spawn to first response':>36} {min(ready):>8.3f}s (median {statistics.median(ready):.3f}s)")
+    print(f"{'first request (median of runs)':>36} {'cold':>8} {'warm':>8}")
+    for path in COLD_PATHS:
+        cold = statistics.median(run[1][path][0] for run in runs)
+        warm = statistics.median(run[1][path][1] for run in runs)
+        print(f"{path:>36} {cold * 1e3:>7.2f}ms {warm * 1e3:>7.2f}ms")
@@ -0,0 +1,65 @@
+"""Compare read and write throughput of the memory and SQLite repositories.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_storage [--records 50000] [--batch-size 1000]
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from app.models import Medication, Inventory
+from app.repository import MemoryRepository, SQLiteRepository
+
+
+def measure(label: str, count: int, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>28} {elapsed:>8.3f}s {count / elapsed:>12.0f} ops/s")
+
+
+def run(repository, records: int, batch_size: int):
+    med_ids = list(range(1, records + 1))
+    lookups = random.Random(42).choices(med_ids, k=records)
+
+    def write_medications():
+        for med_id in med_ids:
+            repository.save_medication(med_id, Medication(id=med_id, name=f"Medication {med_id}"))
+
+    def write_inventory_batches():
+        for start in range(0, records, batch_size):
+            repository.save_inventory_many(
+                (med_id, Inventory(medication_id=med_id, quantity=med_id % 50, shelf_id="A1", shelf_location="Shelf 1"))
+                for med_id in med_ids[start:start + batch_size]
+            )
+
+    def read_by_id():
+        for med_id in lookups:
+            repository.get_medication(med_id)
+
+    def scan():
+        for _ in repository.inventory():
+            pass
+
+    measure("single medication writes", records, write_medications)
+    measure(f"inventory writes (x{batch_size})", records, write_inventory_batches)
+    measure("medication reads by id", records, read_by_id)
+    measure("inventory full scan", records, scan)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=50_000)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args()
+
+    print("memory://")
+    run(MemoryRepository(), args.records, args.batch_size)
+    with tempfile.TemporaryDirectory() as directory:
+        print("sqlite:// (WAL)")
+        repository = SQLiteRepository(os.path.join(directory, "bench.db"))
+        run(repository, args.records, args.batch_size)
+        repository.close()
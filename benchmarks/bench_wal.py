@@ -0,0 +1,109 @@
+"""Measure write-ahead log throughput per fsync policy and restart time from a snapshot.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_wal [--records 1000000] [--tail 10000] [--writes 20000] [--threads 8]
+
+Restarts are timed in a fresh interpreter: the import of app.data (which
+loads the store) with STORAGE_URL=wal://, minus the same import with an
+empty memory:// store, and separately until the background index build
+has finished.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from app.models import Medication, Inventory
+from app.repository import LogRepository
+from app.snapshots import write_snapshot
+from app.wal import FSYNC_POLICIES
+from benchmarks.bench_search import generate_names
+
+RESTART = """
+import time
+start = time.perf_counter()
+import app.data
+loaded = time.perf_counter()
+app.data.wait_for_index("inventory")
+app.data.wait_for_index("names")
+print(loaded - start, time.perf_counter() - start, len(app.data.medications))
+"""
+
+
+def measure(label: str, count: int, fn):
+    start = time.perf_counter()
+    fn()
+    elapsed = time.perf_counter() - start
+    print(f"{label:>36} {elapsed:>8.3f}s {count / elapsed:>12.0f} ops/s")
+
+
+def write_throughput(writes: int, threads: int):
+    for policy in FSYNC_POLICIES:
+        # "always" syncs every commit; keep its run short on slow disks
+        count = writes if policy != "always" else max(writes // 10, 1)
+        with tempfile.TemporaryDirectory() as directory:
+            repository = LogRepository(directory, fsync=policy, snapshot_every=10 * count)
+
+            def write(med_id):
+                repository.save_medication(med_id, Medication(id=med_id, name=f"Medication {med_id}"))
+
+            def serial():
+                for med_id in range(1, count + 1):
+                    write(med_id)
+
+            def concurrent():
+                with ThreadPoolExecutor(threads) as pool:
+                    list(pool.map(write, range(count + 1, 2 * count + 1)))
+
+            measure(f"fsync={policy} writes", count, serial)
+            measure(f"fsync={policy} writes ({threads} threads)", count, concurrent)
+            repository.close()
+
+
+def build_store(directory: str, records: int, tail: int):
+    # A snapshot of `records` medications with inventory, plus `tail` logged
+    # writes on top of it
+    names = generate_names(records)
+    medications = {med_id: Medication.construct(id=med_id, name=name, description=None, icon_url=None) for med_id, name in names.items()}
+    inventory = {med_id: Inventory.construct(medication_id=med_id, quantity=med_id % 200, shelf_id=f"S{med_id % 50}", shelf_location=f"Shelf {med_id % 50}")
+                 for med_id in names}
+    write_snapshot(os.path.join(directory, "snapshot"), 0, None, medications, inventory)
+    repository = LogRepository(directory, snapshot_every=tail + 1)
+    for med_id in range(1, tail + 1):
+        repository.save_inventory(med_id, Inventory(medication_id=med_id, quantity=1, shelf_id="T1", shelf_location="Shelf T1"))
+    repository.close()
+
+
+def restart(storage_url: str):
+    env = dict(os.environ, STORAGE_URL=storage_url)
+    output = subprocess.run([sys.executable, "-c", RESTART], env=env, check=True, capture_output=True, text=True).stdout
+    loaded, indexed, count = output.split()
+    return float(loaded), float(indexed), int(count)
+
+
+def restart_time(records: int, tail: int):
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        build_store(directory, records, tail)
+        print(f"built a snapshot of {records} records and {tail} log entries in {time.perf_counter() - start:.1f}s")
+        baseline = min(restart("memory://")[0] for _ in range(3))
+        runs = [restart(f"wal:///{directory}") for _ in range(3)]
+        loaded, indexed, count = min(runs)
+        print(f"{'restart (store loaded)':>36} {loaded - baseline:>8.3f}s  ({count} medications, import overhead {baseline:.3f}s excluded)")
+        print(f"{'restart (indexes built)':>36} {indexed - baseline:>8.3f}s")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=1_000_000)
+    parser.add_argument("--tail", type=int, default=10_000)
+    parser.add_argument("--writes", type=int, default=20_000)
+    parser.add_argument("--threads", type=int, default=8)
+    args = parser.parse_args()
+
+    write_throughput(args.writes, args.threads)
+    restart_time(args.records, args.tail)
@@ -0,0 +1,49 @@
+"""Compare the schema-aware XML encoder with xmltodict.unparse.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_xml [--sizes 1 1000 100000]
+"""
+import argparse
+import time
+
+import xmltodict
+
+from app.encoders import encode_xml
+from app.models import Medication
+
+
+def generate_records(count: int) -> list:
+    return [
+        Medication(id=med_id, name=f"Medication {med_id}", description="Pain & fever <reliever>").dict()
+        for med_id in range(1, count + 1)
+    ]
+
+
+def timed(fn, repeat: int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def run(sizes, repeat: int):
+    print(f"{'records':>9} {'xmltodict pretty ms':>20} {'xmltodict ms':>13} {'encoder ms':>11} {'speedup':>8}")
+    for size in sizes:
+        records = generate_records(size)
+        document = records[0] if size == 1 else {"item": records}
+        data = records[0] if size == 1 else records
+        assert encode_xml(data, Medication) == xmltodict.unparse({"response": document})
+        rounds = max(1, repeat // max(1, size // 1000))
+        pretty = timed(lambda: xmltodict.unparse({"response": document}, pretty=True), rounds)
+        compact = timed(lambda: xmltodict.unparse({"response": document}), rounds)
+        encoder = timed(lambda: encode_xml(data, Medication), rounds)
+        print(f"{size:>9} {pretty * 1000:>20.3f} {compact * 1000:>13.3f} {encoder * 1000:>11.3f} {pretty / encoder:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 1000, 100000])
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    run(args.sizes, args.repeat)
@@ -0,0 +1,281 @@
+"""Replay a request mix against the API and report latency per route.
+
+The mix is either a traffic file (one JSON request per line, see
+benchmarks/traffic.jsonl) or generated by synthetic_mix(), which covers every
+route in app/routes except the icon uploads and the SSE change stream. Requests
+are sent by --concurrency clients, in-process over ASGI by default or to a
+running server with --url. Reports throughput and p50/p95/p99 latency per
+route template and, with --baseline, fails when p50/p95 or throughput regressed
+by more than --tolerance. Run from the repository root:
+
+    python -m benchmarks.replay [--records 10000] [--requests 5000] [--concurrency 8] [--traffic FILE] [--baseline benchmarks/baseline.json] [--save-baseline FILE] [--url http://127.0.0.1:8000]
+
+--records seeds that many medications with inventory before the run, up to
+1000000. Against a server the data has to be there already: seed a shared
+store once with e.g. STORAGE_URL=sqlite:///bench.db python -m benchmarks.replay
+--records 1000000 --seed-only, start uvicorn with the same STORAGE_URL, then
+replay with the same --records and --url.
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import time
+from collections import defaultdict, deque
+
+import httpx
+from starlette.routing import Match
+
+from app.main import app
+from benchmarks.bench_search import generate_names
+
+BASE_URL = "http://bench"
+FIRST_ID = 1000
+SHELVES = [f"{aisle}{number}" for aisle in "ABCDEFGH" for number in range(1, 26)]
+STEMS = ["^Asp", "^Ibu", "(?i)profen", "cilli", "mol$"]
+
+
+def seed(records: int):
+    from app.data import medications, save_medication, save_inventory_many
+    from app.models import Medication, Inventory
+
+    if records == 0 or FIRST_ID + records - 1 in medications:
+        return
+    rng = random.Random(42)
+    names = generate_names(records)
+    start = time.perf_counter()
+    batch = []
+    for offset, name in names.items():
+        med_id = FIRST_ID + offset - 1
+        if med_id not in medications:
+            save_medication(med_id, Medication(id=med_id, name=name, description="Replay benchmark record"))
+        shelf_id = rng.choice(SHELVES)
+        batch.append((med_id, Inventory(medication_id=med_id, quantity=rng.randint(0, 200), shelf_id=shelf_id, shelf_location=f"Shelf {shelf_id}"), None))
+        if len(batch) == 10000:
+            save_inventory_many(batch)
+            batch = []
+    save_inventory_many(batch)
+    print(f"seeded {records} records in {time.perf_counter() - start:.1f}s", file=sys.stderr)
+
+
+def synthetic_mix(records: int, count: int, seed: int = 1):
+    # Read-heavy mix over the seeded ids (or the demo records when none are
+    # seeded); writes use If-Match: * so they never fail on a stale ETag
+    rng = random.Random(seed)
+    first, last = (FIRST_ID, FIRST_ID + records - 1) if records else (1, 3)
+    created = deque()
+    next_new_id = FIRST_ID + records + 10_000_000
+
+    def any_id():
+        return rng.randint(first, last)
+
+    def inventory_body(med_id):
+        shelf_id = rng.choice(SHELVES)
+        return {"medication_id": med_id, "quantity": rng.randint(0, 200), "shelf_id": shelf_id, "shelf_location": f"Shelf {shelf_id}"}
+
+    def create():
+        nonlocal next_new_id
+        next_new_id += 1
+        created.append(next_new_id)
+        return {"method": "POST", "path": "/medications/", "json": {"id": next_new_id, "name": f"Replay {next_new_id}"}}
+
+    def delete():
+        # Only ids created well before, so the POST has normally completed
+        if len(created) < 50:
+            return create()
+        return {"method": "DELETE", "path": f"/medications/{created.popleft()}"}
+
+    def update_medication():
+        med_id = any_id()
+        return {"method": "PUT", "path": f"/medications/{med_id}", "headers": {"If-Match": "*"},
+                "json": {"id": med_id, "name": f"Updated {med_id}", "description": "Replay benchmark record"}}
+
+    def update_inventory():
+        med_id = any_id()
+        return {"method": "PUT", "path": f"/inventory/{med_id}", "headers": {"If-Match": "*"}, "json": inventory_body(med_id)}
+
+    generators = [
+        (20, lambda: {"path": f"/medications/{any_id()}"}),
+        (20, lambda: {"path": f"/inventory/{any_id()}"}),
+        (6, lambda: {"path": "/medications/", "params": {"limit": 100}}),
+        (4, lambda: {"path": "/medications/", "params": {"regex": rng.choice(STEMS), "limit": 100}}),
+        (1, lambda: {"path": "/medications/", "params": {"regex": rng.choice(STEMS), "stream": "true"}}),
+        (2, lambda: {"path": "/medications/", "params": {"out_of_stock": "true", "limit": 100}}),
+        (6, lambda: {"path": "/inventory/", "params": {"limit": 100}}),
+        (3, lambda: {"path": "/inventory/", "params": {"low_stock": "true", "limit": 100}}),
+        (2, lambda: {"path": "/inventory/", "params": {"limit": 100}, "headers": {"Accept": "application/xml"}}),
+        (3, lambda: {"path": "/inventory/stats"}),
+        (2, lambda: {"path": "/inventory/stats", "params": {"group_by": "shelf_id"}}),
+        (2, lambda: {"path": "/inventory/shelves"}),
+        (3, lambda: {"path": f"/inventory/shelves/{rng.choice(SHELVES)}", "params": {"limit": 100}}),
+        (2, lambda: {"path": "/changes/", "params": {"since": "{seq}", "limit": 100}}),
+        (8, update_inventory),
+        (2, lambda: {"method": "PATCH", "path": "/inventory/", "json": [inventory_body(any_id()) for _ in range(10)]}),
+        (2, update_medication),
+        (2, create),
+        (2, delete),
+    ]
+    weights = [weight for weight, _ in generators]
+    for _ in range(count):
+        yield rng.choices(generators, weights)[0][1]()
+
+
+def load_traffic(path: str) -> list:
+    # Lines without a "path" are not requests and are skipped
+    with open(path) as f:
+        lines = [json.loads(line) for line in f if line.strip()]
+    requests = [line for line in lines if isinstance(line, dict) and "path" in line]
+    if not requests:
+        raise SystemExit(f"{path} holds no requests (lines need at least a \"path\")")
+    return requests
+
+
+def traffic_mix(requests: list, records: int, count: int, seed: int = 1):
+    # Cycles through the recorded requests; "{med_id}" in a path is replaced
+    # by a random seeded id on every replay of the line
+    rng = random.Random(seed)
+    first, last = (FIRST_ID, FIRST_ID + records - 1) if records else (1, 3)
+    for i in range(count):
+        request = requests[i % len(requests)]
+        if "{med_id}" in request["path"]:
+            request = dict(request, path=request["path"].replace("{med_id}", str(rng.randint(first, last))))
+        yield request
+
+
+def route_template(method: str, path: str) -> str:
+    scope = {"type": "http", "method": method, "path": path, "root_path": ""}
+    for route in app.router.routes:
+        match, _ = route.matches(scope)
+        if match == Match.FULL:
+            return f"{method} {route.path}"
+    return f"{method} <unmatched>"
+
+
+def percentile(ordered: list, p: float) -> float:
+    return ordered[max(0, min(len(ordered) - 1, math.ceil(p / 100 * len(ordered)) - 1))]
+
+
+async def replay(client: httpx.AsyncClient, requests, concurrency: int) -> dict:
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    statuses = defaultdict(lambda: defaultdict(int))
+    requests = iter(requests)
+    change_seq = ["0"]
+
+    async def worker():
+        # The clients share one iterator, so the mix is sent in order
+        for request in requests:
+            method = request.get("method", "GET")
+            params = {key: change_seq[0] if value == "{seq}" else value for key, value in request.get("params", {}).items()}
+            route = route_template(method, request["path"])
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, request["path"], params=params, headers=request.get("headers"), json=request.get("json"))
+            except httpx.HTTPError:
+                errors[route] += 1
+                continue
+            latencies[route].append(time.perf_counter() - start)
+            statuses[route][response.status_code] += 1
+            if response.status_code >= 500:
+                errors[route] += 1
+            if "X-Change-Seq" in response.headers:
+                change_seq[0] = response.headers["X-Change-Seq"]
+            # In-process, a request served by an async endpoint need not
+            # suspend at all; yield as a socket read would, so one client
+            # cannot hold the event loop for a run of such requests
+            await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    elapsed = time.perf_counter() - start
+
+    routes = {}
+    for route in sorted(set(latencies) | set(errors)):
+        ordered = sorted(latencies[route])
+        routes[route] = {
+            "count": len(ordered),
+            "errors": errors[route],
+            "rps": len(ordered) / elapsed,
+            **({f"p{p}": percentile(ordered, p) * 1000 for p in (50, 95, 99)} if ordered else {"p50": 0.0, "p95": 0.0, "p99": 0.0}),
+            "statuses": {str(status): n for status, n in sorted(statuses[route].items())},
+        }
+    total = sum(route["count"] for route in routes.values())
+    return {"seconds": elapsed, "requests": total, "throughput": total / elapsed, "routes": routes}
+
+
+def report(results: dict):
+    print(f"{'route':<44} {'count':>6} {'err':>4} {'req/s':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8}  statuses")
+    for route, r in results["routes"].items():
+        statuses = " ".join(f"{status}:{n}" for status, n in r["statuses"].items())
+        print(f"{route:<44} {r['count']:>6} {r['errors']:>4} {r['rps']:>8.0f} {r['p50']:>8.2f} {r['p95']:>8.2f} {r['p99']:>8.2f}  {statuses}")
+    print(f"{results['requests']} requests in {results['seconds']:.2f}s, {results['throughput']:.0f} req/s")
+
+
+def compare(results: dict, baseline: dict, tolerance: float, min_delta_ms: float) -> list:
+    # p99 is reported but not compared; it is too noisy over a few thousand
+    # requests to fail a run on
+    regressions = []
+    if baseline.get("settings") != results.get("settings"):
+        print(f"warning: baseline was recorded with {baseline.get('settings')}", file=sys.stderr)
+    if results["throughput"] < baseline["throughput"] / (1 + tolerance):
+        regressions.append(f"throughput {baseline['throughput']:.0f} -> {results['throughput']:.0f} req/s")
+    for route, base in baseline["routes"].items():
+        current = results["routes"].get(route)
+        if current is None:
+            continue
+        for key in ("p50", "p95"):
+            if current[key] > base[key] * (1 + tolerance) and current[key] - base[key] > min_delta_ms:
+                regressions.append(f"{route} {key} {base[key]:.2f} -> {current[key]:.2f} ms")
+        if current["errors"] > base["errors"]:
+            regressions.append(f"{route} errors {base['errors']} -> {current['errors']}")
+    return regressions
+
+
+def run(records: int, count: int, concurrency: int, traffic, url, baseline, save_baseline, tolerance: float, min_delta_ms: float) -> int:
+    requests = traffic_mix(load_traffic(traffic), records, count) if traffic else synthetic_mix(records, count)
+    if url is None:
+        seed(records)
+    client = httpx.AsyncClient(base_url=url) if url else httpx.AsyncClient(app=app, base_url=BASE_URL)
+
+    async def main():
+        async with client:
+            return await replay(client, requests, concurrency)
+
+    results = asyncio.run(main())
+    results["settings"] = {"records": records, "requests": count, "concurrency": concurrency,
+                           "traffic": traffic, "target": "url" if url else "asgi"}
+    report(results)
+
+    if save_baseline:
+        with open(save_baseline, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+            f.write("\n")
+    if baseline:
+        with open(baseline) as f:
+            regressions = compare(results, json.load(f), tolerance, min_delta_ms)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--records", type=int, default=10000, help="Medications (with inventory) in the dataset, up to 1000000")
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--traffic", default=None, help="JSONL file of requests to replay instead of the synthetic mix")
+    parser.add_argument("--url", default=None, help="Base URL of a running server; in-process when omitted")
+    parser.add_argument("--baseline", default=None, help="Results file to compare with; exits 1 on a regression")
+    parser.add_argument("--save-baseline", default=None, help="Write the results to this file")
+    parser.add_argument("--tolerance", type=float, default=0.5, help="Allowed slowdown as a fraction of the baseline")
+    parser.add_argument("--min-delta-ms", type=float, default=1.0, help="Latency increases smaller than this never count")
+    parser.add_argument("--seed-only", action="store_true", help="Seed --records into STORAGE_URL and exit")
+    args = parser.parse_args()
+    if args.seed_only:
+        seed(args.records)
+        raise SystemExit(0)
+    raise SystemExit(run(args.records, args.requests, args.concurrency, args.traffic, args.url,
+                         args.baseline, args.save_baseline, args.tolerance, args.min_delta_ms))
@@ -0,0 +1,115 @@
+import asyncio
+import pytest
+from fastapi.testclient import TestClient
+from httpx import AsyncClient
+from app import admission
+from app.admission import ConcurrencyLimit, client_buckets, route_buckets, expensive_limits
+from app.main import app
+
+BASE_URL = "http://127.0.0.1:8000"
+
+@pytest.fixture
+def limits(monkeypatch):
+    client_buckets.clear()
+    route_buckets.clear()
+    monkeypatch.setattr("app.main.METRICS_CACHE_TTL", 0)
+    yield admission.settings
+    client_buckets.clear()
+    route_buckets.clear()
+
+@pytest.mark.asyncio
+async def test_client_rate_limit(limits, monkeypatch):
+    """
+    A client that used up its burst gets 429 with Retry-After, and expensive requests take more tokens.
+    """
+    monkeypatch.setattr(limits, "client_rate", 0.1)
+    monkeypatch.setattr(limits, "client_burst", 6)
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        assert (await client.get("/medications/", params={"regex": "^Asp"})).status_code == 200
+        assert (await client.get("/medications/1")).status_code == 200
+        response = await client.get("/medications/1")
+        assert response.status_code == 429
+        assert int(response.headers["Retry-After"]) >= 1
+        # Monitoring is never limited
+        assert (await client.get("/metrics")).status_code == 200
+
+@pytest.mark.asyncio
+async def test_route_rate_limit(limits, monkeypatch):
+    """
+    A route that used up its burst is shed with 503 while other routes still answer.
+    """
+    monkeypatch.setattr(limits, "route_rate", 0.1)
+    monkeypatch.setattr(limits, "route_burst", 2)
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        for med_id in (1, 2):
+            assert (await client.get(f"/medications/{med_id}")).status_code == 200
+        response = await client.get("/medications/3")
+        assert response.status_code == 503
+        assert "Retry-After" in response.headers
+        assert (await client.get("/inventory/1")).status_code == 200
+
+        metrics_text = (await client.get("/metrics")).text
+        assert 'admission_shed_total{endpoint="/medications/{med_id}",reason="route_rate"}' in metrics_text
+        assert 'request_count_total{endpoint="/medications/{med_id}",method="GET"}' in metrics_text
+
+@pytest.mark.asyncio
+async def test_expensive_requests_are_shed_when_the_queue_is_full(limits, monkeypatch):
+    """
+    With every slot busy and the queue full, regex searches and whole XML listings get 503
+    right away while item lookups and pages are served.
+    """
+    monkeypatch.setattr(limits, "expensive_concurrency", 1)
+    monkeypatch.setattr(limits, "expensive_queue", 0)
+    limit = expensive_limits["/medications/"]
+    assert await limit.acquire() is None
+    try:
+        async with AsyncClient(app=app, base_url=BASE_URL) as client:
+            response = await client.get("/medications/", params={"regex": "in"})
+            assert response.status_code == 503
+            assert response.headers["Retry-After"] == "2"
+            assert (await client.get("/medications/", headers={"Accept": "application/xml"})).status_code == 503
+            assert (await client.get("/medications/", params={"limit": 10}, headers={"Accept": "application/xml"})).status_code == 200
+            assert (await client.get("/medications/1")).status_code == 200
+            assert (await client.get("/inventory/", params={"regex": "in"})).status_code == 200
+
+            metrics_text = (await client.get("/metrics")).text
+            assert 'admission_shed_total{endpoint="/medications/",reason="queue_full"}' in metrics_text
+    finally:
+        limit.release()
+    assert limit.active == 0
+
+@pytest.mark.asyncio
+async def test_expensive_requests_wait_for_a_slot(limits, monkeypatch):
+    """
+    Expensive requests beyond the limit queue in order, are admitted as slots free up and
+    are shed once they waited longer than the queue timeout.
+    """
+    monkeypatch.setattr(limits, "expensive_concurrency", 1)
+    monkeypatch.setattr(limits, "expensive_queue", 2)
+    monkeypatch.setattr(limits, "queue_timeout", 0.2)
+    limit = ConcurrencyLimit("/test/")
+    assert await limit.acquire() is None
+    second = asyncio.ensure_future(limit.acquire())
+    third = asyncio.ensure_future(limit.acquire())
+    await asyncio.sleep(0)
+    assert len(limit) == 2
+    assert await limit.acquire() == "queue_full"
+
+    limit.release()
+    assert await second is None
+    assert await third == "queue_timeout"
+    assert len(limit) == 0 and limit.active == 1
+    limit.release()
+    assert limit.active == 0
+
+def test_admission_settings_are_changed_by_admins(limits, monkeypatch):
+    """
+    PUT /admin/admission changes the limits of the worker and validates them.
+    """
+    monkeypatch.setattr("app.tracing.ADMIN_TOKEN", "secret")
+    monkeypatch.setattr(limits, "expensive_concurrency", limits.expensive_concurrency)
+    client = TestClient(app)
+    response = client.put("/admin/admission", json={"expensive_concurrency": 2}, headers={"X-Admin-Token": "secret"})
+    assert response.status_code == 200
+    assert response.json()["expensive_concurrency"] == 2 == limits.expensive_concurrency
+    assert client.put("/admin/admission", json={"expensive_concurrency": 0}, headers={"X-Admin-Token": "secret"}).status_code == 422
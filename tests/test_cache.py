@@ -0,0 +1,51 @@
+import pytest
+from httpx import AsyncClient
+from app.main import app
+from app.cache import ResponseCache, response_cache
+
+BASE_URL = "http://127.0.0.1:8000"  # Single variable for base_url
+
+def test_cache_evicts_least_recently_used():
+    cache = ResponseCache(max_bytes=10)
+    cache.put(("a",), b"1234", "application/json", ["a"])
+    cache.put(("b",), b"1234", "application/json", ["b"])
+    cache.get(("a",))
+    cache.put(("c",), b"1234", "application/json", ["c"])
+    assert cache.get(("a",)) is not None
+    assert cache.get(("b",)) is None
+    assert cache.size == 8
+
+def test_cache_invalidates_by_tag():
+    cache = ResponseCache(max_bytes=100)
+    cache.put(("list",), b"[]", "application/json", ["medications"])
+    cache.put(("item", 1), b"{}", "application/json", [("medication", 1)])
+    cache.put(("item", 2), b"{}", "application/json", [("medication", 2)])
+    cache.invalidate("medications", ("medication", 1))
+    assert cache.get(("list",)) is None
+    assert cache.get(("item", 1)) is None
+    assert cache.get(("item", 2)) is not None
+
+def test_cache_drops_entries_built_before_an_invalidation():
+    cache = ResponseCache(max_bytes=100)
+    generation = cache.generation
+    cache.invalidate("medications")
+    cache.put(("list",), b"[]", "application/json", ["medications"], generation)
+    assert len(cache) == 0
+
+@pytest.mark.asyncio
+async def test_list_responses_are_cached_per_media_type(monkeypatch):
+    monkeypatch.setattr("app.main.METRICS_CACHE_TTL", 0)
+    response_cache.clear()
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        json_response = await client.get("/inventory/")
+        xml_response = await client.get("/inventory/", headers={"Accept": "application/xml"})
+        assert xml_response.status_code == 200
+        assert xml_response.headers["Content-Type"].startswith("application/xml")
+        assert len(response_cache) == 2
+
+        cached = await client.get("/inventory/", headers={"Accept": "application/xml"})
+        assert cached.content == xml_response.content
+        assert (await client.get("/inventory/")).json() == json_response.json()
+
+        metrics = (await client.get("/metrics")).text
+        assert 'response_cache_hits_total{resource="inventory"}' in metrics
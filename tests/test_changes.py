@@ -0,0 +1,117 @@
+import asyncio
+import json
+import threading
+import pytest
+from httpx import AsyncClient
+from app.main import app
+from app.changes import ChangeLog, change_log
+from app.routes.changes import _event_stream
+
+BASE_URL = "http://127.0.0.1:8000"  # Single variable for base_url
+
+def test_change_log_keeps_the_last_entries():
+    log = ChangeLog(retention=3)
+    for record_id in range(1, 6):
+        log.append("inventory", record_id, {"id": record_id}, b'{"id":%d}' % record_id)
+    assert [seq for seq, _, _ in log.since(2, 10)] == [3, 4, 5]
+    assert log.since(4, 10)[0][2] == b'{"seq":5,"kind":"inventory","id":5,"op":"upsert","record":{"id":5}}'
+    assert log.since(5, 10) == []
+    assert log.since(1, 10) is None  # seq 2 is gone
+    assert log.since(6, 10) is None  # from a previous run of the log
+
+    log.append("inventory", 1)
+    assert log.since(5, 10)[0][1] == {"seq": 6, "kind": "inventory", "id": 1, "op": "delete", "record": None}
+    log.reset()
+    assert log.since(5, 10) is None
+    assert log.since(6, 10) == []
+
+@pytest.mark.asyncio
+async def test_change_log_wait_is_woken_by_appends_from_threads():
+    log = ChangeLog()
+    assert not await log.wait(0, 0.01)
+    timer = threading.Timer(0.05, lambda: log.append("medication", 1))
+    timer.start()
+    assert await log.wait(0, 5)
+    timer.join()
+
+@pytest.mark.asyncio
+async def test_get_changes():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        listing = await client.get("/inventory/")
+        since = int(listing.headers["X-Change-Seq"])
+
+        await client.post("/medications/", json={"id": 27, "name": "Change Medication"})
+        await client.delete("/medications/27")
+
+        response = await client.get("/changes/", params={"since": since})
+        assert response.status_code == 200
+        changes = [(change["kind"], change["id"], change["op"]) for change in response.json() if change["id"] == 27]
+        assert changes == [
+            ("medication", 27, "upsert"), ("inventory", 27, "upsert"),
+            ("medication", 27, "delete"), ("inventory", 27, "delete"),
+        ]
+        assert int(response.headers["X-Change-Seq"]) == change_log.last_seq
+
+        response = await client.get("/changes/", params={"since": since, "limit": 1})
+        assert len(response.json()) == 1
+        assert response.headers["X-Change-Seq"] == str(since + 1)
+
+        response = await client.get("/changes/", params={"since": since}, headers={"Accept": "application/xml"})
+        assert "<kind>medication</kind><id>27</id><op>upsert</op><record><id>27</id>" in response.text
+
+        response = await client.get("/changes/", params={"since": change_log.last_seq + 1})
+        assert response.status_code == 410
+        response = await client.get("/changes/stream", params={"since": change_log.last_seq + 1})
+        assert response.status_code == 410
+
+@pytest.mark.asyncio
+async def test_event_stream_sends_changes_as_they_happen():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        stream = _event_stream(change_log.last_seq)
+        first = asyncio.ensure_future(stream.__anext__())
+        await asyncio.sleep(0.01)
+        assert not first.done()
+
+        await client.post("/medications/", json={"id": 28, "name": "Streamed Medication"})
+        event = (await asyncio.wait_for(first, 5)).decode()
+        lines = event.splitlines()
+        assert lines[0] == f"id: {change_log.last_seq - 1}"
+        assert lines[1] == "event: change"
+        assert json.loads(lines[2][len("data: "):])["record"]["name"] == "Streamed Medication"
+        await stream.aclose()
+        await client.delete("/medications/28")
+
+@pytest.mark.asyncio
+async def test_event_stream_resets_clients_that_fell_behind(monkeypatch):
+    log = ChangeLog(retention=2)
+    monkeypatch.setattr("app.routes.changes.change_log", log)
+    stream = _event_stream(0)
+    for record_id in range(3):
+        log.append("medication", record_id)
+    assert await stream.__anext__() == b"event: reset\ndata: {}\n\n"
+
+def test_shared_store_changes_are_recorded_once(monkeypatch, tmp_path):
+    """
+    Syncing from a shared store records the writes of other processes, but not this process's own again.
+    """
+    from app import data
+    from app.models import Inventory, Medication
+    from app.repository import SQLiteRepository
+    path = str(tmp_path / "shared.db")
+    monkeypatch.setattr(data, "repository", SQLiteRepository(path))
+    monkeypatch.setattr(data, "_synced_seq", 0)
+    other_process = SQLiteRepository(path)
+    seq = change_log.last_seq
+
+    data.save_medication(44, Medication(id=44, name="Own Write"))
+    data.save_inventory(44, Inventory(medication_id=44, quantity=1, shelf_id="S1", shelf_location="Shelf S1"))
+    other_process.save_medication(45, Medication(id=45, name="Other Write"))
+    data.sync_from_repository()
+    data.sync_from_repository()
+
+    changes = [(change["kind"], change["id"]) for _, change, _ in change_log.since(seq, 100)]
+    assert changes == [("medication", 44), ("inventory", 44), ("medication", 45)]
+    assert data.medications[45].name == "Other Write"
+    data.remove_medication(44)
+    data.remove_medication(45)
+    data.remove_inventory(44)
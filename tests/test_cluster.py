@@ -0,0 +1,130 @@
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+import httpx
+import pytest
+
+class Cluster:
+    """
+    N API nodes sharing one SQLite store and an invalidation bus. Every node is a
+    uvicorn process of its own, since the working set lives in the process.
+    """
+
+    def __init__(self, directory, size: int, bus: str):
+        env = dict(
+            os.environ,
+            STORAGE_URL=f"sqlite:///{directory / 'store.db'}",
+            INVALIDATION_BUS=f"{bus}:///{directory / ('bus' if bus == 'unix' else 'bus.db')}",
+            # Long enough that only the bus can make the nodes converge
+            STORE_POLL_SECONDS="60",
+            PYTHONPATH=os.getcwd(),
+        )
+        self.processes = []
+        self.clients = []
+        try:
+            # One after the other, so only the first node seeds the demo data
+            for _ in range(size):
+                self._start(env)
+        except BaseException:
+            self.close()
+            raise
+
+    def _start(self, env: dict):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            port = s.getsockname()[1]
+        self.processes.append(subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "app.main:app", "--port", str(port), "--log-level", "warning"], env=env
+        ))
+        client = httpx.Client(base_url=f"http://127.0.0.1:{port}", timeout=10)
+        self.clients.append(client)
+        deadline = time.monotonic() + 30
+        while True:
+            try:
+                if client.get("/medications/1").status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            if time.monotonic() > deadline or self.processes[-1].poll() is not None:
+                raise RuntimeError("node did not come up")
+            time.sleep(0.05)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
+        for process in self.processes:
+            process.terminate()
+        for process in self.processes:
+            process.wait()
+
+@pytest.fixture(params=["unix", "sqlite"])
+def cluster(request, tmp_path):
+    cluster = Cluster(tmp_path, 3, request.param)
+    yield cluster
+    cluster.close()
+
+def test_nodes_read_their_writes(cluster):
+    """
+    A write's X-Store-Seq, sent to another node, makes that node serve the write.
+    """
+    first, second, third = cluster.clients
+    created = first.post("/medications/", json={"id": 31, "name": "Clustered Medication"})
+    assert created.status_code == 200
+    seq = created.headers["X-Store-Seq"]
+    assert second.get("/medications/31", headers={"X-Store-Seq": seq}).json()["name"] == "Clustered Medication"
+
+    updated = third.put("/inventory/31", json={"medication_id": 31, "quantity": 7, "shelf_id": "C1", "shelf_location": "Shelf C1"},
+                        headers={"If-Match": "*", "X-Store-Seq": seq})
+    assert updated.status_code == 200
+    assert first.get("/inventory/31", headers={"X-Store-Seq": updated.headers["X-Store-Seq"]}).json()["quantity"] == 7
+
+def test_nodes_converge_under_load(cluster):
+    """
+    Concurrent writers on random nodes always read their own writes on any node,
+    and once they stop every node serves the same inventory without being asked
+    to sync.
+    """
+    workers, writes = 4, 25
+    failures = []
+
+    def write(worker: int):
+        rng = random.Random(worker)
+        med_ids = [32 + worker * 3 + i for i in range(3)]
+        seq = "0"
+        try:
+            for med_id in med_ids:
+                created = rng.choice(cluster.clients).post("/medications/", json={"id": med_id, "name": f"Load {med_id}"})
+                assert created.status_code == 200
+                seq = created.headers["X-Store-Seq"]
+            for _ in range(writes):
+                med_id, quantity = rng.choice(med_ids), rng.randint(0, 100)
+                response = rng.choice(cluster.clients).put(
+                    f"/inventory/{med_id}", json={"medication_id": med_id, "quantity": quantity, "shelf_id": "L1", "shelf_location": "Shelf L1"},
+                    headers={"If-Match": "*", "X-Store-Seq": seq}
+                )
+                assert response.status_code == 200
+                seq = response.headers["X-Store-Seq"]
+                read = rng.choice(cluster.clients).get(f"/inventory/{med_id}", headers={"X-Store-Seq": seq})
+                assert read.json()["quantity"] == quantity
+        except AssertionError as e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=write, args=(worker,)) for worker in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not failures
+
+    deadline = time.monotonic() + 10
+    while True:
+        listings = [client.get("/inventory/").json() for client in cluster.clients]
+        if all(listing == listings[0] for listing in listings):
+            break
+        assert time.monotonic() < deadline, "nodes did not converge"
+        time.sleep(0.1)
+    assert len([item for item in listings[0] if item["shelf_id"] == "L1"]) == workers * 3
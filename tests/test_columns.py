@@ -0,0 +1,113 @@
+import subprocess
+import sys
+import threading
+from array import array
+import pytest
+from app import columns
+from app.columns import InventoryColumns
+from app.models import Inventory
+
+def inv(med_id, quantity, shelf_id, shelf_location="Shelf 1"):
+    return Inventory(medication_id=med_id, quantity=quantity, shelf_id=shelf_id, shelf_location=shelf_location)
+
+def test_columns_behave_like_a_dict_of_inventory():
+    store = InventoryColumns()
+    store[1] = inv(1, 100, "A1")
+    store[2] = inv(2, 0, "A2")
+    store[3] = inv(3, 5, "A1", "Shelf 2")
+    assert store[3] == inv(3, 5, "A1", "Shelf 2")
+    assert len(store) == 3 and 2 in store and 4 not in store
+    assert store.get(4) is None
+
+    # Deleting moves the last row into the freed one
+    del store[1]
+    assert sorted(store) == [2, 3]
+    assert store[3] == inv(3, 5, "A1", "Shelf 2")
+    store[2] = inv(2, 7, "A1")
+    assert store[2].quantity == 7
+    assert store.shelf_ids.values == ["A1", "A2"]
+
+    with pytest.raises(KeyError):
+        del store[1]
+    store.clear()
+    assert len(store) == 0 and list(store.values()) == []
+
+def test_values_out_of_range_leave_the_columns_unchanged():
+    store = InventoryColumns()
+    store[1] = inv(1, 100, "A1")
+    with pytest.raises(OverflowError):
+        store[2**63] = Inventory.construct(medication_id=2**63, quantity=0, shelf_id="A1", shelf_location="Shelf 1")
+    with pytest.raises(OverflowError):
+        store[1] = Inventory.construct(medication_id=1, quantity=2**63, shelf_id="A1", shelf_location="Shelf 1")
+    store[5] = inv(5, 3, "A2")
+    assert len(store) == 2 and len(store.quantity) == 2
+    assert store[1] == inv(1, 100, "A1") and store[5] == inv(5, 3, "A2")
+    del store[1]
+    assert store[5] == inv(5, 3, "A2")
+
+def test_reads_never_see_a_row_moved_by_a_delete():
+    # Deleting moves the last row, so a delete on another thread between
+    # resolving a row and reading it would mix two medications' inventory
+    store = InventoryColumns()
+    store[1] = inv(1, 100, "A1")
+    store[2] = inv(2, 7, "A2")
+    deleter = threading.Thread(target=store.__delitem__, args=(1,))
+
+    class DeletingColumn(array):
+        def __getitem__(self, row):
+            if deleter.ident is None:
+                deleter.start()
+                deleter.join(0.1)
+            return super().__getitem__(row)
+
+    store.quantity = DeletingColumn("q", store.quantity)
+    assert store[1] == inv(1, 100, "A1")
+    deleter.join()
+    assert list(store) == [2] and store.quantity.tolist() == [7]
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_stats(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(columns, "numpy", None)
+    store = InventoryColumns()
+    for med_id, quantity, shelf_id in [(1, 100, "A1"), (2, 0, "A2"), (3, 5, "A1"), (4, 10, "B1"), (5, 11, "B1")]:
+        store[med_id] = inv(med_id, quantity, shelf_id)
+    store[6] = inv(6, 1, "C1")
+    del store[6]  # C1 has no rows left and is left out
+
+    assert store.stats(10) == {"items": 5, "quantity": 126, "empty": 1, "low_stock": 2}
+    assert store.stats(10, "shelf_id")["groups"] == [
+        {"shelf_id": "A1", "items": 2, "quantity": 105, "empty": 0, "low_stock": 1},
+        {"shelf_id": "A2", "items": 1, "quantity": 0, "empty": 1, "low_stock": 0},
+        {"shelf_id": "B1", "items": 2, "quantity": 21, "empty": 0, "low_stock": 1},
+    ]
+    assert store.stats(10, "shelf_location")["groups"] == [
+        {"shelf_location": "Shelf 1", "items": 5, "quantity": 126, "empty": 1, "low_stock": 2},
+    ]
+    assert InventoryColumns().stats(10, "shelf_id") == {"items": 0, "quantity": 0, "empty": 0, "low_stock": 0, "groups": []}
+
+@pytest.mark.parametrize("use_numpy", [True, False])
+def test_stats_sum_large_quantities_exactly(monkeypatch, use_numpy):
+    if use_numpy:
+        pytest.importorskip("numpy")
+    else:
+        monkeypatch.setattr(columns, "numpy", None)
+    store = InventoryColumns()
+    store[1] = inv(1, 2**53 + 1, "A1")
+    store[2] = inv(2, 2**53 + 1, "A1")
+    store[3] = inv(3, 1, "A1")
+    assert store.stats(10, "shelf_id")["groups"][0]["quantity"] == 2**54 + 3
+    # Beyond int64 the totals are still exact
+    store[4] = inv(4, 2**63 - 1, "A1")
+    store[5] = inv(5, 2**63 - 1, "A2")
+    stats = store.stats(10, "shelf_id")
+    assert stats["quantity"] == 2**54 + 3 + 2**64 - 2
+    assert [group["quantity"] for group in stats["groups"]] == [2**54 + 3 + 2**63 - 1, 2**63 - 1]
+
+def test_numpy_is_imported_by_the_first_aggregate():
+    pytest.importorskip("numpy")
+    script = "import sys, app.main, app.data; print('numpy' in sys.modules); app.data.inventory.stats(10); print('numpy' in sys.modules)"
+    output = subprocess.run([sys.executable, "-c", script], capture_output=True, text=True, check=True).stdout
+    assert output.split() == ["False", "True"]
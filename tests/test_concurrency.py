@@ -0,0 +1,110 @@
+import threading
+import pytest
+from fastapi.testclient import TestClient
+from app.main import app
+from app.data import locked_write, MAX_WRITE_RETRIES
+from app.metrics import WRITE_RETRIES, WRITE_CONFLICTS
+from app.repository import ConcurrentUpdate
+
+def test_concurrent_conditional_updates_lose_nothing():
+    """
+    Writers racing read-modify-write cycles on one item with If-Match: every
+    successful PUT must be reflected in the final quantity.
+    """
+    client = TestClient(app)
+    client.post("/medications/", json={"id": 29, "name": "Contended Medication"})
+    workers, increments = 8, 20
+
+    def increment():
+        worker_client = TestClient(app)
+        done = 0
+        while done < increments:
+            current = worker_client.get("/inventory/29")
+            inv = current.json()
+            response = worker_client.put(
+                "/inventory/29",
+                json=dict(inv, quantity=inv["quantity"] + 1),
+                headers={"If-Match": current.headers["ETag"]}
+            )
+            if response.status_code == 412:
+                continue
+            assert response.status_code == 200
+            done += 1
+
+    threads = [threading.Thread(target=increment) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert client.get("/inventory/29").json()["quantity"] == workers * increments
+    client.delete("/medications/29")
+
+def test_locked_write_retries_concurrent_updates():
+    attempts = []
+
+    def write():
+        attempts.append(1)
+        if len(attempts) == 1:
+            raise ConcurrentUpdate("changed")
+        return "saved"
+
+    retries = WRITE_RETRIES._value.get()
+    assert locked_write([1], write) == "saved"
+    assert len(attempts) == 2
+    assert WRITE_RETRIES._value.get() == retries + 1
+
+    def always_conflicts():
+        attempts.append(1)
+        raise ConcurrentUpdate("changed")
+
+    attempts.clear()
+    conflicts = WRITE_CONFLICTS._value.get()
+    with pytest.raises(ConcurrentUpdate):
+        locked_write([1, 2], always_conflicts)
+    assert len(attempts) == MAX_WRITE_RETRIES + 1
+    assert WRITE_CONFLICTS._value.get() == conflicts + 1
+
+def test_locked_write_holds_the_lock_of_every_id():
+    inside = threading.Event()
+    release = threading.Event()
+    order = []
+
+    def slow_write():
+        inside.set()
+        release.wait(5)
+        order.append("first")
+
+    thread = threading.Thread(target=locked_write, args=([3, 1000], slow_write))
+    thread.start()
+    inside.wait(5)
+    second = threading.Thread(target=locked_write, args=([1000], lambda: order.append("second")))
+    second.start()
+    second.join(0.05)
+    assert order == []  # still waiting for id 1000
+    release.set()
+    thread.join()
+    second.join()
+    assert order == ["first", "second"]
+
+@pytest.mark.asyncio
+async def test_writes_wait_for_held_locks_off_the_event_loop():
+    """
+    A PUT whose record lock is held on a worker thread waits for it there, and other requests are still served.
+    """
+    import asyncio
+    import time
+    from httpx import AsyncClient
+    from app.data import LOCK_STRIPES, _record_locks
+
+    lock = _record_locks[1 % LOCK_STRIPES]
+    lock.acquire()
+    threading.Timer(1.0, lock.release).start()
+    async with AsyncClient(app=app, base_url="http://127.0.0.1:8000") as client:
+        inv = (await client.get("/inventory/1")).json()
+        start = time.monotonic()
+        put = asyncio.ensure_future(client.put("/inventory/1", json=inv, headers={"If-Match": "*"}))
+        await asyncio.sleep(0.1)
+        assert (await client.get("/medications/2")).status_code == 200
+        assert time.monotonic() - start < 0.5 and not put.done()
+        assert (await put).status_code == 200
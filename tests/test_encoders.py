@@ -0,0 +1,94 @@
+import json
+import pytest
+import xmltodict
+from httpx import AsyncClient
+from app.main import app
+from app.models import Medication, Inventory
+from app.encoders import encode_json, join_json, encode_xml, encode_xml_item
+from app.utils import negotiate, LIST_MEDIA_TYPES
+
+BASE_URL = "http://127.0.0.1:8000"  # Single variable for base_url
+
+MEDICATION = Medication(id=1, name="Salt & <Pepper>", description=None).dict()
+INVENTORY = Inventory(medication_id=1, quantity=3, shelf_id="B2", shelf_location="Shelf \"2\"").dict()
+
+def test_encode_json_matches_json_response_encoding():
+    medication = Medication(id=1, name="Café \"Crème\"", description=None)
+    expected = json.dumps(medication.dict(), ensure_ascii=False, separators=(",", ":")).encode()
+    assert encode_json(medication) == expected
+    assert encode_json({"results": [medication]}) == b'{"results":[' + expected + b"]}"
+    assert json.loads(join_json([expected, expected])) == [medication.dict(), medication.dict()]
+
+def test_private_attributes_are_not_encoded():
+    medication = Medication(id=1, name="Aspirin")
+    medication._icon_file = "0" * 64 + ".png"
+    assert b"icon_file" not in encode_json(medication)
+    assert "icon_file" not in encode_xml(medication, Medication)
+
+@pytest.mark.parametrize("data, model", [
+    (MEDICATION, Medication),
+    ([MEDICATION, MEDICATION], Medication),
+    (INVENTORY, Inventory),
+    ([], Inventory),
+    ({"results": [{"medication_id": 1, "status": 200, "etag": None, "ok": True}]}, None),
+])
+def test_encode_xml_matches_xmltodict(data, model):
+    wrapped = {"item": data} if isinstance(data, list) else data
+    assert encode_xml(data, model) == xmltodict.unparse({"response": wrapped})
+    assert encode_xml(data) == xmltodict.unparse({"response": wrapped})
+    assert encode_xml(data, model, pretty=True) == xmltodict.unparse({"response": wrapped}, pretty=True)
+
+def test_encode_xml_item_matches_xmltodict():
+    expected = xmltodict.unparse({"item": MEDICATION}, full_document=False)
+    assert encode_xml_item(MEDICATION, Medication) == expected
+    assert encode_xml_item(MEDICATION) == expected
+
+@pytest.mark.parametrize("accept, expected", [
+    ("application/xml", ("application/xml", False)),
+    ("text/xml", ("application/xml", False)),
+    ("application/xml; pretty=true", ("application/xml", True)),
+    ("application/xml;q=0.5, application/json", ("application/json", False)),
+    ("application/json;q=0.2, application/*;q=0.9, application/xml", ("application/xml", False)),
+    ("*/*", ("application/json", False)),
+    ("text/html, */*;q=0.1", ("application/json", False)),
+    ("application/json;q=0, */*", ("application/xml", False)),
+    ("text/html", ("application/json", False)),
+    ("", ("application/json", False)),
+    ("application/json;charset=utf-8, application/json", ("application/json", False)),
+    ("text/xml, application/xml;charset=utf-8", ("application/xml", False)),
+    ("application/xml; pretty=true, application/xml", ("application/xml", True)),
+])
+def test_negotiate(accept, expected):
+    assert negotiate(accept) == expected
+
+def test_negotiate_list_media_types():
+    assert negotiate("application/x-ndjson", LIST_MEDIA_TYPES) == ("application/x-ndjson", False)
+    assert negotiate("application/x-ndjson;q=0.5, application/json", LIST_MEDIA_TYPES) == ("application/json", False)
+    assert negotiate("application/x-ndjson", ("application/json", "application/xml")) == ("application/json", False)
+
+@pytest.mark.asyncio
+async def test_xml_is_compact_unless_pretty_is_requested():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        compact = await client.get("/medications/1", headers={"Accept": "text/xml"})
+        assert compact.status_code == 200
+        assert compact.headers["content-type"] == "application/xml"
+        assert "\n\t" not in compact.text
+        pretty = await client.get("/medications/1", headers={"Accept": "application/xml; pretty=true"})
+        assert "\n\t<id>1</id>" in pretty.text
+        assert xmltodict.parse(pretty.text) == xmltodict.parse(compact.text)
+
+@pytest.mark.asyncio
+async def test_json_list_is_joined_from_stored_fragments():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        response = await client.get("/medications/", params={"regex": "^Asp"})
+        assert response.headers["content-type"] == "application/json"
+        assert response.json()[0] == {"id": 1, "name": "Aspirin", "description": "Pain reliever", "icon_url": None}
+
+@pytest.mark.asyncio
+async def test_records_that_fail_to_encode_are_not_stored():
+    from app.data import medications, medication_ids, medication_json, save_medication
+    with pytest.raises(TypeError):
+        save_medication(43, Medication.construct(id=43, name="Unencodable", description=object()))
+    assert 43 not in medications and 43 not in medication_json and 43 not in medication_ids.all()
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        assert (await client.get("/medications/", params={"limit": 1000})).status_code == 200
@@ -1,3 +1,4 @@
+import json
 import pytest
 from httpx import AsyncClient
 from app.main import app
@@ -65,3 +66,148 @@ async def test_delete_inventory_not_allowed():
         response = await client.delete("/inventory/1")
         assert response.status_code == 405  # Method Not Allowed
         assert response.json()["detail"] == "Method Not Allowed"
+
+@pytest.mark.asyncio
+async def test_get_low_stock_and_empty_inventory():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        # Step 1: Create a medication, which starts with an empty inventory item
+        await client.post("/medications/", json={"id": 20, "name": "Low Stock Medication"})
+        response = await client.get("/inventory/", params={"empty": True})
+        assert response.status_code == 200
+        assert 20 in [inv["medication_id"] for inv in response.json()]
+
+        # Step 2: Restock it to a quantity below the low-stock threshold
+        etag = (await client.get("/inventory/20")).headers["ETag"]
+        response = await client.put(
+            "/inventory/20",
+            json={"medication_id": 20, "quantity": 3, "shelf_id": "D1", "shelf_location": "Shelf 4"},
+            headers={"If-Match": etag}
+        )
+        assert response.status_code == 200
+
+        response = await client.get("/inventory/", params={"low_stock": True})
+        assert response.status_code == 200
+        assert [inv["medication_id"] for inv in response.json()] == [20]
+        response = await client.get("/inventory/", params={"empty": True})
+        assert 20 not in [inv["medication_id"] for inv in response.json()]
+
+        # Step 3: Deleting the medication removes it from the low-stock filter
+        await client.delete("/medications/20")
+        response = await client.get("/inventory/", params={"low_stock": True})
+        assert response.status_code == 404
+
+@pytest.mark.asyncio
+async def test_batch_update_inventory_per_item():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        etag = (await client.get("/inventory/3")).headers["ETag"]
+        updates = [
+            {"medication_id": 3, "quantity": 45, "shelf_id": "A3", "shelf_location": "Shelf 3", "if_match": etag},
+            {"medication_id": 2, "quantity": 70, "shelf_id": "A2", "shelf_location": "Shelf 2"},
+            {"medication_id": 999, "quantity": 1, "shelf_id": "Z9", "shelf_location": "Shelf 9"},
+            {"medication_id": 3, "quantity": 40, "shelf_id": "A3", "shelf_location": "Shelf 3", "if_match": etag},
+            {"medication_id": 2, "quantity": "many"},
+        ]
+        response = await client.patch("/inventory/", json=updates)
+        assert response.status_code == 207
+        assert [result["status"] for result in response.json()["results"]] == [200, 200, 404, 412, 422]
+
+        response = await client.get("/inventory/3")
+        assert response.json()["quantity"] == 45
+
+@pytest.mark.asyncio
+async def test_batch_update_inventory_atomic_and_ndjson():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        lines = [
+            {"medication_id": 3, "quantity": 1, "shelf_id": "A3", "shelf_location": "Shelf 3"},
+            {"medication_id": 3, "quantity": 2, "shelf_id": "A3", "shelf_location": "Shelf 3", "if_match": "\"stale\""},
+        ]
+        body = "\n".join(json.dumps(line) for line in lines)
+        response = await client.patch(
+            "/inventory/",
+            params={"atomic": True},
+            content=body,
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        assert response.status_code == 409
+        assert [result["status"] for result in response.json()["results"]] == [424, 412]
+        assert (await client.get("/inventory/3")).json()["quantity"] != 1
+
+        response = await client.patch(
+            "/inventory/",
+            params={"atomic": True},
+            content=json.dumps(lines[0]),
+            headers={"Content-Type": "application/x-ndjson"}
+        )
+        assert response.status_code == 200
+        assert (await client.get("/inventory/3")).headers["ETag"] == response.json()["results"][0]["etag"]
+
+@pytest.mark.asyncio
+async def test_inventory_stats_by_shelf():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        await client.post("/medications/", json={"id": 25, "name": "Stats Medication"})
+        etag = (await client.get("/inventory/25")).headers["ETag"]
+        await client.put(
+            "/inventory/25",
+            json={"medication_id": 25, "quantity": 7, "shelf_id": "Z9", "shelf_location": "Shelf 9"},
+            headers={"If-Match": etag}
+        )
+
+        response = await client.get("/inventory/stats")
+        assert response.status_code == 200
+        totals = response.json()
+        assert totals["items"] == len((await client.get("/inventory/")).json())
+
+        response = await client.get("/inventory/stats", params={"group_by": "shelf_id"})
+        assert response.status_code == 200
+        groups = {group["shelf_id"]: group for group in response.json()["groups"]}
+        assert groups["Z9"] == {"shelf_id": "Z9", "items": 1, "quantity": 7, "empty": 0, "low_stock": 1}
+        assert sum(group["quantity"] for group in groups.values()) == totals["quantity"]
+
+        response = await client.get("/inventory/stats", headers={"If-None-Match": response.headers["ETag"]}, params={"group_by": "shelf_id"})
+        assert response.status_code == 304
+
+        response = await client.get("/inventory/stats", params={"group_by": "name"})
+        assert response.status_code == 422
+
+@pytest.mark.asyncio
+async def test_shelf_queries_follow_moves(monkeypatch):
+    monkeypatch.setattr("app.main.METRICS_CACHE_TTL", 0)
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        await client.post("/medications/", json={"id": 26, "name": "Shelf Medication"})
+        etag = (await client.get("/inventory/26")).headers["ETag"]
+        response = await client.put(
+            "/inventory/26",
+            json={"medication_id": 26, "quantity": 2, "shelf_id": "Y1", "shelf_location": "Aisle Y"},
+            headers={"If-Match": etag}
+        )
+        assert response.status_code == 200
+
+        response = await client.get("/inventory/shelves/Y1")
+        assert response.status_code == 200
+        assert [inv["medication_id"] for inv in response.json()] == [26]
+        near_empty = (await client.get("/inventory/shelves", params={"near_empty": True})).json()
+        assert "Y1" in [shelf["shelf_id"] for shelf in near_empty]
+
+        # Moving the item to another shelf with plenty of stock
+        etag = (await client.get("/inventory/26")).headers["ETag"]
+        response = await client.put(
+            "/inventory/26",
+            json={"medication_id": 26, "quantity": 500, "shelf_id": "Y2", "shelf_location": "Aisle Y"},
+            headers={"If-Match": etag}
+        )
+        assert response.status_code == 200
+        assert (await client.get("/inventory/shelves/Y1")).status_code == 404
+        assert [inv["medication_id"] for inv in (await client.get("/inventory/shelves/Y2")).json()] == [26]
+        shelves = {shelf["shelf_id"]: shelf for shelf in (await client.get("/inventory/shelves")).json()}
+        assert shelves["Y2"]["quantity"] == 500 and "Y1" not in shelves
+        near_empty = (await client.get("/inventory/shelves", params={"near_empty": True})).json()
+        assert "Y2" not in [shelf["shelf_id"] for shelf in near_empty]
+
+        # Only the series for the new shelf is left in the metrics
+        metrics_text = (await client.get("/metrics")).text
+        assert 'inventory_quantity{medication_id="26",shelf_id="Y2",shelf_location="Aisle Y"} 500.0' in metrics_text
+        assert 'shelf_id="Y1"' not in metrics_text
+
+        await client.delete("/medications/26")
+        assert (await client.get("/inventory/shelves/Y2")).status_code == 404
+        assert 'medication_id="26"' not in (await client.get("/metrics")).text
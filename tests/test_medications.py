@@ -2,7 +2,10 @@ import pytest
 from httpx import AsyncClient
 from app.main import app
 import base64
+import io
+import os
 from fastapi.testclient import TestClient
+from app.utils import IMAGE_DIR
 
 BASE_URL = "http://127.0.0.1:8000"  # Single variable for base_url
 
@@ -139,3 +142,158 @@ def test_delete_medication_icon():
     get_response = client.get("/medications/1/icon")
     assert get_response.status_code == 404
     assert get_response.json()["detail"] == "Image not found"
+
+@pytest.mark.asyncio
+async def test_get_medication_not_modified():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        response = await client.get("/medications/2")
+        etag = response.headers["ETag"]
+        response = await client.get("/medications/2", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+        assert response.headers["ETag"] == etag
+
+@pytest.mark.asyncio
+async def test_list_medications_collection_etag():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        response = await client.get("/medications/")
+        etag = response.headers["ETag"]
+        assert etag.startswith('W/"')
+
+        response = await client.get("/medications/", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+        # Filters and media types get their own ETag
+        response = await client.get("/medications/", params={"regex": "in"})
+        assert response.headers["ETag"] != etag
+
+        # Any write invalidates the collection ETag
+        await client.post("/medications/", json={"id": 21, "name": "Cetirizine"})
+        response = await client.get("/medications/", headers={"If-None-Match": etag})
+        assert response.status_code == 200
+        assert response.headers["ETag"] != etag
+        await client.delete("/medications/21")
+        response = await client.get("/medications/", headers={"If-None-Match": etag})
+        assert response.status_code == 304
+
+def test_get_medication_icon_conditional_and_range():
+    files = {"file": ("icon.png", b"0123456789", "image/png")}
+    assert client.post("/medications/2/icon", files=files).status_code == 200
+
+    response = client.get("/medications/2/icon")
+    assert response.status_code == 200
+    assert response.content == b"0123456789"
+    assert "Last-Modified" in response.headers
+    etag = response.headers["ETag"]
+
+    assert client.get("/medications/2/icon", headers={"If-None-Match": etag}).status_code == 304
+
+    response = client.get("/medications/2/icon", headers={"Range": "bytes=2-5"})
+    assert response.status_code == 206
+    assert response.content == b"2345"
+    assert response.headers["Content-Range"] == "bytes 2-5/10"
+
+    response = client.get("/medications/2/icon", headers={"Range": "bytes=20-"})
+    assert response.status_code == 416
+
+def test_identical_icons_share_one_file():
+    files = {"file": ("icon.png", b"shared_icon_data", "image/png")}
+    client.post("/medications/", json={"id": 22, "name": "Loratadine"})
+    client.post("/medications/", json={"id": 23, "name": "Desloratadine"})
+    client.post("/medications/22/icon", files=files)
+    client.post("/medications/23/icon", files=files)
+    assert client.get("/medications/22/icon").headers["ETag"] == client.get("/medications/23/icon").headers["ETag"]
+
+    # Deleting one medication keeps the file the other still uses
+    assert client.delete("/medications/22").status_code == 200
+    assert client.get("/medications/23/icon").content == b"shared_icon_data"
+    assert client.delete("/medications/23/icon").status_code == 200
+    assert client.get("/medications/23/icon").status_code == 404
+    client.delete("/medications/23")
+
+def test_get_medication_icon_thumbnail():
+    from PIL import Image
+    from app.data import medications
+    from app.thumbnails import schedule_derivatives
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (300, 200), "red").save(buffer, format="PNG")
+    client.post("/medications/", json={"id": 24, "name": "Cetirizine"})
+    assert client.post("/medications/24/icon", files={"file": ("icon.png", buffer.getvalue(), "image/png")}).status_code == 200
+
+    schedule_derivatives(medications[24]._icon_file).result(timeout=60)
+    response = client.get("/medications/24/icon", params={"size": 64})
+    assert response.status_code == 200
+    assert response.headers["Content-Type"] == "image/webp"
+    assert Image.open(io.BytesIO(response.content)).size == (64, 43)
+    assert response.headers["ETag"] != client.get("/medications/24/icon").headers["ETag"]
+
+    assert client.get("/medications/24/icon", params={"size": 65}).status_code == 400
+
+    # Deleting the medication removes the derivatives along with the icon
+    client.delete("/medications/24")
+    assert not [name for name in os.listdir(IMAGE_DIR) if name.startswith(response.headers["ETag"].strip('"').split(".")[0])]
+
+def test_icons_with_the_same_content_share_derivatives():
+    from PIL import Image
+    from app.data import medications
+    from app.thumbnails import schedule_derivatives
+
+    buffer = io.BytesIO()
+    Image.new("RGB", (200, 200), "blue").save(buffer, format="PNG")
+    client.post("/medications/", json={"id": 25, "name": "Fexofenadine"})
+    client.post("/medications/", json={"id": 26, "name": "Levocetirizine"})
+    assert client.post("/medications/25/icon", files={"file": ("icon.png", buffer.getvalue(), "image/png")}).status_code == 200
+    assert client.post("/medications/26/icon", files={"file": ("icon.jpg", buffer.getvalue(), "image/jpeg")}).status_code == 200
+    schedule_derivatives(medications[25]._icon_file).result(timeout=60)
+    schedule_derivatives(medications[26]._icon_file).result(timeout=60)
+
+    # Dropping the last reference to the .png keeps the thumbnails the .jpg uses
+    assert client.delete("/medications/25/icon").status_code == 200
+    assert client.get("/medications/26/icon", params={"size": 64}).headers["Content-Type"] == "image/webp"
+    client.delete("/medications/25")
+    client.delete("/medications/26")
+
+def test_update_keeps_the_icon():
+    client.post("/medications/", json={"id": 27, "name": "Montelukast"})
+    assert client.post("/medications/27/icon", files={"file": ("icon.png", b"montelukast_icon", "image/png")}).status_code == 200
+    etag = client.get("/medications/27").headers["ETag"]
+
+    # icon_url in the body is ignored like the icon file behind it
+    response = client.put("/medications/27", json={"id": 27, "name": "Montelukast 10mg", "icon_url": "http://example.com/icon.png"}, headers={"If-Match": etag})
+    assert response.status_code == 200
+    assert response.json()["icon_url"] == "/medications/27/icon"
+    assert client.get("/medications/27/icon").content == b"montelukast_icon"
+    client.delete("/medications/27")
+
+def test_large_listings_are_built_on_a_worker_thread(monkeypatch):
+    import asyncio
+    from app.cache import response_cache
+    from app.routes import medications as routes
+
+    on_event_loop = []
+    list_medications = routes._list_medications
+
+    def spy(*args):
+        try:
+            asyncio.get_running_loop()
+            on_event_loop.append(True)
+        except RuntimeError:
+            on_event_loop.append(False)
+        return list_medications(*args)
+
+    monkeypatch.setattr(routes, "_list_medications", spy)
+    monkeypatch.setattr("app.data.INLINE_BUILD_LIMIT", 0)
+    response_cache.clear()
+    # A page is built right away, the whole collection off the event loop
+    assert client.get("/medications/", params={"limit": 2}).status_code == 200
+    assert client.get("/medications/").json() == client.get("/medications/", params={"limit": 1000}).json()
+    assert on_event_loop == [True, False, True]
+    # Regex searches always run on a worker thread, however small the page
+    assert client.get("/medications/", params={"regex": "in", "limit": 1}).status_code == 200
+    assert on_event_loop[-1] is False
+
+def test_ids_beyond_64_bits_are_rejected():
+    for med_id in (2**63, 10**20, -2**63 - 1):
+        assert client.post("/medications/", json={"id": med_id, "name": "Too Large"}).status_code == 422
+    assert client.put("/inventory/42", json={"medication_id": 42, "quantity": 2**63, "shelf_id": "A1", "shelf_location": "Shelf 1"}, headers={"If-Match": "*"}).status_code == 422
+    assert client.get("/inventory/").status_code == 200
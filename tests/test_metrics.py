@@ -17,3 +17,28 @@ def test_metrics_endpoint():
     assert 'request_count_total' in metrics_text
     assert "# HELP inventory_quantity Quantity of medications in inventory" in metrics_text
     assert "# TYPE inventory_quantity gauge" in metrics_text
+
+def test_request_metrics_use_route_templates(monkeypatch):
+    """
+    Requests for different medication ids must share one series labelled with the route template.
+    """
+    monkeypatch.setattr("app.main.METRICS_CACHE_TTL", 0)
+    client.get("/medications/1")
+    client.get("/medications/2")
+    client.get("/no-such-route")
+
+    metrics_text = client.get("/metrics").text
+    assert 'request_count_total{endpoint="/medications/{med_id}",method="GET"}' in metrics_text
+    assert 'endpoint="/medications/1"' not in metrics_text
+    assert 'request_count_total{endpoint="<unmatched>",method="GET"}' in metrics_text
+    assert 'request_latency_seconds_bucket{endpoint="/medications/{med_id}",le="0.005",method="GET"}' in metrics_text
+
+def test_metrics_output_is_cached_for_ttl(monkeypatch):
+    """
+    Scrapes within METRICS_CACHE_TTL of each other get the same rendering.
+    """
+    monkeypatch.setattr("app.main.METRICS_CACHE_TTL", 0)
+    first = client.get("/metrics").text
+    monkeypatch.setattr("app.main.METRICS_CACHE_TTL", 60)
+    client.get("/medications/1")
+    assert client.get("/metrics").text == first
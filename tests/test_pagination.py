@@ -0,0 +1,78 @@
+import json
+import pytest
+import xmltodict
+from httpx import AsyncClient
+from app.main import app
+from app.pagination import SortedIds, iter_ids, encode_cursor, decode_cursor
+
+BASE_URL = "http://127.0.0.1:8000"  # Single variable for base_url
+
+def test_sorted_ids_pages_after_cursor():
+    ids = SortedIds()
+    for item_id in [5, 1, 3, 4, 2, 3]:
+        ids.add(item_id)
+    ids.remove(4)
+    assert ids.all() == [1, 2, 3, 5]
+    assert ids.after(None, 2) == [1, 2]
+    assert ids.after(2, 2) == [3, 5]
+    assert list(iter_ids(ids.after, chunk_size=1)) == [1, 2, 3, 5]
+
+def test_cursor_round_trip():
+    assert decode_cursor(encode_cursor(12345)) == 12345
+    with pytest.raises(ValueError):
+        decode_cursor("not a cursor!")
+
+@pytest.mark.asyncio
+async def test_page_through_inventory():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        expected = [inv["medication_id"] for inv in (await client.get("/inventory/")).json()]
+        seen = []
+        response = await client.get("/inventory/", params={"limit": 2})
+        while True:
+            assert response.status_code == 200
+            seen += [inv["medication_id"] for inv in response.json()]
+            if "Link" not in response.headers:
+                break
+            response = await client.get(response.headers["Link"].split(";")[0].strip("<>"))
+        assert seen == expected == sorted(expected)
+
+        response = await client.get("/inventory/", params={"cursor": "!!"})
+        assert response.status_code == 400
+
+@pytest.mark.asyncio
+async def test_stream_medications():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        expected = (await client.get("/medications/")).json()
+
+        response = await client.get("/medications/", headers={"Accept": "application/x-ndjson"})
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("application/x-ndjson")
+        assert [json.loads(line) for line in response.text.splitlines()] == expected
+
+        response = await client.get("/medications/", params={"stream": True}, headers={"Accept": "application/xml"})
+        items = xmltodict.parse(response.text)["response"]["item"]
+        assert [int(item["id"]) for item in items] == [med["id"] for med in expected]
+
+@pytest.mark.asyncio
+async def test_stream_pages_with_limit():
+    """
+    Streamed listings honour limit and link to the next page like the buffered ones.
+    """
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        expected = [inv["medication_id"] for inv in (await client.get("/inventory/")).json()]
+        seen = []
+        response = await client.get("/inventory/", params={"limit": 2}, headers={"Accept": "application/x-ndjson"})
+        while True:
+            assert response.status_code == 200
+            assert response.headers["Vary"] == "Accept"
+            page = [json.loads(line)["medication_id"] for line in response.text.splitlines()]
+            assert len(page) <= 2
+            seen += page
+            if "Link" not in response.headers:
+                break
+            response = await client.get(response.headers["Link"].split(";")[0].strip("<>"), headers={"Accept": "application/x-ndjson"})
+        assert seen == expected
+
+        response = await client.get("/medications/", params={"stream": True, "limit": 1})
+        assert len(response.text.splitlines()) == 1
+        assert "Link" in response.headers
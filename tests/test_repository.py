@@ -0,0 +1,168 @@
+import os
+import subprocess
+import sys
+import threading
+import pytest
+from app.models import Medication, Inventory
+from app.repository import MEDICATION, INVENTORY, ConcurrentUpdate, MemoryRepository, SQLiteRepository, LogRepository, open_repository
+from app.wal import list_segments
+
+@pytest.fixture(params=["memory", "sqlite", "log"])
+def repository(request, tmp_path):
+    if request.param == "memory":
+        yield MemoryRepository()
+    else:
+        repo = SQLiteRepository(str(tmp_path / "medications.db")) if request.param == "sqlite" else LogRepository(str(tmp_path / "log"))
+        yield repo
+        repo.close()
+
+def test_repository_round_trip(repository):
+    repository.save_medication(1, Medication(id=1, name="Aspirin", description="Pain reliever"))
+    repository.save_inventory_many([
+        (1, Inventory(medication_id=1, quantity=10, shelf_id="A1", shelf_location="Shelf 1")),
+        (2, Inventory(medication_id=2, quantity=0, shelf_id="A2", shelf_location="Shelf 2")),
+    ])
+    assert repository.get_medication(1).name == "Aspirin"
+    assert repository.get_inventory(1).quantity == 10
+    assert [inv.medication_id for inv in repository.inventory()] == [1, 2]
+
+    repository.remove_inventory(2)
+    repository.remove_medication(1)
+    assert repository.get_medication(1) is None
+    assert [inv.medication_id for inv in repository.inventory()] == [1]
+
+def test_conditional_writes_compare_and_swap(repository):
+    original = Medication(id=1, name="Aspirin")
+    repository.save_medication(1, original, expected=None)
+    with pytest.raises(ConcurrentUpdate):
+        repository.save_medication(1, Medication(id=1, name="Other"), expected=None)
+
+    renamed = Medication(id=1, name="Aspirin 500")
+    repository.save_medication(1, renamed, expected=original)
+    with pytest.raises(ConcurrentUpdate):
+        repository.save_medication(1, Medication(id=1, name="Lost update"), expected=original)
+    assert repository.get_medication(1).name == "Aspirin 500"
+
+    stocked = Inventory(medication_id=1, quantity=5, shelf_id="A1", shelf_location="Shelf 1")
+    repository.save_inventory(1, stocked, expected=None)
+    with pytest.raises(ConcurrentUpdate):
+        # Nothing in a batch is written if one of its items changed
+        repository.save_inventory_many(
+            [(1, stocked.copy(update={"quantity": 6})), (2, stocked.copy(update={"medication_id": 2}))],
+            {1: stocked.copy(update={"quantity": 4}), 2: None}
+        )
+    assert repository.get_inventory(1).quantity == 5
+    assert repository.get_inventory(2) is None
+
+def test_sqlite_workers_see_each_others_writes(tmp_path):
+    path = str(tmp_path / "shared.db")
+    writer, reader = SQLiteRepository(path), SQLiteRepository(path)
+    seq = reader.latest_seq()
+
+    writer.save_medication(7, Medication(id=7, name="Metformin"))
+    writer.save_inventory(7, Inventory(medication_id=7, quantity=3, shelf_id="C1", shelf_location="Shelf 5"))
+    seq, changes = reader.changes_since(seq)
+    assert [(kind, record_id) for kind, record_id, _ in changes] == [(MEDICATION, 7), (INVENTORY, 7)]
+    assert changes[1][2].quantity == 3
+
+    assert reader.changes_since(seq) == (seq, [])
+
+    writer.remove_medication(7)
+    seq, changes = reader.changes_since(seq)
+    assert changes == [(MEDICATION, 7, None)]
+    writer.close()
+    reader.close()
+
+def test_sqlite_expired_changes_require_reload(tmp_path):
+    repository = SQLiteRepository(str(tmp_path / "pruned.db"), change_retention=1)
+    for med_id in range(1, 1001):
+        repository.save_medication(med_id, Medication(id=med_id, name=f"Medication {med_id}"))
+    latest, changes = repository.changes_since(0)
+    assert changes is None
+    assert latest == repository.latest_seq()
+    repository.close()
+
+def test_open_repository_rejects_unknown_urls():
+    with pytest.raises(ValueError):
+        open_repository("postgres://localhost/medications")
+
+def test_log_repository_restarts_from_snapshot_and_log(tmp_path):
+    directory = str(tmp_path / "log")
+    repository = LogRepository(directory)
+    for med_id in range(1, 6):
+        repository.save_medication(med_id, Medication(id=med_id, name=f"Medication {med_id}"))
+        repository.save_inventory(med_id, Inventory(medication_id=med_id, quantity=med_id, shelf_id="A1", shelf_location="Shelf 1"))
+    repository.snapshot_now()
+    repository.save_medication(1, Medication(id=1, name="Renamed"))
+    repository.remove_medication(2)
+    repository.remove_inventory(3)
+    repository.close()
+
+    reopened = LogRepository(directory)
+    assert reopened.get_medication(1).name == "Renamed"
+    assert reopened.get_medication(2) is None
+    assert [inv.medication_id for inv in reopened.inventory()] == [1, 2, 4, 5]
+    snapshot, tail = reopened.load_snapshot()
+    assert len(snapshot.medication_ids) == 5
+    assert [(kind, med_id) for kind, med_id, _ in tail] == [(MEDICATION, 1), (MEDICATION, 2), (INVENTORY, 3)]
+    reopened.close()
+
+def test_log_repository_cuts_off_torn_writes(tmp_path):
+    directory = str(tmp_path / "log")
+    repository = LogRepository(directory, fsync="always")
+    repository.save_medication(1, Medication(id=1, name="Aspirin"))
+    repository.close()
+    # A crash in the middle of writing the next entry
+    _, segment = list_segments(directory)[-1]
+    with open(segment, "ab") as f:
+        f.write(b"\x40\x00\x00\x00\x00\x00\x00\x00{\"half")
+
+    reopened = LogRepository(directory)
+    assert reopened.get_medication(1).name == "Aspirin"
+    reopened.save_medication(2, Medication(id=2, name="Ibuprofen"))
+    reopened.close()
+    assert [m.name for m in LogRepository(directory).medications()] == ["Aspirin", "Ibuprofen"]
+
+def test_log_repository_compacts_in_the_background(tmp_path):
+    directory = str(tmp_path / "log")
+    repository = LogRepository(directory, snapshot_every=10)
+
+    def write(offset):
+        for med_id in range(offset, offset + 25):
+            repository.save_medication(med_id, Medication(id=med_id, name=f"Medication {med_id}"))
+
+    writers = [threading.Thread(target=write, args=(offset,)) for offset in (1, 101, 201, 301)]
+    for writer in writers:
+        writer.start()
+    for writer in writers:
+        writer.join()
+    repository.close()
+    assert os.path.exists(os.path.join(directory, "snapshot"))
+    assert len(list_segments(directory)) < 10
+
+    reopened = LogRepository(directory)
+    assert sorted(m.id for m in reopened.medications()) == [offset + i for offset in (1, 101, 201, 301) for i in range(25)]
+    reopened.close()
+
+def test_app_restarts_from_wal_storage(tmp_path):
+    script = """
+import sys
+from app import data
+from app.models import Medication, Inventory
+if sys.argv[1] == "write":
+    data.save_medication(10, Medication(id=10, name="Persisted"))
+    data.save_inventory(10, Inventory(medication_id=10, quantity=0, shelf_id="P1", shelf_location="Shelf P1"))
+    data.repository.snapshot_now()
+    data.save_medication(11, Medication(id=11, name="Logged"))
+    data.remove_medication(1)
+data.wait_for_index("names")
+data.wait_for_index("inventory")
+print(sorted(data.medications), data.medication_names.search("^(Pers|Log)"), data.stock_levels.ids("empty"),
+      data.medication_etags[10], data.collection_digests)
+data.repository.close()
+"""
+    env = dict(os.environ, STORAGE_URL=f"wal:///{tmp_path}/store", PYTHONPATH=os.getcwd())
+    run = lambda mode: subprocess.run([sys.executable, "-c", script, mode], env=env, capture_output=True, text=True, check=True).stdout
+    written = run("write")
+    assert written.startswith("[2, 3, 10, 11] [10, 11] [2, 10] ")
+    assert run("read") == written
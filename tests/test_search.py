@@ -0,0 +1,92 @@
+import re
+import time
+import pytest
+from httpx import AsyncClient
+from app.main import app
+from app.search import MAX_PATTERN_LENGTH, NameIndex, PatternTooComplex, SearchTimeout, check_pattern, required_literals
+
+BASE_URL = "http://127.0.0.1:8000"  # Single variable for base_url
+
+def build_index():
+    index = NameIndex()
+    for med_id, name in enumerate(["Aspirin", "Ibuprofen", "Paracetamol", "aspartame", "Ämoxicillin"], start=1):
+        index.add(med_id, name)
+    return index
+
+def test_required_literals_extracts_anchored_runs():
+    assert required_literals("^Asp") == ["\x02\x02asp"]
+    assert required_literals("mol$") == ["mol\x03\x03"]
+    assert required_literals("pro.*fen") == ["pro", "fen"]
+    assert required_literals("a|b") == []
+
+def test_index_prunes_candidates():
+    index = build_index()
+    assert index.candidates("^Asp") == {1, 4, 5}  # non-ASCII names are always candidates
+    assert index.candidates("cet") == {3, 5}
+    assert index.candidates("x?") == {1, 2, 3, 4, 5}
+
+def test_index_matches_linear_scan():
+    index = build_index()
+    names = {1: "Aspirin", 2: "Ibuprofen", 3: "Paracetamol", 4: "aspartame", 5: "Ämoxicillin"}
+    for pattern, flags in [("^Asp", 0), ("^asp", re.IGNORECASE), ("(?i)AMOX", 0), ("in$", 0), ("r.*n", 0), ("", 0)]:
+        expected = sorted(med_id for med_id, name in names.items() if re.search(pattern, name, flags))
+        assert index.search(pattern, flags) == expected
+
+def test_index_incremental_updates():
+    index = build_index()
+    index.add(1, "Acetylsalicylic acid")
+    index.remove(2)
+    assert index.search("^Asp") == []
+    assert index.search("salicyl") == [1]
+    assert index.search("profen") == []
+
+@pytest.mark.asyncio
+async def test_search_medications_by_regex():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        response = await client.get("/medications/", params={"regex": "^paracet", "ignore_case": True})
+        assert response.status_code == 200
+        assert [med["id"] for med in response.json()] == [3]
+
+        response = await client.get("/medications/", params={"regex": "("})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Invalid regex pattern"
+
+def test_patterns_that_backtrack_exponentially_are_refused():
+    for pattern in ["pro.*fen", "(foo|bar)+", "[a-z]+ [0-9]+mg", "(ab)*", "x?"]:
+        check_pattern(pattern)
+    for pattern in ["(a+)+$", r"(\w+\s?)*$", "(a|ab)*c", "(?=(a*)*)b", "a" * (MAX_PATTERN_LENGTH + 1)]:
+        with pytest.raises(PatternTooComplex):
+            check_pattern(pattern)
+
+def test_patterns_the_matcher_reads_differently_are_refused():
+    # The index prunes by re's reading of a pattern but regex matches it
+    index = build_index()
+    for pattern in ["[]:[]x", "[^]:]", r"Asp\{e}", "a{2,3}", "[{e}]"]:
+        check_pattern(pattern)
+    for pattern in ["[[:alpha:]]ain", "[a[:digit:]]x", "(rin){e<=1}", "a{s}"]:
+        with pytest.raises(re.error):
+            index.search(pattern)
+
+def test_search_gives_up_after_its_timeout():
+    index = NameIndex()
+    for med_id in range(1000):
+        index.add(med_id, f"Medication {med_id}")
+    assert len(index.search("Medication", timeout=10)) == 1000
+    with pytest.raises(SearchTimeout):
+        index.search("Medication", timeout=-1)
+
+def test_timeout_interrupts_a_single_match():
+    # Adjacent quantifiers pass check_pattern but backtrack polynomially
+    index = NameIndex()
+    index.add(1, "a" * 1000 + "!")
+    start = time.monotonic()
+    with pytest.raises(SearchTimeout):
+        index.search(r"\w*\w*\w*\w*\d$", timeout=0.2)
+    assert time.monotonic() - start < 1
+
+@pytest.mark.asyncio
+async def test_search_refuses_catastrophic_patterns():
+    async with AsyncClient(app=app, base_url=BASE_URL) as client:
+        response = await client.get("/medications/", params={"regex": "^(a+)+$"})
+        assert response.status_code == 400
+        assert response.json()["detail"] == "Regex pattern too complex: nested quantifiers"
@@ -0,0 +1,17 @@
+from app.shelves import ShelfIndex
+
+def test_shelf_index_moves_ids_between_shelves():
+    index = ShelfIndex()
+    index.set(1, "A1")
+    index.set(2, "A1")
+    index.set(3, "B1")
+    assert index.ids("A1") == [1, 2]
+    assert index.shelves() == ["A1", "B1"]
+
+    index.set(1, "B1")
+    index.remove(2)
+    assert index.ids("A1") == []
+    assert index.ids("B1") == [1, 3]
+    assert index.shelves() == ["B1"]
+    assert index.shelf_of(1) == "B1"
+    assert index.shelf_of(2) is None
@@ -0,0 +1,44 @@
+from app.models import Medication, Inventory
+from app.snapshots import RecordTable, Snapshot, write_snapshot
+from app.utils import json_etag, etag_digest
+from app.encoders import encode_json
+
+def test_snapshot_round_trip(tmp_path):
+    path = str(tmp_path / "snapshot")
+    medications = {med_id: Medication(id=med_id, name=f"Medication {med_id}") for med_id in (3, 1, 2)}
+    medications[2]._icon_file = "abc.png"
+    inventory = {1: Inventory(medication_id=1, quantity=4, shelf_id="A1", shelf_location="Shelf 1")}
+    write_snapshot(path, 7, None, medications, inventory)
+
+    snapshot = Snapshot(path)
+    assert snapshot.seq == 7
+    assert snapshot.medication_ids.tolist() == [1, 2, 3]
+    assert snapshot.medication(1) == medications[2] and snapshot.medication(1)._icon_file == "abc.png"
+    assert snapshot.medication_etag(0) == json_etag(encode_json(medications[1]))
+    assert snapshot.inventory_item(0) == inventory[1]
+    assert snapshot.digests["medications"] == etag_digest(json_etag(encode_json(medications[1]))) ^ etag_digest(json_etag(encode_json(medications[2]))) ^ etag_digest(json_etag(encode_json(medications[3])))
+
+    # Unchanged records are carried over from the previous snapshot
+    write_snapshot(path + ".next", 9, snapshot, {2: None, 4: Medication(id=4, name="New")}, {1: inventory[1].copy(update={"shelf_id": "B2"})})
+    merged = Snapshot(path + ".next")
+    assert merged.medication_ids.tolist() == [1, 3, 4]
+    assert [merged.medication(i).name for i in range(3)] == ["Medication 1", "Medication 3", "New"]
+    assert merged.icons == {}
+    assert merged.inventory_item(0).shelf_id == "B2"
+    assert merged.digests["medications"] == etag_digest(json_etag(encode_json(medications[1]))) ^ etag_digest(json_etag(encode_json(medications[3]))) ^ etag_digest(json_etag(encode_json(Medication(id=4, name="New"))))
+
+def test_record_table_overlays_its_base(tmp_path):
+    table = RecordTable(cache=True)
+    table.attach([1, 3, 5], lambda i: f"base {i}")
+    assert len(table) == 3 and table[3] == "base 1" and 4 not in table
+
+    table[3] = "written"
+    table[4] = "added"
+    del table[5]
+    assert table.pop(1) == "base 0"
+    assert table.get(5) is None
+    assert dict(table) == {3: "written", 4: "added"}
+    assert len(table) == 2
+
+    table.clear()
+    assert len(table) == 0 and table.get(3) is None
@@ -0,0 +1,26 @@
+from app.stock import StockIndex, EMPTY, LOW, IN_STOCK
+
+def test_stock_index_moves_ids_between_buckets():
+    index = StockIndex(low_stock_threshold=10)
+    index.set(1, 100)
+    index.set(2, 0)
+    index.set(3, 5)
+    assert index.ids(IN_STOCK) == [1]
+    assert index.ids(EMPTY) == [2]
+    assert index.ids(LOW) == [3]
+
+    index.set(1, 0)
+    index.set(2, 10)
+    index.remove(3)
+    assert index.ids(IN_STOCK) == []
+    assert index.ids(EMPTY) == [1]
+    assert index.ids(LOW) == [2]
+
+def test_stock_index_threshold_change_rebuckets():
+    index = StockIndex(low_stock_threshold=10)
+    index.set(1, 20)
+    index.set(2, 5)
+    index.set_low_stock_threshold(25)
+    assert index.ids(LOW) == [1, 2]
+    index.set_low_stock_threshold(1)
+    assert index.ids(IN_STOCK) == [1, 2]
@@ -0,0 +1,99 @@
+import logging
+import time
+from fastapi.testclient import TestClient
+from app.main import app
+from app.profiling import SamplingProfiler
+from app.tracing import settings
+
+client = TestClient(app)
+ADMIN = {"X-Admin-Token": "secret"}
+
+def test_stage_timings_are_exported(monkeypatch):
+    """
+    A validated write records the validation, etag and serialize stages in the stage histogram.
+    """
+    monkeypatch.setattr("app.main.METRICS_CACHE_TTL", 0)
+    client.post("/medications/", json={"id": 30, "name": "Traced Medication"})
+    response = client.put("/inventory/30", json={"medication_id": 30, "quantity": 5, "shelf_id": "T1", "shelf_location": "Shelf T1"}, headers={"If-Match": "*"})
+    assert response.status_code == 200
+
+    metrics_text = client.get("/metrics").text
+    for stage in ("validation", "etag", "serialize"):
+        assert f'stage_latency_seconds_count{{stage="{stage}"}}' in metrics_text
+
+def test_trace_log(monkeypatch, caplog):
+    """
+    With trace logging on every request logs its route, status, duration and stage totals.
+    """
+    monkeypatch.setattr(settings, "trace_log", True)
+    with caplog.at_level(logging.INFO, logger="app.trace"):
+        client.get("/medications/1")
+    [line] = [record.getMessage() for record in caplog.records if record.name == "app.trace"]
+    assert line.startswith("GET /medications/{med_id} 200 ")
+    assert "validation=" in line
+
+def test_profile_requires_admin_token(monkeypatch):
+    """
+    ?profile=1 is ignored without an ADMIN_TOKEN or with the wrong token, and the admin endpoints are forbidden.
+    """
+    assert client.get("/medications/1?profile=1", headers=ADMIN).json()["id"] == 1
+    assert client.get("/admin/tracing", headers=ADMIN).status_code == 403
+
+    monkeypatch.setattr("app.tracing.ADMIN_TOKEN", "secret")
+    assert client.get("/medications/1?profile=1", headers={"X-Admin-Token": "wrong"}).json()["id"] == 1
+    assert client.get("/admin/tracing", headers={"X-Admin-Token": "wrong"}).status_code == 403
+
+def test_profile_is_returned_to_admins(monkeypatch):
+    """
+    An admin's ?profile=1 request gets the collapsed-stack profile instead of the response.
+    """
+    monkeypatch.setattr("app.tracing.ADMIN_TOKEN", "secret")
+    response = client.get("/medications/1?profile=1", headers=ADMIN)
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    assert response.headers["X-Profiled-Status"] == "200"
+    for line in response.text.splitlines():
+        stack, count = line.rsplit(" ", 1)
+        assert stack.split(";")[0] in ("loop", "worker") and int(count) > 0
+
+    response = client.get("/medications/999999", headers=dict(ADMIN, **{"X-Profile": "1"}))
+    assert response.headers["X-Profiled-Status"] == "404"
+
+def test_sampled_profiles_are_stored(monkeypatch, tmp_path):
+    """
+    Switching on sampling via PUT /admin/tracing stores profiles that the admin endpoints list and return.
+    """
+    monkeypatch.setattr("app.tracing.ADMIN_TOKEN", "secret")
+    monkeypatch.setattr("app.profiling.PROFILE_DIR", str(tmp_path))
+    monkeypatch.setattr(settings, "profile_sample_rate", 0.0)
+
+    response = client.put("/admin/tracing", json={"profile_sample_rate": 1}, headers=ADMIN)
+    assert response.json()["profile_sample_rate"] == 1
+    assert client.get("/inventory/1").json()["medication_id"] == 1
+    client.put("/admin/tracing", json={"profile_sample_rate": 0}, headers=ADMIN)
+
+    names = client.get("/admin/profiles", headers=ADMIN).json()
+    assert any("GET_inventory_med_id_" in name for name in names)
+    assert client.get(f"/admin/profiles/{names[-1]}", headers=ADMIN).status_code == 200
+    assert client.get("/admin/profiles/..%2Fsecrets.folded", headers=ADMIN).status_code == 404
+    assert client.put("/admin/tracing", json={"profile_sample_rate": 2}, headers=ADMIN).status_code == 422
+
+def test_sampling_profiler_collapses_stacks():
+    """
+    Samples of a registered thread are aggregated into "outer;...;leaf count" lines.
+    """
+    import threading
+
+    def busy_wait():
+        end = time.perf_counter() + 0.05
+        while time.perf_counter() < end:
+            pass
+
+    profiler = SamplingProfiler(interval=0.001)
+    profiler.add_thread(threading.get_ident(), "main")
+    profiler.start()
+    busy_wait()
+    profiler.stop()
+    lines = profiler.collapsed().splitlines()
+    assert profiler.samples > 0
+    assert any(line.startswith("main;") and "busy_wait (tests/test_tracing.py)" in line for line in lines)